@@ -0,0 +1,531 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Client for the smart-socket protocol of the adb server.
+
+Device commands go straight to the server adb keeps running on the host
+instead of through an adb process per command. Arguments never pass
+through a host shell and one sync connection is kept per device for all
+push, pull and stat requests.
+"""
+
+import collections
+import hashlib
+import itertools
+import logging
+import os
+import os.path
+import pipes
+import posixpath
+import re
+import socket
+import stat
+import struct
+import threading
+import time
+import uuid
+
+from phabletutils import settings
+from phabletutils import trace
+from phabletutils import verification
+
+log = logging.getLogger()
+
+# Largest DATA block adbd accepts in a sync transfer.
+SYNC_DATA_MAX = 64 * 1024
+
+Stat = collections.namedtuple('Stat', 'mode size mtime')
+Result = collections.namedtuple('Result', 'command status output')
+
+
+class _Disconnected(EnvironmentError):
+    '''The adb server closed the connection.'''
+
+
+def server_address():
+    port = os.environ.get('ANDROID_ADB_SERVER_PORT',
+                          settings.adb_server_port)
+    return settings.adb_server_host, int(port)
+
+
+def quote(command):
+    '''Returns command for the device shell, quoting list arguments.'''
+    if isinstance(command, basestring):
+        return command
+    return ' '.join(pipes.quote(str(arg)) for arg in command)
+
+
+class _Connection(object):
+    '''One socket to the adb server.'''
+
+    def __init__(self, address, timeout):
+        try:
+            self._sock = socket.create_connection(address, timeout)
+        except socket.error as e:
+            raise EnvironmentError('Cannot connect to the adb server on '
+                                   '%s:%d: %s' % (address + (e,)))
+        # Sync requests are small writes answered by the server, Nagle
+        # would hold each one back until the previous one is acked.
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def send(self, data):
+        try:
+            self._sock.sendall(data)
+        except socket.error as e:
+            raise _Disconnected('Lost the adb server: %s' % e)
+
+    def recv(self, size):
+        '''Returns exactly size bytes.'''
+        chunks = []
+        while size:
+            chunk = self._sock.recv(min(size, SYNC_DATA_MAX))
+            if not chunk:
+                raise _Disconnected('adb server closed the connection')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def read_all(self):
+        '''Returns everything sent until the server closes.'''
+        chunks = []
+        while True:
+            chunk = self._sock.recv(SYNC_DATA_MAX)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def read_string(self):
+        return self.recv(int(self.recv(4), 16))
+
+    def status(self, service):
+        '''Reads the OKAY for service, raising on FAIL.'''
+        status = self.recv(4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise EnvironmentError('adb %s failed: %s' %
+                                   (service, self.read_string()))
+        raise EnvironmentError('Unexpected adb reply %r to %s' %
+                               (status, service))
+
+    def request(self, service):
+        self.send('%04x%s' % (len(service), service))
+        self.status(service)
+
+    def close(self):
+        self._sock.close()
+
+
+class Client(object):
+    '''
+    Sends adb services to the device with serial.
+
+    Without a serial the only device attached is used, like adb does.
+    '''
+
+    def __init__(self, serial=None, timeout=None):
+        self.serial = serial
+        self._timeout = settings.adb_timeout if timeout is None else timeout
+        self._sync = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return _Connection(server_address(), self._timeout)
+
+    def _transport(self, service):
+        '''Returns a connection to service on the device.'''
+        conn = self._connect()
+        try:
+            if self.serial:
+                conn.request('host:transport:%s' % self.serial)
+            else:
+                conn.request('host:transport-any')
+            conn.request(service)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _host_service(self, service):
+        if self.serial:
+            return 'host-serial:%s:%s' % (self.serial, service)
+        return 'host:%s' % service
+
+    def host(self, service):
+        '''Returns the reply of a host service such as host:version.'''
+        conn = self._connect()
+        try:
+            conn.request(service)
+            return conn.read_string()
+        finally:
+            conn.close()
+
+    def version(self):
+        '''Returns the protocol version of the adb server.'''
+        return int(self.host('host:version'), 16)
+
+    def devices(self):
+        '''Returns (serial, state) for every device the server knows.'''
+        devices = []
+        for line in self.host('host:devices').splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                devices.append((fields[0], fields[1]))
+        return devices
+
+    def shell(self, command):
+        '''Runs command in the device shell and returns its output.'''
+        conn = self._transport('shell:%s' % quote(command))
+        try:
+            conn.settimeout(None)
+            return conn.read_all()
+        finally:
+            conn.close()
+
+    def shell_batch(self, commands):
+        '''
+        Runs commands one after the other in a single device shell.
+
+        Every command runs in its own subshell so state does not leak to
+        the next one. Returns (status, output) for each command, with
+        output line endings normalized to \\n.
+        '''
+        if not commands:
+            return []
+        marker = 'phablet-flash-%s' % uuid.uuid4().hex
+        script = '; '.join('(%s); status=$?; echo; echo %s $status' %
+                           (quote(command), marker) for command in commands)
+        output = self.shell(script).replace('\r\n', '\n')
+        results = [(int(status), text) for text, status in re.findall(
+            r'(.*?)\n%s (\d+)\n' % marker, output, re.DOTALL)]
+        if len(results) != len(commands):
+            raise EnvironmentError('Device shell stopped after %d of %d '
+                                   'commands' % (len(results), len(commands)))
+        return results
+
+    def _restart(self, service):
+        self.close()
+        conn = self._transport(service)
+        try:
+            conn.settimeout(None)
+            return conn.read_all()
+        finally:
+            conn.close()
+
+    def reboot(self, target=''):
+        '''Reboots into target, recovery or bootloader, or the system.'''
+        self._restart('reboot:%s' % target)
+
+    def root(self):
+        '''Restarts adbd on the device as root.'''
+        return self._restart('root:')
+
+    def wait_for_device(self):
+        '''Blocks until the device is online.'''
+        service = self._host_service('wait-for-any-device')
+        conn = self._connect()
+        try:
+            conn.request(service)
+            conn.settimeout(None)
+            conn.status(service)
+        finally:
+            conn.close()
+
+    def forward(self, local, remote):
+        '''Forwards the host socket local, e.g. tcp:8888, to remote.'''
+        service = self._host_service('forward:%s;%s' % (local, remote))
+        conn = self._connect()
+        try:
+            conn.request(service)
+            conn.status(service)
+        finally:
+            conn.close()
+
+    def _sync_call(self, func):
+        '''Runs func with the kept sync connection.'''
+        with self._lock:
+            reused = self._sync is not None
+            if not reused:
+                self._sync = self._transport('sync:')
+            try:
+                return func(self._sync)
+            except _Disconnected:
+                self._close_sync()
+                if not reused:
+                    raise
+                # adbd restarted since the connection was opened.
+                log.debug('Reconnecting adb sync')
+            except Exception:
+                self._close_sync()
+                raise
+            self._sync = self._transport('sync:')
+            try:
+                return func(self._sync)
+            except Exception:
+                self._close_sync()
+                raise
+
+    def _close_sync(self):
+        if self._sync is not None:
+            self._sync.close()
+            self._sync = None
+
+    def close(self):
+        '''Closes the kept sync connection.'''
+        with self._lock:
+            if self._sync is not None:
+                try:
+                    self._sync.send(struct.pack('<4sI', 'QUIT', 0))
+                except EnvironmentError:
+                    pass
+            self._close_sync()
+
+    def _stat_all(self, conn, paths):
+        '''Returns the Stat of every path, asking for all of them at once.'''
+        conn.send(''.join(struct.pack('<4sI', 'STAT', len(path)) + path
+                          for path in paths))
+        stats = []
+        for _ in paths:
+            reply = conn.recv(16)
+            if reply[:4] != 'STAT':
+                raise EnvironmentError('Unexpected adb reply %r to STAT' %
+                                       reply[:4])
+            stats.append(Stat(*struct.unpack('<III', reply[4:])))
+        return stats
+
+    def stat(self, path):
+        '''Returns the Stat of path on the device, mode is 0 if missing.'''
+        return self._sync_call(lambda conn: self._stat_all(conn, [path])[0])
+
+    def _send_file(self, conn, src, dst):
+        info = os.stat(src)
+        header = '%s,%d' % (dst, info.st_mode)
+        conn.send(struct.pack('<4sI', 'SEND', len(header)) + header)
+        with open(src, 'rb') as f:
+            while True:
+                data = f.read(SYNC_DATA_MAX)
+                if not data:
+                    break
+                conn.send(struct.pack('<4sI', 'DATA', len(data)) + data)
+        conn.send(struct.pack('<4sI', 'DONE', int(info.st_mtime)))
+        reply, length = struct.unpack('<4sI', conn.recv(8))
+        if reply == 'FAIL':
+            raise EnvironmentError('Cannot push %s to %s: %s' %
+                                   (src, dst, conn.recv(length)))
+        if reply != 'OKAY':
+            raise EnvironmentError('Unexpected adb reply %r to SEND' % reply)
+        return info.st_size
+
+    def _resolve(self, conn, pairs):
+        '''Returns the (src, dst) file pairs that pushing pairs copies.'''
+        ambiguous = [dst for src, dst in pairs
+                     if not os.path.isdir(src) and not dst.endswith('/')]
+        directories = set(dst for dst, info in
+                          zip(ambiguous, self._stat_all(conn, ambiguous))
+                          if stat.S_ISDIR(info.mode))
+        files = []
+        for src, dst in pairs:
+            if os.path.isdir(src):
+                for root, _, names in os.walk(src):
+                    for name in sorted(names):
+                        path = os.path.join(root, name)
+                        files.append((path, posixpath.join(
+                            dst, os.path.relpath(path, src))))
+            elif dst.endswith('/') or dst in directories:
+                files.append((src, posixpath.join(dst,
+                                                  os.path.basename(src))))
+            else:
+                files.append((src, dst))
+        return files
+
+    def _device_md5sums(self, paths):
+        '''Returns the md5 of each of paths the device could read.'''
+        sums = {}
+        for line in self.shell(['md5sum'] + paths).splitlines():
+            match = re.match(r'^([0-9a-f]{32})\s+(\S.*)$', line.strip())
+            if match:
+                sums[match.group(2)] = match.group(1)
+        return sums
+
+    def _changed(self, conn, files):
+        '''
+        Returns the file pairs whose target differs from the source.
+
+        Sizes come from one round of sync STATs and the targets of the
+        same size as their source are summed by a single md5sum on the
+        device.
+        '''
+        same_size = []
+        for (src, dst), info in zip(files, self._stat_all(
+                conn, [dst for _, dst in files])):
+            if stat.S_ISREG(info.mode) and \
+                    info.size == os.path.getsize(src):
+                same_size.append((src, dst))
+        unchanged = set()
+        if same_size:
+            device_sums = self._device_md5sums([dst for _, dst in same_size])
+            unchanged = set(
+                (src, dst) for src, dst in same_size if device_sums.get(dst)
+                == verification.digest(src, hashlib.md5))
+        if unchanged:
+            log.info('%d of %d files are already on the device, %.1f MiB '
+                     'not sent' % (len(unchanged), len(files),
+                                   sum(os.path.getsize(src) for src, _ in
+                                       unchanged) / 1024.0 / 1024))
+        return [pair for pair in files if pair not in unchanged]
+
+    def push_all(self, pairs, incremental=False):
+        '''
+        Copies every (src, dst) pair in one sync transfer.
+
+        With incremental, files already on the device with the same
+        content are not sent. Returns the bytes sent.
+        '''
+
+        def send(conn):
+            files = self._resolve(conn, pairs)
+            if incremental:
+                files = self._changed(conn, files)
+            return sum(self._send_file(conn, src, dst)
+                       for src, dst in files)
+        return self._sync_call(send)
+
+    def push(self, src, dst, incremental=False):
+        '''
+        Copies the file or directory src to dst on the device.
+
+        A file pushed to an existing directory, or a dst ending in /, is
+        placed in it under its own name. Returns the bytes sent.
+        '''
+        return self.push_all([(src, dst)], incremental)
+
+    def push_stream(self, chunks, dst, mode=0644):
+        '''
+        Writes the data yielded by chunks to the file dst on the device.
+
+        The transfer has a sync connection of its own, a failure midway
+        leaves a partial dst behind. Returns the bytes sent.
+        '''
+        conn = self._transport('sync:')
+        try:
+            header = '%s,%d' % (dst, stat.S_IFREG | mode)
+            conn.send(struct.pack('<4sI', 'SEND', len(header)) + header)
+            size = 0
+            for chunk in chunks:
+                for offset in range(0, len(chunk), SYNC_DATA_MAX):
+                    data = chunk[offset:offset + SYNC_DATA_MAX]
+                    conn.send(struct.pack('<4sI', 'DATA', len(data)) + data)
+                size += len(chunk)
+            conn.send(struct.pack('<4sI', 'DONE', int(time.time())))
+            reply, length = struct.unpack('<4sI', conn.recv(8))
+            if reply == 'FAIL':
+                raise EnvironmentError('Cannot write %s: %s' %
+                                       (dst, conn.recv(length)))
+            if reply != 'OKAY':
+                raise EnvironmentError('Unexpected adb reply %r to SEND' %
+                                       reply)
+            conn.send(struct.pack('<4sI', 'QUIT', 0))
+            return size
+        finally:
+            conn.close()
+
+    def pull(self, src, dst):
+        '''Copies the file src on the device to dst. Returns its size.'''
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, posixpath.basename(src))
+
+        def receive(conn):
+            conn.send(struct.pack('<4sI', 'RECV', len(src)) + src)
+            size = 0
+            with open(dst, 'wb') as f:
+                while True:
+                    reply, length = struct.unpack('<4sI', conn.recv(8))
+                    if reply == 'DONE':
+                        return size
+                    if reply == 'FAIL':
+                        raise EnvironmentError('Cannot pull %s: %s' %
+                                               (src, conn.recv(length)))
+                    if reply != 'DATA':
+                        raise EnvironmentError(
+                            'Unexpected adb reply %r to RECV' % reply)
+                    f.write(conn.recv(length))
+                    size += length
+        try:
+            return self._sync_call(receive)
+        except Exception:
+            if os.path.exists(dst):
+                os.unlink(dst)
+            raise
+
+
+class Batch(object):
+    '''
+    Queues shell commands and pushes for one round trip to the device.
+
+    Consecutive shell commands share one device shell and consecutive
+    pushes one sync transfer. run() returns a Result per queued
+    operation in order, a push failure is raised.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self._queue = []
+        self.results = []
+
+    def shell(self, command):
+        self._queue.append(('shell', command))
+
+    def push(self, src, dst, incremental=False):
+        self._queue.append(('push', (src, dst, incremental)))
+
+    def run(self):
+        queue, self._queue = self._queue, []
+        results = []
+        for kind, group in itertools.groupby(queue, lambda item: item[0]):
+            items = [item for _, item in group]
+            if kind == 'shell':
+                log.debug('Running %d commands in one shell' % len(items))
+                with trace.span('shell batch', 'device',
+                                commands=map(quote, items)) as span:
+                    statuses = self._client.shell_batch(items)
+                    span['exit_codes'] = [status for status, _ in statuses]
+                for command, (status, output) in zip(items, statuses):
+                    results.append(Result(quote(command), status, output))
+            else:
+                for incremental, pushes in itertools.groupby(
+                        items, lambda item: item[2]):
+                    pairs = [(src, dst) for src, dst, _ in pushes]
+                    for src, dst in pairs:
+                        log.info('Pushing %s to %s' % (src, dst))
+                    with trace.span('push batch', 'device',
+                                    files=[src for src, _ in pairs]) as span:
+                        span['bytes'] = self._client.push_all(pairs,
+                                                              incremental)
+                    results.extend(Result('push %s %s' % pair, 0, '')
+                                   for pair in pairs)
+        self.results.extend(results)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
@@ -20,6 +20,7 @@ import tempfile
 import urllib
 import urlparse
 
+from phabletutils import cache
 from phabletutils import cdimage
 from phabletutils import environment
 from phabletutils import resources
@@ -28,6 +29,29 @@ from phabletutils import settings
 log = logging.getLogger()
 
 
+def byte_size(value):
+    '''Parses a size like 500K, 2M or 10G into bytes.'''
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    multiplier = units.get(value[-1:].lower(), 1)
+    if value[-1:].lower() in units:
+        value = value[:-1]
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a valid size' % value)
+
+
+def image_revision(value):
+    '''Parses latest, a relative revision like -1 or a version.'''
+    if value == 'latest':
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a valid revision' %
+                                         value)
+
+
 class PathAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         log.debug('PathAction: %r %r %r' %
@@ -42,7 +66,7 @@ class PathAction(argparse.Action):
             zip_file_uri = None
             check = False
         elif uri.scheme == 'http' or uri.scheme == 'https':
-            zip_file_path = tempfile.mktemp()
+            zip_file_path = tempfile.mktemp(dir=cache.tmp_dir())
             zip_file_uri = values
             check = True
         log.debug('Download from %s, path on disk %s' %
@@ -128,9 +152,19 @@ def ubuntu_system(parent_parser, parents):
                         series=settings.default_series,
                         project='imageupdates')
     parser.add_argument('--revision',
-                        type=int,
-                        help='''Download a relative revision from current
-                                (-1, -2, ...) or a specific version.''')
+                        type=image_revision,
+                        help='''Download latest, a relative revision from
+                                current (-1, -2, ...) or a specific
+                                version.''')
+    parser.add_argument('--channel',
+                        default=settings.system_image_channel,
+                        help='''System image channel to provision
+                                from.''')
+    parser.add_argument('--full',
+                        action='store_true',
+                        help='''Flash the full image and wipe the device
+                                instead of upgrading the installed
+                                version with deltas.''')
     return parser
 
 
@@ -190,6 +224,59 @@ def community(parent_parser, parents):
     return parser
 
 
+def collect(parent_parser, parents):
+    parser = parent_parser.add_parser(
+        'gc', parents=parents,
+        help='Removes unused builds to fit the download cache quota.')
+    parser.set_defaults(func=environment.collect_cache)
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='''Enable debug messages.''')
+    return parser
+
+
+def serve(parent_parser, parents):
+    parser = parent_parser.add_parser(
+        'serve', parents=parents,
+        help='''Serves the download cache over HTTP to other hosts
+                using --cache-peer.''')
+    parser.set_defaults(func=environment.serve_cache)
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='''Enable debug messages.''')
+    parser.add_argument('--bind',
+                        default='',
+                        help='''Address to listen on, all by default.''')
+    parser.add_argument('--port',
+                        type=int,
+                        default=settings.serve_port,
+                        help='''Port to listen on.''')
+    return parser
+
+
+def common_cache():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--cache-quota',
+                        type=byte_size,
+                        default=settings.cache_quota,
+                        help='''Evict the least recently used builds
+                                until the download cache fits this
+                                size, e.g.; 10G.''')
+    parser.add_argument('--cache-peer',
+                        dest='cache_peers',
+                        action='append',
+                        default=list(settings.cache_peers),
+                        help='''Base URL of a phablet-flash serve host to
+                                fetch from before upstream. Repeat to try
+                                several in order.''')
+    parser.add_argument('--metadata-ttl',
+                        type=int,
+                        default=settings.metadata_ttl,
+                        help='''Seconds to use cached checksums and
+                                indexes before revalidating them.''')
+    return parser
+
+
 def common_non_system():
     parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--device-path',
@@ -203,6 +290,11 @@ def common_non_system():
     parser.add_argument('--wipe',
                         action='store_true',
                         help='''Wipes device data.''')
+    parser.add_argument('--refresh-hashes',
+                        action='store_true',
+                        help='''Fetch the published checksums again
+                                instead of using the ones kept with the
+                                download.''')
     return parser
 
 
@@ -223,12 +315,41 @@ def common():
                         help='''Enable debug messages.''')
     parser.add_argument('-s',
                         '--serial',
+                        dest='serials',
+                        metavar='SERIAL',
+                        action='append',
                         help='''Device serial. Use when more than
-                                one device is connected.''')
+                                one device is connected, repeat to
+                                provision several devices at once.''')
+    parser.add_argument('--all-devices',
+                        action='store_true',
+                        help='''Provision every attached device.''')
     parser.add_argument('-D',
                         '--download-only',
                         action='store_true',
                         help='Download image only, but do not flash device.')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        help='''Stream the files pushed to the device
+                                straight from the download without
+                                keeping them on the host. Images that
+                                are flashed are still downloaded.''')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=settings.download_concurrency,
+                        help='''Number of files to download at the same
+                                time.''')
+    parser.add_argument('--limit-rate',
+                        type=byte_size,
+                        default=settings.download_rate_limit,
+                        help='''Cap the combined download bandwidth,
+                                e.g.; 500K, 2M.''')
+    parser.add_argument('--trace',
+                        metavar='FILE',
+                        help='''Write how long each phase of the run took
+                                to FILE as Chrome trace events, viewable
+                                in chrome://tracing.''')
     return parser
 
 
@@ -244,13 +365,18 @@ def get_parser():
                   their provisioning options.''')
     # Parsers
     common_parser = common()
+    common_cache_parser = common_cache()
     common_supported_parser = common_supported()
     common_non_system_parser = common_non_system()
     sub = parser.add_subparsers(title='Commands', metavar='')
-    cdimage_touch(sub, [common_parser, common_supported_parser,
-                        common_non_system_parser])
-    legacy(sub, [common_parser, common_supported_parser,
-                 common_non_system_parser])
-    ubuntu_system(sub, [common_parser, common_supported_parser, ])
-    community(sub, [common_parser, common_non_system_parser, ])
+    cdimage_touch(sub, [common_parser, common_cache_parser,
+                        common_supported_parser, common_non_system_parser])
+    legacy(sub, [common_parser, common_cache_parser,
+                 common_supported_parser, common_non_system_parser])
+    ubuntu_system(sub, [common_parser, common_cache_parser,
+                        common_supported_parser, ])
+    community(sub, [common_parser, common_cache_parser,
+                    common_non_system_parser, ])
+    collect(sub, [common_cache_parser, ])
+    serve(sub, [])
     return parser
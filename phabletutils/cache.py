@@ -0,0 +1,213 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Size quota for the phablet-flash download cache.
+
+A build directory is any directory below the cache root that holds
+files which are not hidden, other than checkouts with hidden metadata
+directories. Each run holds a shared lock on the stamp file of the
+builds it uses, whose mtime records the last use. The collector evicts
+the least recently used builds that nobody holds until the cache fits
+its quota, then drops objects no build links to anymore.
+
+A build with subdirectories, like community/<device> next to its config
+checkout, only loses its files; the subdirectories and hidden files such
+as license acceptances stay.
+"""
+
+import fcntl
+import logging
+import os
+import os.path
+import shutil
+import time
+
+from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import store
+
+log = logging.getLogger()
+
+# Stamp files kept open, and so locked, until the process exits.
+_held = {}
+
+
+def root():
+    '''Returns the top level download directory for phablet-flash.'''
+    return downloads.tool_dir()
+
+
+def tmp_dir():
+    '''Returns the directory for downloads that are not part of a build.'''
+    return downloads.tool_dir(settings.cache_tmp_dir)
+
+
+def use(directories):
+    '''Marks directories as used now and holds them until exit.'''
+    for directory in directories:
+        if directory in _held or not os.path.isdir(directory):
+            continue
+        while True:
+            stamp = open(os.path.join(directory, settings.cache_stamp), 'a')
+            fcntl.flock(stamp, fcntl.LOCK_SH)
+            if os.fstat(stamp.fileno()).st_nlink:
+                break
+            # Evicted while waiting for the lock, start over.
+            log.debug('%s was evicted, recreating it' % directory)
+            stamp.close()
+            downloads.setup_download_directory(directory)
+        os.utime(stamp.name, None)
+        _held[directory] = stamp
+
+
+def _remove(directory):
+    '''Removes the build in directory, see the module documentation.'''
+    names = os.listdir(directory)
+    if not any(os.path.isdir(os.path.join(directory, name))
+               for name in names):
+        shutil.rmtree(directory, ignore_errors=True)
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and (not name.startswith('.') or
+                                     name == settings.cache_stamp):
+            os.unlink(path)
+
+
+def _evict(directory):
+    '''
+    Removes directory unless a run holds it, returns True if removed.
+
+    The stamp stays locked until the build is gone, so a run starting to
+    use it meanwhile waits and then finds it evicted.
+    '''
+    if directory in _held:
+        return False
+    try:
+        stamp = open(os.path.join(directory, settings.cache_stamp), 'a')
+    except IOError:
+        return False
+    with stamp:
+        try:
+            fcntl.flock(stamp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        log.info('Removing %s from the download cache' % directory)
+        _remove(directory)
+    return True
+
+
+def _last_used(directory):
+    stamp_path = os.path.join(directory, settings.cache_stamp)
+    if os.path.exists(stamp_path):
+        return os.path.getmtime(stamp_path)
+    mtimes = [os.path.getmtime(os.path.join(directory, f))
+              for f in os.listdir(directory)]
+    return max(mtimes or [os.path.getmtime(directory)])
+
+
+def _builds(cache_root):
+    '''Returns the build directories below cache_root.'''
+    skip = (os.path.join(cache_root, settings.store_dir),
+            os.path.join(cache_root, settings.cache_tmp_dir),
+            os.path.join(cache_root, settings.metadata_cache_dir))
+    builds = []
+    for directory, subdirs, files in os.walk(cache_root):
+        checkout = any(d.startswith('.') for d in subdirs)
+        visible = [f for f in files if not f.startswith('.')]
+        if visible and not checkout and directory != cache_root:
+            builds.append(directory)
+        # Hidden directories hold bzr checkouts and similar metadata.
+        subdirs[:] = [d for d in subdirs if not d.startswith('.') and
+                      os.path.join(directory, d) not in skip]
+    return builds
+
+
+def usage(cache_root):
+    '''Returns the bytes used below cache_root, counting hardlinks once.'''
+    seen = set()
+    total = 0
+    for directory, subdirs, files in os.walk(cache_root):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def _remove_orphans(cache_root):
+    '''Removes store objects that no build directory links to or copied.'''
+    store_dir = os.path.join(cache_root, settings.store_dir)
+    if not os.path.isdir(store_dir):
+        return
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if len(name) == 64 and not store.in_use(path):
+            log.debug('Removing unreferenced object %s' % name)
+            store.remove(path)
+
+
+def _remove_stale(cache_root, max_age):
+    '''Removes old temporary downloads and lock files nobody holds.'''
+    deadline = time.time() - max_age
+    for directory, subdirs, files in os.walk(cache_root):
+        for name in files:
+            path = os.path.join(directory, name)
+            is_tmp = directory.startswith(
+                os.path.join(cache_root, settings.cache_tmp_dir))
+            if not (is_tmp or name.endswith('.lock')):
+                continue
+            try:
+                if os.path.getmtime(path) > deadline:
+                    continue
+                with open(path, 'a') as f:
+                    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    log.debug('Removing stale %s' % path)
+                    os.unlink(path)
+            except (IOError, OSError):
+                continue
+
+
+def collect(quota, cache_root=None):
+    '''
+    Evicts least recently used builds until cache_root fits in quota.
+
+    Returns the number of bytes freed.
+    '''
+    cache_root = cache_root or root()
+    before = usage(cache_root)
+    _remove_stale(cache_root, settings.cache_stale_age)
+    _remove_orphans(cache_root)
+    used = usage(cache_root)
+    builds = sorted(_builds(cache_root), key=_last_used)
+    while quota is not None and used > quota and builds:
+        build = builds.pop(0)
+        if not _evict(build):
+            log.debug('Keeping %s, it is in use' % build)
+            continue
+        _remove_orphans(cache_root)
+        used = usage(cache_root)
+    if quota is not None and used > quota:
+        log.warning('Download cache uses %d bytes, over the %d bytes quota '
+                    'with nothing left to evict' % (used, quota))
+    log.info('Download cache uses %d bytes, %d freed' %
+             (used, before - used))
+    return before - used
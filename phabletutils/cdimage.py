@@ -15,47 +15,36 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import re
-import requests
 import os.path
+import requests
 import subprocess
+import sys
+import time
 import urlparse
 
+from phabletutils import downloads
 from phabletutils import hashes
+from phabletutils import listing
+from phabletutils import network
 from phabletutils import resources
 from phabletutils import settings
+from phabletutils import trace
+from phabletutils import workers
 
 log = logging.getLogger()
 
 
 def _get_elements(uri):
-    '''Scraps cdimage and returns a list of relevant links as elements.'''
-    request = requests.get(uri).content
-    html_elements = filter(
-        lambda x: '<li><a href=' in x and
-        'Parent Directory' not in x and
-        'daily' not in x and
-        'current' not in x,
-        request.split('\n'))
-    # cdimage lays out the content in more than one way.
-    if not html_elements:
-        html_elements = filter(
-            lambda x: 'alt="[DIR]"' in x and
-            'Parent Directory' not in x and
-            'daily' not in x and
-            'pending' not in x and
-            'current' not in x,
-            request.split('\n'))
-        html_elements = [re.search(r'<a.* href.*>.*</a>', x).group(0)
-                         for x in html_elements]
-    elements_inter = [re.sub('<[^>]*>', '', i) for i in html_elements]
-    elements = [i.strip().strip('/') for i in elements_inter]
-    return elements
+    '''Returns the names of the relevant directories listed at uri.'''
+    return [entry.name for entry in listing.get_entries(uri)
+            if entry.directory and
+            not any(skip in entry.name
+                    for skip in ('daily', 'current', 'pending'))]
 
 
 def _get_releases(uri):
     '''Fetches the available releases for a given cdimage project URI.'''
-    releases = [{'release': i, 'uri': '%s/%s' % (uri, i)}
+    releases = [{'release': i, 'uri': '%s/%s' % (uri.rstrip('/'), i)}
                 for i in _get_elements(uri)]
     log.debug('releases: %s', releases)
     return releases
@@ -66,39 +55,61 @@ def _get_revisions(uri):
     return _get_elements(uri)
 
 
-def get_available_revisions(cdimage_uri):
-    '''Returns all the releases available for a given cdimage project.'''
+def iter_available_revisions(cdimage_uri,
+                             concurrency=settings.crawl_concurrency):
+    '''
+    Yields the releases of a cdimage project with their revisions.
+
+    The release listings are fetched concurrently and every release is
+    yielded, in order, as soon as its listing is in.
+    '''
     if cdimage_uri[-1] != '/':
         cdimage_uri = cdimage_uri + '/'
     releases = _get_releases(cdimage_uri)
-    for release in releases:
+
+    def crawl(release):
         release['revisions'] = _get_revisions(release['uri'])
-    return releases
+        return release
+    return workers.imap(crawl, releases, concurrency)
+
+
+def get_available_revisions(cdimage_uri):
+    '''Returns all the releases available for a given cdimage project.'''
+    return list(iter_available_revisions(cdimage_uri))
 
 
 def get_latest_revision(cdimage_uri):
     '''Returns the latest revision tagged.'''
     log.debug('cdimage_uri: %s', cdimage_uri)
+    releases = _get_releases(cdimage_uri)
+    # Newest first, the crawl stops with the first release that has
+    # revisions while the ones before it are still being fetched.
+    crawl = workers.imap(lambda r: (r, _get_revisions(r['uri'])),
+                         reversed(releases), settings.crawl_concurrency)
     try:
-        latest_release = _get_releases(cdimage_uri)[-1]
-        log.debug('latest_release: %s', latest_release)
-        latest_revision = _get_revisions(latest_release['uri'])[-1]
-    except IndexError:
-        raise EnvironmentError('No releases for current project. Verify '
-                               'by checking %s' % cdimage_uri)
-    return latest_release['release'], latest_revision
+        for release, revisions in crawl:
+            log.debug('release: %s revisions: %s', release, revisions)
+            if revisions:
+                return release['release'], revisions[-1]
+    finally:
+        crawl.close()
+    raise EnvironmentError('No releases for current project. Verify '
+                           'by checking %s' % cdimage_uri)
 
 
 def display_revisions(revisions):
     '''Displays the available revisions for a give cdimage project.'''
+    shown = False
     for series in revisions:
+        shown = True
         print 'Available releases:'
         if 'revisions' in series:
             for rev in series['revisions']:
                 print '\t%s/%s' % (series['release'], rev)
         else:
-            print 'No releases for %s available' % rev['release']
-    if not revisions:
+            print 'No releases for %s available' % series['release']
+        sys.stdout.flush()
+    if not shown:
         print 'No revisions have been tagged for this project yet'
 
 
@@ -110,13 +121,71 @@ def _get_link_target(uri):
     return link
 
 
+def _sums_validators(build_uri):
+    response = network.head('%s/SHA256SUMS' % build_uri)
+    if response.status_code != 200:
+        return None
+    return [response.headers.get(h) for h in
+            ('etag', 'last-modified', 'content-length')]
+
+
+def _resolve_pointer(uri):
+    '''
+    Returns the build a pointer like current links to, or None.
+
+    Apache lists a symlink with the modification time of its target, so
+    the builds listed with the same time are candidates. The one whose
+    SHA256SUMS has the same validators as the pointer's is the target.
+    '''
+    parent, pointer = uri.rstrip('/').rsplit('/', 1)
+    entries = listing.get_entries('%s/' % parent,
+                                  ttl=settings.build_pointer_ttl)
+    target = [e for e in entries if e.name == pointer and e.mtime]
+    if not target:
+        return None
+    pointer_validators = _sums_validators(uri)
+    if not pointer_validators:
+        return None
+    for entry in entries:
+        if entry.directory and entry.mtime == target[0].mtime and \
+                entry.name not in ('current', 'pending') and \
+                _sums_validators('%s/%s' % (parent, entry.name)) == \
+                pointer_validators:
+            return entry.name
+    return None
+
+
+@trace.traced('environment')
 def get_build(cdimage_uri, pending=False):
     '''Returns the latest build in current.'''
     if pending:
         uri = '%s/%s' % (cdimage_uri, 'pending')
     else:
         uri = '%s/%s' % (cdimage_uri, 'current')
-    build = _get_link_target(uri)
+    cache_path = os.path.join(downloads.metadata_dir(), 'pointers.json')
+    cached = downloads.load_json(cache_path).get(uri)
+    if cached and time.time() - cached['fetched'] < \
+            settings.build_pointer_ttl:
+        return cached['build']
+    try:
+        build = _resolve_pointer(uri)
+    except (EnvironmentError, requests.RequestException) as e:
+        log.debug('Resolving %s over HTTP failed: %s' % (uri, e))
+        build = None
+    if not build:
+        if not settings.build_pointer_rsync:
+            raise EnvironmentError('Cannot find the build %s points to' %
+                                   uri)
+        log.warning('Cannot find the build %s points to over HTTP, '
+                    'asking rsync' % uri)
+        build = _get_link_target(uri)
+
+    def update(pointers):
+        pointers[uri] = {'build': build, 'fetched': time.time()}
+    try:
+        downloads.update_json(cache_path, update)
+    except (IOError, OSError) as e:
+        log.debug('Cannot cache %s: %s' % (uri, e))
     return build
 
 
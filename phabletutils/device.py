@@ -16,20 +16,33 @@
 
 import subprocess
 import logging
+import os.path
+import re
 
-from time import sleep
+from phabletutils import adbclient
+from phabletutils import states
+from phabletutils import trace
 
 log = logging.getLogger()
 
 
 def call(args):
-    subprocess.check_call(args, shell=True)
+    with trace.span(args, 'device') as span:
+        span['exit_code'] = subprocess.call(args, shell=True)
+    if span['exit_code']:
+        raise subprocess.CalledProcessError(span['exit_code'], args)
 
 
 def check_output(args):
     return subprocess.check_output(args, shell=True)
 
 
+def attached_devices():
+    '''Returns the serials of the devices adb sees online.'''
+    return [serial for serial, state in adbclient.Client().devices()
+            if state == 'device']
+
+
 class Device(object):
     '''Android device.'''
 
@@ -48,87 +61,137 @@ class Device(object):
 
 
 class AndroidBridge(Device):
-    '''Interface to adb.'''
+    '''Interface to adb, spoken through the adb server.'''
 
     def __init__(self, device=None):
         '''Initializes an adb interface attached to a given device.'''
         super(AndroidBridge, self).__init__(device=device, cmd='adb')
+        self._client = adbclient.Client(device)
+        self._model = None
 
     def start(self):
         '''Attempts to start adb if not running.'''
-        log.debug('Starting adb server')
-        cmd = 'start-server'
-        call(self._cmd % cmd)
-
-    def push(self, src, dst):
+        try:
+            self._client.version()
+        except EnvironmentError:
+            log.debug('Starting adb server')
+            cmd = 'start-server'
+            call(self._cmd % cmd)
+
+    def push(self, src, dst, incremental=False):
         '''Performs and adb push.'''
         log.info('Pushing %s to %s' % (src, dst))
-        cmd = 'push %s %s' % (src, dst)
-        call(self._cmd % cmd)
+        with trace.span('push %s' % os.path.basename(src), 'device',
+                        dst=dst) as span:
+            span['bytes'] = self._client.push(src, dst, incremental)
+
+    def push_stream(self, chunks, dst):
+        '''Writes the data yielded by chunks to dst on the device.'''
+        with trace.span('stream %s' % os.path.basename(dst), 'device',
+                        dst=dst) as span:
+            span['bytes'] = self._client.push_stream(chunks, dst)
+        return span['bytes']
 
     def pull(self, src, dst):
         '''Performs and adb pull.'''
         log.info('Pulling %s to %s' % (src, dst))
-        cmd = 'pull %s %s' % (src, dst)
-        call(self._cmd % cmd)
-
-    def wait_for_device(self, wait=2):
+        with trace.span('pull %s' % os.path.basename(src), 'device') as span:
+            span['bytes'] = self._client.pull(src, dst)
+
+    def model(self):
+        '''Returns the device model or None if it cannot be told.'''
+        if self._model is None:
+            try:
+                model = self.getprop('ro.product.device').strip()
+            except EnvironmentError:
+                model = ''
+            self._model = model if re.match(r'^[\w.-]+$', model) else ''
+        return self._model or None
+
+    def wait_for(self, state, leave=None, timeout=None, source=None):
+        '''
+        Waits for the device to be in state, e.g. recovery or fastboot.
+
+        The time taken is recorded for the model as source->state.
+        '''
+        return states.wait(self._device, [state], timeout=timeout,
+                           leave=leave, model=self.model(),
+                           transition='%s->%s' % (source, state))
+
+    def wait_for_device(self, timeout=None):
         '''Waits for device.'''
-        # Hack wait to avoid LP:1176929
         log.info('Restarting device... wait')
-        sleep(wait)
-        call(self._cmd % 'wait-for-device')
+        states.wait(self._device, ['device'], timeout=timeout)
         log.info('Restarting device... wait complete')
 
     def root(self):
         '''Set device to work as root.'''
-        call(self._cmd % 'root')
-        self.wait_for_device()
+        if 'already' in self._client.root():
+            return
+        # adbd restarts, it is listed until the old one goes away.
+        self.model()
+        self.wait_for('device', leave='device', source='root')
 
     def chmod(self, filename, mode):
         '''Performs a chmod on target device.'''
-        cmd = 'shell chmod %s %s' % (mode, filename)
-        call(self._cmd % cmd)
+        self.shell(['chmod', mode, filename])
 
     def chown(self, user, path):
         '''Performs a chmod on target device.'''
-        cmd = 'shell chown -R %s %s' % (user, path)
-        call(self._cmd % cmd)
+        self.shell(['chown', '-R', user, path])
 
     def getprop(self, android_property):
         '''Returns an android property.'''
-        cmd = 'shell getprop %s ' % (android_property)
-        return check_output(self._cmd % cmd)
+        return self.shell(['getprop', android_property])
 
     def tcp_forward(self, src, dst):
         '''Creates a tcp forwarding rule.'''
-        cmd = 'forward tcp:%s tcp:%s' % (src, dst)
-        call(self._cmd % cmd)
+        self._client.forward('tcp:%s' % src, 'tcp:%s' % dst)
 
     def shell(self, command):
-        '''Runs shell command and returns output'''
-        cmd = 'shell %s' % command
-        return check_output(self._cmd % cmd)
+        '''
+        Runs shell command and returns output.
+
+        command is passed to the device shell as is, or quoted argument by
+        argument when given as a list.
+        '''
+        with trace.span('shell', 'device', command=command):
+            return self._client.shell(command)
+
+    def batch(self):
+        '''
+        Returns a Batch queueing shell commands and pushes.
+
+        The queue runs when the with block using it ends or on run(),
+        with far fewer round trips than one call per operation.
+        '''
+        return adbclient.Batch(self._client)
 
     def chroot(self, command, root='data/ubuntu'):
         '''Runs command in chroot.'''
         log.debug('Running in chroot: %s' % command)
-        cmd = 'shell "PATH=/usr/sbin:/usr/bin:/sbin:/bin ' \
-              'system/xbin/chroot %s %s"' % (root, command)
-        call(self._cmd % cmd)
+        self.shell('PATH=/usr/sbin:/usr/bin:/sbin:/bin '
+                   'system/xbin/chroot %s %s' % (root, command))
 
     def reboot(self, recovery=False, bootloader=False):
-        '''Reboots device.'''
+        '''
+        Reboots device.
+
+        Rebooting into recovery or the bootloader returns once the device
+        is there.
+        '''
+        if not recovery and not bootloader:
+            log.info('Restarting device')
+            self._client.reboot()
+            return
         log.info('Restarting device... wait')
-        if recovery:
-            cmd = 'reboot recovery'
-        elif bootloader:
-            cmd = 'reboot bootloader'
-        else:
-            cmd = 'reboot'
-        call(self._cmd % cmd)
-        if recovery:
-            sleep(20)
+        self.model()
+        source = states.state(self._device)
+        target = 'recovery' if recovery else 'fastboot'
+        with trace.span('reboot to %s' % target, 'device', source=source):
+            self._client.reboot('recovery' if recovery else 'bootloader')
+            self.wait_for(target, leave=source if source == target else None,
+                          source=source)
         log.info('Restarting device... wait complete')
 
 
@@ -16,23 +16,46 @@
 
 import configobj
 import contextlib
+import errno
 import fcntl
 import hashlib
+import json
 import logging
 import os
 import requests
-import subprocess
+import tempfile
+import threading
+import time
 
+from phabletutils import network
+from phabletutils import settings
+from phabletutils import trace
+from phabletutils import workers
 from xdg.BaseDirectory import xdg_config_home
 
 
 log = logging.getLogger()
 
 
+# fcntl locks belong to the process, threads are kept apart by these.
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+# The download directory, looked up on first use by tool_dir.
+_download_dir = None
+_created_dirs = set()
+
+
+def _thread_lock(lockfile):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(os.path.realpath(lockfile),
+                                        threading.Lock())
+
+
 @contextlib.contextmanager
 def flocked(lockfile):
+    '''Holds the lock for lockfile against other threads and processes.'''
     lockfile += '.lock'
-    with open(lockfile, 'w') as f:
+    with _thread_lock(lockfile), open(lockfile, 'w') as f:
         log.debug('Aquiring lock for %s', lockfile)
         try:
             fcntl.lockf(f, fcntl.LOCK_EX)
@@ -42,6 +65,33 @@ def flocked(lockfile):
             fcntl.lockf(f, fcntl.LOCK_UN)
 
 
+def load_json(path):
+    '''Returns the dictionary stored in path, empty if it is unusable.'''
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def update_json(path, update):
+    '''
+    Calls update on the dictionary stored in path and writes it back.
+
+    The lock for path is held throughout and the new content is renamed
+    into place, so concurrent readers never see a partial file.
+    '''
+    with flocked(path):
+        data = load_json(path)
+        update(data)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix=os.path.basename(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+    return data
+
+
 def setup_download_directory(download_dir):
     '''
     Tries to create the download directory from XDG_DOWNLOAD_DIR or sets
@@ -61,14 +111,19 @@ def setup_download_directory(download_dir):
                 raise e
 
 
-def get_full_path(subdir):
+def _xdg_download_dir():
+    '''Returns XDG_DOWNLOAD_DIR or None if it could not be read.'''
     try:
         userdirs_file = os.path.join(xdg_config_home, 'user-dirs.dirs')
         userdirs_config = configobj.ConfigObj(userdirs_file, encoding='utf-8')
-        userdirs_download = os.path.expandvars(
-            userdirs_config['XDG_DOWNLOAD_DIR'])
-        download_dir = userdirs_download
+        return os.path.expandvars(userdirs_config['XDG_DOWNLOAD_DIR'])
     except KeyError:
+        return None
+
+
+def get_full_path(subdir):
+    download_dir = _xdg_download_dir()
+    if download_dir is None:
         download_dir = os.path.expandvars('$HOME')
         log.warning('XDG_DOWNLOAD_DIR could not be read')
     directory = os.path.join(download_dir, subdir)
@@ -76,17 +131,50 @@ def get_full_path(subdir):
     return directory
 
 
-def checksum_verify(file_path, file_hash, sum_method=hashlib.sha256):
-    '''Returns the checksum for a file with a specified algorightm.'''
-    file_sum = sum_method()
-    log.debug('Verifying file: %s against: %s' % (file_path, file_hash))
+def tool_dir(*parts):
+    '''
+    Returns the directory parts within the phablet-flash download
+    directory, creating it when missing.
+
+    Unlike get_full_path the download directory is looked up once and
+    nothing is logged, as this is called for every object and cache file.
+    '''
+    global _download_dir
+    if _download_dir is None:
+        _download_dir = _xdg_download_dir() or os.path.expandvars('$HOME')
+    directory = os.path.join(_download_dir, settings.download_dir, *parts)
+    if directory not in _created_dirs:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        _created_dirs.add(directory)
+    return directory
+
+
+def hash_file(file_path, sum_method=hashlib.sha256):
+    '''Returns the hash object for the file contents or None if missing.'''
     if not os.path.exists(file_path):
         log.debug('File %s not found' % file_path)
-        return False
-    with open(file_path, 'rb') as f:
+        return None
+    file_sum = sum_method()
+    with trace.span('hash %s' % os.path.basename(file_path), 'verification',
+                    algorithm=file_sum.name, bytes=0) as span, \
+            open(file_path, 'rb') as f:
         for file_chunk in iter(
-                lambda: f.read(file_sum.block_size * 128), b''):
+                lambda: f.read(settings.hash_buffer_size), b''):
             file_sum.update(file_chunk)
+            span['bytes'] += len(file_chunk)
+    return file_sum
+
+
+def checksum_verify(file_path, file_hash, sum_method=hashlib.sha256):
+    '''Returns the checksum for a file with a specified algorightm.'''
+    log.debug('Verifying file: %s against: %s' % (file_path, file_hash))
+    file_sum = hash_file(file_path, sum_method)
+    if not file_sum:
+        return False
     if file_hash == file_sum.hexdigest():
         return True
     else:
@@ -95,42 +183,670 @@ def checksum_verify(file_path, file_hash, sum_method=hashlib.sha256):
     return False
 
 
-def _download(uri, path):
-    if uri.startswith('http://cdimage.ubuntu.com') or \
-       uri.startswith('https://system-image.ubuntu.com'):
-        subprocess.check_call(['wget',
-                               '-c',
-                               uri,
-                               '-O',
-                               path])
+class _RangeNotSupported(Exception):
+    '''Raised when a server answers a Range request with the full body.'''
+
+
+class _Throttle(object):
+    '''Token bucket shared by every download to cap total bandwidth.'''
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._rate = rate
+            self._allowance = rate or 0
+            self._last = time.time()
+
+    def consume(self, size):
+        with self._lock:
+            if not self._rate:
+                return
+            now = time.time()
+            self._allowance = min(
+                self._rate,
+                self._allowance + (now - self._last) * self._rate)
+            self._last = now
+            self._allowance -= size
+            wait = -float(self._allowance) / self._rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+_throttle = _Throttle(settings.download_rate_limit)
+
+
+def set_rate_limit(rate):
+    '''Caps the combined bandwidth of all downloads to rate bytes/s.'''
+    if rate:
+        log.info('Limiting download bandwidth to %d bytes/s' % rate)
+    _throttle.set_rate(rate)
+
+
+_peers = list(settings.cache_peers)
+_metadata_ttl = settings.metadata_ttl
+
+
+def set_peers(peers):
+    '''Sets the ordered list of cache peers tried before upstream.'''
+    if peers:
+        log.info('Using cache peers %s' % ', '.join(peers))
+    _peers[:] = peers or []
+
+
+def _cancelled(uri):
+    return EnvironmentError('Download of %s cancelled' % uri)
+
+
+class _Progress(object):
+    '''Logs the progress of a download at a fixed interval.'''
+
+    def __init__(self, path, total, done=0):
+        self._name = os.path.basename(path)
+        self._total = total
+        self._done = done
+        self._last = time.time()
+        self._lock = threading.Lock()
+        self._span = trace.current()
+
+    def update(self, size):
+        with self._lock:
+            self._done += size
+            self._span['bytes'] = self._span.get('bytes', 0) + size
+            now = time.time()
+            if now - self._last < settings.download_progress_interval:
+                return
+            self._last = now
+        if self._total:
+            log.info('%s: %d%% (%d/%d bytes)' %
+                     (self._name, self._done * 100 / self._total,
+                      self._done, self._total))
+        else:
+            log.info('%s: %d bytes' % (self._name, self._done))
+
+
+def iter_content(uri, cancel=None):
+    '''
+    Yields the content at uri in chunks without keeping it on disk.
+
+    Chunks count against the bandwidth cap like any download.
+    '''
+    response = network.get(uri, stream=True)
+    try:
+        if response.status_code != 200:
+            raise EnvironmentError('%s cannot be retrieved (HTTP %d)' %
+                                   (uri, response.status_code))
+        progress = _Progress(uri, int(response.headers.get(
+            'Content-Length') or 0))
+        for chunk in response.iter_content(settings.download_chunk_size):
+            if cancel and cancel.is_set():
+                raise _cancelled(uri)
+            _throttle.consume(len(chunk))
+            progress.update(len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+
+class _StreamHash(object):
+    '''
+    Hashes a file in order while it is being written.
+
+    Data written at the hashed position is fed from memory, anything
+    written ahead of it is read back from disk by catch_up once the
+    bytes before it are complete. prefix is an optional (size, mtime,
+    hash object) tuple for a partial file that was hashed already. It is
+    ignored for an interrupted segmented download, whose file is full
+    size with holes.
+    '''
+
+    def __init__(self, path, sum_method, prefix=None):
+        self._path = path
+        self._sum_method = sum_method
+        self._lock = threading.Lock()
+        self.reset()
+        if prefix and os.path.exists(path) and \
+                not os.path.exists(path + '.segments'):
+            stat = os.stat(path)
+            size, mtime, prefix_sum = prefix
+            if (stat.st_size, stat.st_mtime) == (size, mtime):
+                log.debug('Reusing hash of the first %d bytes of %s' %
+                          (size, path))
+                self.position = size
+                self._sum = prefix_sum.copy()
+
+    @property
+    def name(self):
+        return self._sum.name.lower()
+
+    def reset(self):
+        self.position = 0
+        self._sum = self._sum_method()
+
+    def feed(self, offset, data):
+        with self._lock:
+            if offset == self.position:
+                self._sum.update(data)
+                self.position += len(data)
+
+    def catch_up(self, end):
+        '''Hashes the bytes up to end that were written out of order.'''
+        with self._lock:
+            if self.position > end:
+                self.reset()
+            if self.position == end:
+                return
+            with open(self._path, 'rb') as f:
+                f.seek(self.position)
+                while self.position < end:
+                    chunk = f.read(min(settings.download_chunk_size,
+                                       end - self.position))
+                    if not chunk:
+                        break
+                    self._sum.update(chunk)
+                    self.position += len(chunk)
+
+    def hexdigest(self):
+        return self._sum.hexdigest()
+
+
+class _Segment(object):
+    '''A byte range [start, end) of a file and how much of it is on disk.'''
+
+    def __init__(self, start, end, position=None):
+        self.start = start
+        self.end = end
+        self.position = start if position is None else position
+
+    @property
+    def done(self):
+        return self.position >= self.end
+
+    def to_list(self):
+        return [self.start, self.end, self.position]
+
+
+def _plan_segments(offset, size, count):
+    '''Splits the bytes from offset to size into at most count segments.'''
+    remaining = size - offset
+    count = max(1, min(count,
+                       remaining / settings.download_segment_min_size))
+    step = remaining / count
+    segments = []
+    for i in range(count):
+        start = offset + i * step
+        end = size if i == count - 1 else start + step
+        segments.append(_Segment(start, end))
+    return segments
+
+
+def _retry_wait(attempt, uri, error, event=None, retries=None):
+    '''Sleeps with exponential backoff or raises once retries run out.'''
+    if retries is None:
+        retries = settings.download_retries
+    if attempt > retries:
+        raise EnvironmentError('Download of %s failed after %d attempts: %s' %
+                               (uri, attempt, error))
+    wait = min(2 ** attempt, 30)
+    log.debug('Retrying %s in %ds after: %s' % (uri, wait, error))
+    if event:
+        event.wait(wait)
     else:
-        subprocess.check_call(['curl',
-                               '-L',
-                               '-C',
-                               '-',
-                               uri,
-                               '-o',
-                               path])
+        time.sleep(wait)
 
 
-def download_sig(artifact):
-    '''Downloads an artifact into target.'''
-    log.info('Downloading %s to %s' % (artifact.uri, artifact.path))
-    with flocked(artifact._sig_path):
-        _download(artifact.sig_uri, artifact.sig_path)
+class _SegmentedDownload(object):
+    '''
+    Fetches a file over several parallel HTTP Range requests.
+
+    Progress is kept in a .segments state file next to the target so an
+    interrupted download resumes each segment from where it stopped.
+    '''
+
+    def __init__(self, uri, path, size, cancel=None, stream_hash=None,
+                 retries=None):
+        self._uri = uri
+        self._cancel = cancel
+        self._retries = retries
+        self._hash = stream_hash
+        self._path = path
+        self._size = size
+        self._state_path = path + '.segments'
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._errors = []
+        self._segments = self._load_state()
+        if self._segments is None:
+            self._segments = self._new_state()
+        done = sum(s.position - s.start for s in self._segments)
+        self._progress = _Progress(path, size, size - sum(
+            s.end - s.start for s in self._segments) + done)
+
+    def _load_state(self):
+        if not os.path.exists(self._state_path) or \
+           not os.path.exists(self._path):
+            return None
+        try:
+            with open(self._state_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if state.get('size') != self._size or \
+           os.path.getsize(self._path) != self._size:
+            log.debug('Discarding stale segment state for %s' % self._path)
+            return None
+        log.info('Resuming segmented download of %s' % self._path)
+        return [_Segment(*s) for s in state['segments']]
+
+    def _new_state(self):
+        # A partial file without state was written sequentially, so it
+        # is a valid prefix that does not need to be fetched again.
+        offset = 0
+        if os.path.exists(self._path):
+            offset = os.path.getsize(self._path)
+            if offset > self._size:
+                offset = 0
+        segments = _plan_segments(offset, self._size,
+                                  settings.download_segments)
+        self._segments = segments
+        self._save_state()
+        with open(self._path, 'ab') as f:
+            f.truncate(offset)
+            f.truncate(self._size)
+        if self._hash and self._hash.position != offset:
+            self._hash.reset()
+        return segments
+
+    def _save_state(self):
+        with self._lock:
+            state = {'size': self._size,
+                     'segments': [s.to_list() for s in self._segments]}
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self._state_path + '.tmp', self._state_path)
+
+    def _fetch(self, segment):
+        headers = {'Range': 'bytes=%d-%d' % (segment.position,
+                                             segment.end - 1),
+                   'Accept-Encoding': 'identity'}
+        response = network.get(self._uri, retry=False, headers=headers,
+                               stream=True, timeout=settings.download_timeout)
+        try:
+            if response.status_code == 200:
+                raise _RangeNotSupported(self._uri)
+            response.raise_for_status()
+            with open(self._path, 'r+b') as f:
+                f.seek(segment.position)
+                for chunk in response.iter_content(
+                        settings.download_chunk_size):
+                    if self._aborted():
+                        return
+                    chunk = chunk[:segment.end - segment.position]
+                    f.write(chunk)
+                    f.flush()
+                    offset = segment.position
+                    with self._lock:
+                        segment.position += len(chunk)
+                    if self._hash:
+                        self._hash.feed(offset, chunk)
+                    self._progress.update(len(chunk))
+                    _throttle.consume(len(chunk))
+                    if segment.done:
+                        break
+        finally:
+            response.close()
+        if not segment.done:
+            raise IOError('Short read at byte %d' % segment.position)
+
+    def _contiguous(self):
+        '''Returns how many leading bytes of the file are on disk.'''
+        with self._lock:
+            for segment in self._segments:
+                if not segment.done:
+                    return segment.position
+        return self._size
+
+    def _aborted(self):
+        return self._abort.is_set() or \
+            (self._cancel is not None and self._cancel.is_set())
+
+    def _worker(self, segment):
+        attempt = 0
+        while not segment.done and not self._aborted():
+            position = segment.position
+            try:
+                self._fetch(segment)
+                if segment.done and self._hash:
+                    self._hash.catch_up(self._contiguous())
+            except (requests.RequestException, IOError) as e:
+                attempt = 1 if segment.position > position else attempt + 1
+                try:
+                    _retry_wait(attempt, self._uri, e, self._abort,
+                                self._retries)
+                except EnvironmentError as e:
+                    self._fail(e)
+            except Exception as e:
+                self._fail(e)
+
+    def _fail(self, error):
+        self._errors.append(error)
+        self._abort.set()
+
+    def run(self):
+        threads = []
+        for segment in self._segments:
+            if segment.done:
+                continue
+            thread = threading.Thread(target=self._worker, args=(segment,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        log.debug('Fetching %s in %d segments' % (self._uri, len(threads)))
+        last_save = [time.time()]
+
+        def save():
+            if time.time() - last_save[0] > 1:
+                self._save_state()
+                last_save[0] = time.time()
+        try:
+            workers.join(threads, save)
+        except KeyboardInterrupt:
+            self._abort.set()
+            raise
+        finally:
+            self._save_state()
+        if self._errors:
+            raise self._errors[0]
+        if not all(s.done for s in self._segments):
+            raise _cancelled(self._uri)
+        if self._hash:
+            self._hash.catch_up(self._size)
+        os.unlink(self._state_path)
+
+
+def _probe(uri):
+    '''Returns the final uri, size and Range support for a download.'''
+    try:
+        response = network.head(uri, allow_redirects=True,
+                                headers={'Accept-Encoding': 'identity'},
+                                timeout=settings.download_timeout)
+    except requests.RequestException as e:
+        log.debug('Probing %s failed: %s' % (uri, e))
+        return uri, None, False
+    if response.status_code != 200:
+        return uri, None, False
+    size = response.headers.get('content-length')
+    ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return response.url, int(size) if size else None, ranges
+
+
+def _download_stream(uri, path, ranges=False, size=None, cancel=None,
+                     stream_hash=None, retries=None):
+    '''Fetches uri into path on one connection, resuming when possible.'''
+    attempt = 0
+    while True:
+        offset = 0
+        if ranges and os.path.exists(path):
+            offset = os.path.getsize(path)
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        try:
+            response = network.get(uri, retry=False, headers=headers,
+                                   stream=True,
+                                   timeout=settings.download_timeout)
+            try:
+                if offset and response.status_code == 416:
+                    log.debug('%s already complete' % path)
+                    if stream_hash:
+                        stream_hash.catch_up(offset)
+                    return
+                response.raise_for_status()
+                if response.status_code != 206:
+                    offset = 0
+                if stream_hash:
+                    stream_hash.catch_up(offset)
+                length = response.headers.get('content-length')
+                expected = offset + int(length) if length else size
+                progress = _Progress(path, expected, offset)
+                with open(path, 'ab' if offset else 'wb') as f:
+                    for chunk in response.iter_content(
+                            settings.download_chunk_size):
+                        if cancel is not None and cancel.is_set():
+                            raise _cancelled(uri)
+                        f.write(chunk)
+                        if stream_hash:
+                            stream_hash.feed(offset, chunk)
+                        offset += len(chunk)
+                        progress.update(len(chunk))
+                        _throttle.consume(len(chunk))
+            finally:
+                response.close()
+            if expected and os.path.getsize(path) != expected:
+                raise IOError('Short read, got %d of %d bytes' %
+                              (os.path.getsize(path), expected))
+            return
+        except (requests.RequestException, IOError) as e:
+            attempt += 1
+            _retry_wait(attempt, uri, e, retries=retries)
+
+
+def _download_from(uri, path, cancel=None, stream_hash=None, peer=False):
+    '''Fetches uri into path, in parallel Range segments when possible.'''
+    with trace.span('fetch', 'downloads', uri=uri, peer=peer):
+        _fetch_from(uri, path, cancel, stream_hash, peer)
+
+
+def _fetch_from(uri, path, cancel, stream_hash, peer):
+    final_uri, size, ranges = _probe(uri)
+    retries = None
+    if peer:
+        if size is None:
+            raise EnvironmentError('%s is not available' % uri)
+        retries = settings.peer_retries
+    if ranges and size and settings.download_segments > 1 and \
+       size >= 2 * settings.download_segment_min_size:
+        try:
+            _SegmentedDownload(final_uri, path, size, cancel,
+                               stream_hash, retries).run()
+            return
+        except _RangeNotSupported:
+            log.warning('%s ignores Range requests, falling back to a single '
+                        'stream' % uri)
+            ranges = False
+    if os.path.exists(path + '.segments'):
+        # Segment state means the file has holes, it is not a prefix.
+        os.unlink(path + '.segments')
+        ranges = False
+    _download_stream(final_uri, path, ranges, size, cancel, stream_hash,
+                     retries)
+
+
+def peer_uri(peer, uri):
+    '''Returns where the cache peer serves the content of uri.'''
+    return '%s/mirror/%s' % (peer.rstrip('/'), uri.replace('://', '/', 1))
+
 
+def _candidates(uri, digest=None):
+    '''Returns the URIs to fetch uri from, cache peers first.'''
+    candidates = []
+    for peer in _peers:
+        if digest:
+            candidates.append('%s/objects/%s' % (peer.rstrip('/'), digest))
+        else:
+            candidates.append(peer_uri(peer, uri))
+    return candidates + [uri]
 
-def download(artifact):
-    '''Downloads an artifact into target.'''
+
+def _detach(path):
+    '''
+    Removes path if it has other names, like an object store entry.
+
+    Downloads write into the file in place, which would change the
+    content behind every other name. A linked file is complete content
+    that is being replaced, so there is nothing to resume from it.
+    Returns True if path was removed.
+    '''
+    try:
+        if os.stat(path).st_nlink > 1:
+            log.debug('Unlinking %s from its other names' % path)
+            os.unlink(path)
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def _download(uri, path, cancel=None, stream_hash=None, digest=None):
+    '''
+    Fetches uri into path, trying the cache peers before uri itself.
+
+    With digest the peers are asked for the object with that sha256.
+    If stream_hash is given it holds the hash of the whole file on return.
+    '''
+    if _detach(path) and stream_hash:
+        # A hash of the linked content is no prefix of the new file.
+        stream_hash.reset()
+    candidates = _candidates(uri, digest)
+    for candidate in candidates[:-1]:
+        try:
+            _download_from(candidate, path, cancel, stream_hash, peer=True)
+            log.debug('Fetched %s from %s' % (uri, candidate))
+            return
+        except (requests.RequestException, EnvironmentError) as e:
+            if cancel is not None and cancel.is_set():
+                raise
+            log.debug('Cache peer failed for %s: %s' % (uri, e))
+    _download_from(uri, path, cancel, stream_hash)
+
+
+def download_sig(artifact, cancel=None):
+    '''Downloads an artifact into target and returns its sha256.'''
+    log.info('Downloading %s to %s' % (artifact.sig_uri, artifact.sig_path))
+    stream_hash = _StreamHash(artifact.sig_path, hashlib.sha256)
+    with trace.span('download %s' % os.path.basename(artifact.sig_path),
+                    'downloads'), flocked(artifact._sig_path):
+        _download(artifact.sig_uri, artifact.sig_path, cancel, stream_hash)
+    return stream_hash.hexdigest()
+
+
+def download(artifact, cancel=None):
+    '''
+    Downloads an artifact into target.
+
+    Artifacts are hashed as they are written and the result recorded on
+    the artifact, so they need no separate verification. Returns the
+    sha256 of the artifact or None if it is verified with another hash.
+    '''
     log.info('Downloading %s to %s' % (artifact.uri, artifact.path))
-    with flocked(artifact._path):
-        _download(artifact.uri, artifact.path)
+    if artifact.hash:
+        stream_hash = _StreamHash(artifact.path, artifact.hash_type,
+                                  artifact.partial_sum)
+    else:
+        stream_hash = _StreamHash(artifact.path, hashlib.sha256)
+    digest = None
+    if artifact.hash and stream_hash.name == 'sha256':
+        digest = artifact.hash
+    with trace.span('download %s' % os.path.basename(artifact.path),
+                    'downloads'), flocked(artifact._path):
+        _download(artifact.uri, artifact.path, cancel, stream_hash, digest)
+    if artifact.hash:
+        artifact.record_digest(stream_hash.hexdigest())
+    return stream_hash.hexdigest() if stream_hash.name == 'sha256' else None
 
 
-def get_content(uri):
-    '''Fetches the SHA256 sum file from cdimage.'''
-    content_request = requests.get(uri)
+def metadata_dir():
+    '''Returns the directory of the metadata cache.'''
+    return tool_dir(settings.metadata_cache_dir)
+
+
+def set_metadata_ttl(ttl):
+    '''Sets for how many seconds cached metadata is used as is.'''
+    global _metadata_ttl
+    _metadata_ttl = ttl
+
+
+def metadata_ttl():
+    '''Returns for how many seconds cached metadata is used as is.'''
+    return _metadata_ttl
+
+
+def _metadata_path(uri):
+    return os.path.join(metadata_dir(),
+                        '%s.json' % hashlib.sha1(uri).hexdigest())
+
+
+def _store_metadata(path, entry):
+    def update(cached):
+        cached.clear()
+        cached.update(entry)
+    try:
+        update_json(path, update)
+    except (IOError, OSError) as e:
+        log.debug('Cannot cache %s: %s' % (entry['uri'], e))
+
+
+def _from_peers(uri):
+    for peer in _peers:
+        try:
+            content_request = network.get(peer_uri(peer, uri), retry=False,
+                                          timeout=settings.peer_timeout)
+            if content_request.status_code == 200:
+                return content_request.content
+        except requests.RequestException as e:
+            log.debug('Cache peer %s failed for %s: %s' % (peer, uri, e))
+    return None
+
+
+def get_content(uri, peers=True, ttl=None):
+    '''
+    Returns the content behind uri or None if it cannot be found.
+
+    Responses are kept in the metadata cache and returned without asking
+    for ttl seconds, then revalidated with a conditional request.
+    '''
+    ttl = metadata_ttl() if ttl is None else ttl
+    path = _metadata_path(uri)
+    entry = load_json(path)
+    if entry:
+        content = entry['content'].decode('base64')
+        if time.time() - entry['fetched'] < ttl:
+            log.debug('Using cached %s' % uri)
+            return content
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    if peers and not headers:
+        content = _from_peers(uri)
+        if content is not None:
+            _store_metadata(path, {'uri': uri, 'fetched': time.time(),
+                                   'content': content.encode('base64')})
+            return content
+    try:
+        with trace.span('get', 'downloads', uri=uri) as span:
+            content_request = network.get(uri, headers=headers)
+            span['status'] = content_request.status_code
+            span['bytes'] = len(content_request.content)
+    except requests.RequestException as e:
+        if not entry:
+            raise
+        log.warning('Using cached %s, cannot revalidate: %s' % (uri, e))
+        return content
+    if content_request.status_code == 304 and entry:
+        log.debug('Cached %s is still current' % uri)
+        entry['fetched'] = time.time()
+        _store_metadata(path, entry)
+        return content
     if content_request.status_code != 200:
         return None
-    else:
-        return content_request.content
+    _store_metadata(path, {
+        'uri': uri,
+        'fetched': time.time(),
+        'etag': content_request.headers.get('etag'),
+        'last_modified': content_request.headers.get('last-modified'),
+        'content': content_request.content.encode('base64')})
+    return content_request.content
@@ -22,13 +22,16 @@ import os.path
 import requests
 
 from phabletutils.device import AndroidBridge
+from phabletutils import cache
 from phabletutils import cdimage
 from phabletutils import community
 from phabletutils import downloads
 from phabletutils import hashes
 from phabletutils import resources
 from phabletutils import projects
+from phabletutils import serve
 from phabletutils import settings
+from phabletutils import trace
 from phabletutils import ubuntuimage
 
 log = logging.getLogger()
@@ -37,15 +40,15 @@ log = logging.getLogger()
 def get_ubuntu_stamp(uri):
     '''Downloads the jenkins build id from stamp file'''
     try:
-        ubuntu_stamp = requests.get('%s/quantal-ubuntu_stamp' % uri)
-        if ubuntu_stamp.status_code != 200:
-            ubuntu_stamp = requests.get('%s/ubuntu_stamp' % uri)
-        if ubuntu_stamp.status_code != 200:
+        ubuntu_stamp = downloads.get_content('%s/quantal-ubuntu_stamp' % uri)
+        if ubuntu_stamp is None:
+            ubuntu_stamp = downloads.get_content('%s/ubuntu_stamp' % uri)
+        if ubuntu_stamp is None:
             log.error('Latest build detection not supported... bailing')
             exit(1)
         # Make list and get rid of empties
         build_data = filter(lambda x: x.startswith('JENKINS_BUILD='),
-                            ubuntu_stamp.content.split('\n'))
+                            ubuntu_stamp.split('\n'))
         jenkins_build_id = build_data[0].split('=')[1]
     except (requests.HTTPError, requests.Timeout, requests.ConnectionError):
         log.error('Could not download build data from jenkins... bailing')
@@ -55,6 +58,7 @@ def get_ubuntu_stamp(uri):
     return jenkins_build_id
 
 
+@trace.traced('environment')
 def detect_device(serial, device=None):
     '''If no argument passed determine them from the connected device.'''
     # Check CyanogenMod property
@@ -103,8 +107,9 @@ def detect_device(serial, device=None):
 #    return projects.Android(boot=boot_file, system=system_file)
 
 
+@trace.traced('environment')
 def setup_cdimage_files(project_name, uri, download_dir, series,
-                        device, legacy=False):
+                        device, legacy=False, refresh=False):
     downloads.setup_download_directory(download_dir)
     templ_arch_any = settings.files_arch_any[project_name]
     templ_arch_all = settings.files_arch_all[project_name]
@@ -115,14 +120,13 @@ def setup_cdimage_files(project_name, uri, download_dir, series,
         file_names[key] = templ_arch_all[key] % series
     if legacy:
         hash_func = hashlib.md5
-        hash_dict = {}
-        for key in file_names:
-            file_hash = hashes.load_hash(uri, '%s.md5sum' %
-                                         file_names[key], download_dir)
-            hash_dict[file_names[key]] = file_hash[file_names[key]]
+        hash_dict = hashes.load_hashes(
+            uri, ['%s.md5sum' % name for name in file_names.values()],
+            download_dir, refresh)
     else:
         hash_func = hashlib.sha256
-        hash_dict = hashes.load_hash(uri, 'SHA256SUMS', download_dir)
+        hash_dict = hashes.load_hash(uri, 'SHA256SUMS', download_dir,
+                                     refresh)
     files = {}
     for key in file_names:
         if uri:
@@ -152,7 +156,8 @@ def setup_cdimage_touch(args):
         download_dir = downloads.get_full_path(
             os.path.join(settings.download_dir, args.project, build))
     files = setup_cdimage_files(
-        args.project, uri, download_dir, series, device)
+        args.project, uri, download_dir, series, device,
+        refresh=args.refresh_hashes)
     return cdimage_project(files, args)
 
 
@@ -175,7 +180,8 @@ def setup_cdimage_legacy(args):
         download_dir = downloads.get_full_path(
             os.path.join(settings.download_dir, args.project, build))
     files = setup_cdimage_files(
-        args.project, uri, download_dir, series, device, legacy=True)
+        args.project, uri, download_dir, series, device, legacy=True,
+        refresh=args.refresh_hashes)
     return cdimage_project(files, args)
 
 
@@ -197,16 +203,45 @@ def cdimage_project(files, args):
             wipe=args.wipe)
 
 
+@trace.traced('environment')
+def installed_version(serials):
+    '''Returns what system-image all devices run or None.'''
+    versions = set()
+    for serial in serials:
+        versions.add(ubuntuimage.installed_version(AndroidBridge(serial)))
+    if len(versions) != 1:
+        return None
+    return versions.pop()
+
+
 def setup_ubuntu_system(args):
     device = detect_device(args.serial, args.device)
+    catalog = ubuntuimage.get_catalog(device, args.channel)
     if args.revision <= 0:
-        json = ubuntuimage.get_json_from_index(device, args.revision)
+        json = catalog.relative(args.revision)
     else:
-        raise EnvironmentError('Specific version retrieve not supported yet')
+        json = catalog.exact(args.revision)
     download_dir = downloads.get_full_path(os.path.join(
         settings.download_dir, args.project, str(json['version'])))
     uri = settings.system_image_uri
-    files, command_part = ubuntuimage.get_files(download_dir, uri, json)
+    chain = None
+    if not args.full:
+        base = installed_version(getattr(args, 'serials', None) or
+                                 [args.serial])
+        log.debug('Installed %s' % (base,))
+        if base and (base.channel, base.device) != (args.channel, device):
+            log.info('Installing a full image, the device runs %s on '
+                     'channel %s' % (base.device, base.channel))
+        elif base:
+            chain = ubuntuimage.get_delta_chain(catalog, base.version,
+                                                json['version'])
+    if chain:
+        log.info('Upgrading from %s to %s with %d deltas' %
+                 (base.version, json['version'], len(chain)))
+        files, command_part = ubuntuimage.get_delta_files(download_dir, uri,
+                                                          chain)
+    else:
+        files, command_part = ubuntuimage.get_files(download_dir, uri, json)
     recovery = cdimage.get_file(file_key='recovery_img',
                                 series=args.series,
                                 download_dir=download_dir,
@@ -214,7 +249,8 @@ def setup_ubuntu_system(args):
     return projects.UbuntuTouchSystem(
         file_list=files,
         command_part=command_part,
-        recovery=recovery)
+        recovery=recovery,
+        wipe=not chain)
 
 
 def setup_community(args):
@@ -233,5 +269,13 @@ def setup_community(args):
 def list_revisions(args):
     # Easy hack to get rid of the logger and inhibit requests from logging
     log.setLevel(logging.FATAL)
-    revisions = cdimage.get_available_revisions(args.uri)
+    revisions = cdimage.iter_available_revisions(args.uri)
     cdimage.display_revisions(revisions)
+
+
+def collect_cache(args):
+    cache.collect(args.cache_quota)
+
+
+def serve_cache(args):
+    serve.serve(args.bind, args.port)
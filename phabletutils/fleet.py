@@ -0,0 +1,194 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provisions several devices from one phablet-flash run.
+
+Devices are grouped by their detected model, each model's build is
+resolved and downloaded once and then installed on all devices of the
+group concurrently. Every device logs to its own file and the run ends
+with a summary of which devices failed.
+"""
+
+import collections
+import copy
+import logging
+import os.path
+import threading
+import time
+
+from phabletutils.device import (AndroidBridge, Fastboot)
+from phabletutils import cache
+from phabletutils import device
+from phabletutils import downloads
+from phabletutils import environment
+from phabletutils import settings
+from phabletutils import trace
+from phabletutils import workers
+
+log = logging.getLogger()
+
+_local = threading.local()
+
+Result = collections.namedtuple('Result', 'serial model error elapsed')
+
+
+def _serial():
+    return getattr(_local, 'serial', None)
+
+
+class _SerialTagger(logging.Filter):
+    '''Prefixes records logged while working on a device with its serial.'''
+
+    def filter(self, record):
+        serial = _serial()
+        record.serial = serial
+        if serial and not getattr(record, 'tagged', False):
+            record.msg = '[%s] %s' % (serial, record.msg)
+            record.tagged = True
+        return True
+
+
+class _SerialFilter(logging.Filter):
+    '''Passes the records of a single device.'''
+
+    def __init__(self, serial):
+        logging.Filter.__init__(self)
+        self._serial = serial
+
+    def filter(self, record):
+        return getattr(record, 'serial', None) == self._serial
+
+
+def requested(args):
+    '''Returns True when args ask for more than one device.'''
+    return getattr(args, 'all_devices', False) or \
+        len(getattr(args, 'serials', None) or []) > 1
+
+
+def log_dir():
+    return downloads.tool_dir(settings.fleet_log_dir)
+
+
+def _detect(serials, device_name):
+    '''Returns the serials grouped by model and Results for failures.'''
+
+    def detect(serial):
+        _local.serial = serial
+        try:
+            return environment.detect_device(serial, device_name), None
+        except Exception as e:
+            return None, e
+        finally:
+            _local.serial = None
+
+    groups = collections.OrderedDict()
+    failed = []
+    detected = workers.run(detect, serials, len(serials))
+    for serial, (model, error) in zip(serials, detected):
+        if error:
+            failed.append(Result(serial, None, error, 0))
+        else:
+            groups.setdefault(model, []).append(serial)
+    return groups, failed
+
+
+def _install(project, serial, model):
+    '''Installs project on the device with serial, logging to its file.'''
+    _local.serial = serial
+    handler = logging.FileHandler(os.path.join(log_dir(), '%s.log' % serial),
+                                  'w')
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(message)s'))
+    handler.addFilter(_SerialFilter(serial))
+    log.addHandler(handler)
+    start = time.time()
+    try:
+        with trace.span('install %s' % serial, 'projects', model=model):
+            project.install(AndroidBridge(serial), Fastboot(serial))
+        return Result(serial, model, None, time.time() - start)
+    except Exception as e:
+        log.error(e)
+        log.debug('Install failed', exc_info=True)
+        return Result(serial, model, e, time.time() - start)
+    finally:
+        log.removeHandler(handler)
+        handler.close()
+        _local.serial = None
+
+
+def summary(results):
+    '''Logs one line per device and returns the number of failures.'''
+    failed = [r for r in results if r.error]
+    log.info('Provisioned %d of %d devices' %
+             (len(results) - len(failed), len(results)))
+    for result in results:
+        if result.error:
+            log.error('  %s (%s): failed after %ds: %s' %
+                      (result.serial, result.model or 'unknown',
+                       result.elapsed, result.error))
+        else:
+            log.info('  %s (%s): done in %ds' %
+                     (result.serial, result.model, result.elapsed))
+    return len(failed)
+
+
+def run(args):
+    '''
+    Downloads each distinct build once and installs it on every device.
+
+    Returns the number of devices that failed.
+    '''
+    AndroidBridge().start()
+    if args.all_devices:
+        serials = device.attached_devices()
+    else:
+        serials = list(collections.OrderedDict.fromkeys(args.serials))
+    if not serials:
+        raise EnvironmentError('No devices attached')
+    log.info('Provisioning %d devices: %s' % (len(serials),
+                                              ', '.join(serials)))
+    tagger = _SerialTagger()
+    log.addFilter(tagger)
+    try:
+        groups, results = _detect(serials, getattr(args, 'device', None))
+        downloads.set_rate_limit(args.limit_rate)
+        if getattr(args, 'stream', False):
+            log.info('Not streaming, each build is downloaded once for '
+                     'all of its devices')
+        jobs = []
+        for model, group in groups.items():
+            model_args = copy.copy(args)
+            model_args.serial = group[0]
+            model_args.serials = group
+            model_args.device = model
+            log.info('Preparing %s for %s' % (model, ', '.join(group)))
+            try:
+                project = args.func(model_args)
+                cache.use(project.directories)
+                project.download(args.jobs)
+            except Exception as e:
+                log.error('Cannot prepare %s: %s' % (model, e))
+                results.extend(Result(s, model, e, 0) for s in group)
+                continue
+            jobs.extend((project, serial, model) for serial in group)
+        if args.download_only:
+            return summary(results) if results else 0
+        installed = workers.run(lambda job: _install(*job), jobs,
+                                settings.fleet_concurrency or len(jobs))
+        return summary(results + installed)
+    finally:
+        log.removeFilter(tagger)
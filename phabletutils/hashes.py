@@ -18,6 +18,8 @@ import logging
 import os.path
 
 from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import workers
 
 log = logging.getLogger()
 
@@ -38,29 +40,71 @@ def hash2dict(hash_file_content):
     return hash_dict
 
 
-def load_hash(uri, artifact, download_dir=None):
-    if download_dir:
-        hash_path = os.path.join(download_dir, artifact)
-    else:
-        hash_path = None
+def _read_local(download_dir, artifact):
+    hash_path = os.path.join(download_dir, artifact)
+    if not os.path.exists(hash_path):
+        return None
+    with open(hash_path, 'r') as f:
+        return hash2dict(f.read())
+
+
+def _write_local(download_dir, artifact, hashes):
+    hash_path = os.path.join(download_dir, artifact)
+    log.debug('Storing hash to %s' % hash_path)
+    with downloads.flocked(hash_path):
+        with open(hash_path, 'w') as f:
+            for key in hashes:
+                f.write('%s %s\n' % (hashes[key], key))
+
+
+def load_hashes(uri, artifacts, download_dir, refresh=False):
+    '''
+    Returns a dictionary with the sums from all checksum artifacts.
+
+    Sums are kept in one manifest per download directory. Artifacts the
+    manifest lacks, or all of them with refresh, are fetched concurrently
+    and merged into it with a single write. The checksum files are still
+    written next to the artifacts for other tools and --base-path.
+    '''
+    manifest_path = os.path.join(download_dir, settings.hash_manifest)
+    manifest = downloads.load_json(manifest_path)
+    missing = [a for a in artifacts if refresh or a not in manifest]
+    fetched = {}
+    if uri and missing:
+        log.debug('Fetching %s' % ', '.join(missing))
+        contents = workers.run(
+            lambda artifact: downloads.get_content('%s/%s' % (uri, artifact)),
+            missing, settings.hash_concurrency)
+        for artifact, content in zip(missing, contents):
+            if not content:
+                raise RuntimeError('%s/%s cannot be downloaded' %
+                                   (uri, artifact))
+            fetched[artifact] = hash2dict(content)
+    elif missing:
+        for artifact in missing:
+            hashes = _read_local(download_dir, artifact)
+            if hashes:
+                fetched[artifact] = hashes
+    if fetched:
+        log.debug('Storing hashes to %s' % manifest_path)
+        manifest = downloads.update_json(manifest_path,
+                                         lambda m: m.update(fetched))
     hashes = {}
-    if hash_path and os.path.exists(hash_path):
-        with open(hash_path, 'r') as f:
-            file_hash_content = f.read()
-        hashes = hash2dict(file_hash_content)
-    if uri:
-        uri = '%s/%s' % (uri, artifact)
-        hash_content = downloads.get_content(uri)
-        if not hash_content:
-            raise RuntimeError('%s cannot be downloaded' % uri)
-        hashes.update(hash2dict(hash_content))
-        if hash_path:
-            log.debug('Storing hash to %s' % hash_path)
-            with downloads.flocked(hash_path):
-                with open(hash_path, 'w') as f:
-                    for key in hashes:
-                        f.write('%s %s\n' % (hashes[key], key))
-    if hashes:
-        return hashes
-    else:
+    for artifact in artifacts:
+        if not manifest.get(artifact):
+            raise RuntimeError('%s cannot be obtained for verifiaction' %
+                               artifact)
+        if artifact in fetched or \
+                not os.path.exists(os.path.join(download_dir, artifact)):
+            _write_local(download_dir, artifact, manifest[artifact])
+        hashes.update(manifest[artifact])
+    return hashes
+
+
+def load_hash(uri, artifact, download_dir=None, refresh=False):
+    if download_dir:
+        return load_hashes(uri, [artifact], download_dir, refresh)
+    hash_content = downloads.get_content('%s/%s' % (uri, artifact))
+    if not hash_content:
         raise RuntimeError('%s cannot be obtained for verifiaction' % artifact)
+    return hash2dict(hash_content)
@@ -0,0 +1,178 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Parser for the directory indexes served by Apache.
+
+The plain list, the <pre> and the table layouts are parsed in one pass
+from a stream of chunks, so a listing is never held in full.
+"""
+
+import calendar
+import collections
+import HTMLParser
+import hashlib
+import logging
+import os.path
+import re
+import time
+import urllib
+
+from phabletutils import downloads
+from phabletutils import network
+from phabletutils import settings
+
+log = logging.getLogger()
+
+Entry = collections.namedtuple('Entry', 'name mtime size directory')
+
+_date_formats = ((r'\d{2}-\w{3}-\d{4} \d{2}:\d{2}(?::\d{2})?',
+                  ('%d-%b-%Y %H:%M', '%d-%b-%Y %H:%M:%S')),
+                 (r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}(?::\d{2})?',
+                  ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S')))
+_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def _parse_mtime(text):
+    for pattern, formats in _date_formats:
+        match = re.search(pattern, text)
+        if not match:
+            continue
+        for date_format in formats:
+            try:
+                return calendar.timegm(time.strptime(match.group(0),
+                                                     date_format)), \
+                    text[match.end():]
+            except ValueError:
+                continue
+    return None, text
+
+
+def _parse_size(text):
+    match = re.match(r'\s*(?:-|([\d.]+)([KMG]?))(?:\s|$)', text)
+    if not match or not match.group(1):
+        return None
+    return int(float(match.group(1)) * _units[match.group(2)])
+
+
+class _IndexParser(HTMLParser.HTMLParser):
+    '''Collects an Entry for every link to something in the directory.'''
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.entries = []
+        self._href = None
+        self._in_link = False
+        self._in_pre = False
+        self._trail = []
+
+    def _finish(self):
+        if self._href is None:
+            return
+        href = urllib.unquote(self._href.split('?')[0].split('#')[0])
+        self._href = None
+        # Parent directory, sort links and anything outside the directory.
+        if not href or href.startswith(('/', '..')) or \
+                '://' in href or '/' in href.rstrip('/'):
+            return
+        mtime, rest = _parse_mtime(''.join(self._trail))
+        self.entries.append(Entry(name=href.rstrip('/'),
+                                  mtime=mtime,
+                                  size=_parse_size(rest) if mtime else None,
+                                  directory=href.endswith('/')))
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._finish()
+            self._href = dict(attrs).get('href')
+            self._in_link = True
+            self._trail = []
+        elif tag in ('tr', 'li'):
+            self._finish()
+        elif tag == 'pre':
+            self._in_pre = True
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self._in_link = False
+        elif tag in ('pre', 'table', 'ul', 'body'):
+            self._finish()
+            self._in_pre = False
+
+    def handle_data(self, data):
+        if self._href is None or self._in_link:
+            return
+        if self._in_pre:
+            # Rows of the <pre> layout end with the line.
+            head, newline, tail = data.partition('\n')
+            self._trail.append(head)
+            if newline:
+                self._finish()
+        else:
+            self._trail.append(data)
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        self._finish()
+
+
+def parse(chunks):
+    '''Yields the entries of the directory index read from chunks.'''
+    parser = _IndexParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        for entry in parser.entries:
+            yield entry
+        del parser.entries[:]
+    parser.close()
+    for entry in parser.entries:
+        yield entry
+
+
+def iter_entries(uri):
+    '''Yields the entries of the directory index at uri as they arrive.'''
+    response = network.get(uri, stream=True)
+    try:
+        if response.status_code != 200:
+            raise EnvironmentError('%s cannot be retrieved' % uri)
+        for entry in parse(response.iter_content(
+                settings.download_chunk_size)):
+            yield entry
+    finally:
+        response.close()
+
+
+def get_entries(uri, ttl=None):
+    '''
+    Returns the entries of the directory index at uri.
+
+    Entries are kept in the metadata cache and reused for ttl seconds,
+    settings.listing_ttl by default.
+    '''
+    ttl = settings.listing_ttl if ttl is None else ttl
+    path = os.path.join(downloads.metadata_dir(), 'listing-%s.json' %
+                        hashlib.sha1(uri).hexdigest())
+    cached = downloads.load_json(path)
+    if cached and time.time() - cached['fetched'] < ttl:
+        log.debug('Using cached listing for %s' % uri)
+        return [Entry(*entry) for entry in cached['entries']]
+    entries = list(iter_entries(uri))
+    try:
+        downloads.update_json(path, lambda listing: listing.update(
+            {'uri': uri, 'fetched': time.time(), 'entries': entries}))
+    except (IOError, OSError) as e:
+        log.debug('Cannot cache listing for %s: %s' % (uri, e))
+    return entries
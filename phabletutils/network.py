@@ -0,0 +1,83 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared HTTP sessions for all network access.
+
+Connections are kept alive in per host pools, every request gets a
+default timeout and idempotent requests are retried with exponential
+backoff. Callers running retry loops of their own, like the segmented
+downloads, use a session that does not retry.
+"""
+
+import logging
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from phabletutils import settings
+
+log = logging.getLogger()
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _new_session(retry):
+    if retry:
+        max_retries = Retry(total=settings.http_retries,
+                            backoff_factor=settings.http_backoff,
+                            status_forcelist=settings.http_retry_statuses,
+                            raise_on_status=False)
+    else:
+        max_retries = 0
+    adapter = HTTPAdapter(pool_connections=settings.http_pool_hosts,
+                          pool_maxsize=settings.http_pool_size,
+                          max_retries=max_retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session(retry=True):
+    '''Returns the shared session, with or without retries.'''
+    with _lock:
+        if retry not in _sessions:
+            _sessions[retry] = _new_session(retry)
+        return _sessions[retry]
+
+
+def reset():
+    '''Closes all pooled connections.'''
+    with _lock:
+        for shared in _sessions.values():
+            shared.close()
+        _sessions.clear()
+
+
+def get(uri, retry=True, **kwargs):
+    '''Issues a GET through the shared session.'''
+    kwargs.setdefault('timeout', settings.http_timeout)
+    return session(retry).get(uri, **kwargs)
+
+
+def head(uri, retry=True, **kwargs):
+    '''Issues a HEAD through the shared session.'''
+    kwargs.setdefault('timeout', settings.http_timeout)
+    return session(retry).head(uri, **kwargs)
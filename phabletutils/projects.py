@@ -16,39 +16,157 @@
 
 """Holds different projects or ways Ubuntu Touch is delivered."""
 
+import hashlib
 import os
 import os.path
+import pipes
+import posixpath
+import shutil
 import tempfile
+import threading
 import logging
 import gzip
 
-from phabletutils.downloads import checksum_verify
 from phabletutils.resources import (File, SignedFile)
 from phabletutils import downloads
-from time import sleep
+from phabletutils import settings
+from phabletutils import steps
+from phabletutils import store
+from phabletutils import trace
+from phabletutils import verification
+from phabletutils import workers
+from phabletutils.steps import Step
 from textwrap import dedent
 
 log = logging.getLogger()
 
+# Devices provisioned together share the decompressed image.
+_gunzip_lock = threading.Lock()
 
-def gunzip(file_path):
+
+def gunzip(file_path, source_hash=None):
+    '''
+    Decompresses file_path next to it and returns the decompressed path.
+
+    The image is streamed in settings.gunzip_chunk_size pieces and kept
+    for as long as file_path holds the content identified by source_hash,
+    the sha256 of file_path by default.
+    '''
     if not file_path.endswith('.gz'):
         return file_path
     target_path = file_path[:-3]
-    log.info('Decompressing %s' % file_path)
-    with open(target_path, 'wb') as target_file:
-        with gzip.open(file_path, 'r') as gzip_file:
-            for chunk in gzip_file.read():
-                target_file.write(chunk)
-    return target_path
+    with _gunzip_lock:
+        if not source_hash:
+            source_hash = verification.digest(file_path, hashlib.sha256)
+        if verification.cached_digest(target_path, 'gunzip') == source_hash:
+            log.info('Using decompressed %s' % target_path)
+            return target_path
+        log.info('Decompressing %s' % file_path)
+        tmp_path = '%s.%d.gunzip' % (target_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as target_file:
+                with gzip.open(file_path, 'rb') as gzip_file:
+                    shutil.copyfileobj(gzip_file, target_file,
+                                       settings.gunzip_chunk_size)
+            os.rename(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        verification.record_digest(target_path, 'gunzip', source_hash)
+        return target_path
+
+
+def _is_sha256(entry):
+    return entry.hash and \
+        verification.hash_name(entry.hash_type) == 'sha256'
+
+
+def _can_stream(entry):
+    return bool(entry.uri and entry.hash)
+
+
+def _stream_entry(adb, entry, directory):
+    '''
+    Streams entry from its URI into directory on the device.
+
+    The data is hashed on its way through and the device copy is removed
+    if it does not match entry.hash.
+    '''
+    dst = posixpath.join(directory, os.path.basename(entry.path))
+    log.info('Streaming %s to %s' % (entry.uri, dst))
+    file_sum = entry.hash_type()
+
+    def chunks():
+        for chunk in workers.prefetch(downloads.iter_content(entry.uri),
+                                      settings.stream_prefetch):
+            file_sum.update(chunk)
+            yield chunk
+    try:
+        adb.push_stream(chunks(), dst)
+        if file_sum.hexdigest() != entry.hash:
+            raise EnvironmentError(
+                'Checksum does not match after streaming %s and hash %s' %
+                (entry.uri, entry.hash))
+    except Exception:
+        adb.shell(['rm', '-f', dst])
+        raise
+
+
+def _streamed(entry):
+    '''Returns True if entry is to be streamed instead of pushed.'''
+    return entry.check and _can_stream(entry) and not entry.verified
+
+
+def _fetched(path):
+    '''Returns the name of the step fetching path.'''
+    return 'fetch %s' % os.path.basename(path)
+
+
+def _push_payload(adb, entry, path, directory):
+    '''
+    Pushes path, entry or its signature, to directory on the device.
+
+    entry is streamed instead when it was not downloaded for it.
+    '''
+    if path == entry.path and _streamed(entry):
+        _stream_entry(adb, entry, directory)
+    else:
+        adb.push(path, directory.rstrip('/') + '/', incremental=True)
+
+
+def _queue_wipe(batch, keep=()):
+    '''
+    Queues clearing /data and /cache on batch.
+
+    The files in keep under /cache/recovery are spared, so payloads that
+    are pushed again need not be sent.
+    '''
+    log.info('Clearing /data and /cache')
+    batch.shell('mount /data')
+    if keep:
+        spared = '|'.join(pipes.quote(posixpath.join('/cache/recovery', name))
+                          for name in keep)
+        batch.shell('rm -Rf /data/* /data/.developer_mode')
+        batch.shell('for f in /cache/* /cache/recovery/*; do case "$f" in '
+                    '/cache/recovery|%s) ;; *) rm -Rf "$f" ;; esac; done' %
+                    spared)
+    else:
+        batch.shell('rm -Rf /cache/* /data/* /data/.developer_mode')
+    batch.shell('mkdir /cache/recovery')
+    batch.shell('mkdir /data/media')
+
+
+def _log_failures(results):
+    for result in results:
+        if result.status:
+            log.debug('%s exited with %d: %s' %
+                      (result.command, result.status, result.output.strip()))
 
 
 def wipe_device(adb):
-    log.info('Clearing /data and /cache')
-    adb.shell('mount /data')
-    adb.shell('rm -Rf /cache/* /data/* /data/.developer_mode')
-    adb.shell('mkdir /cache/recovery')
-    adb.shell('mkdir /data/media')
+    with adb.batch() as batch:
+        _queue_wipe(batch)
+    _log_failures(batch.results)
 
 
 class BaseProject(object):
@@ -73,25 +191,152 @@ class BaseProject(object):
         self._ubuntu = ubuntu
         self._wipe = wipe
 
-    def download(self):
-        """Downloads and verifies resources."""
+    @property
+    def directories(self):
+        """Directories holding the files of this project."""
+        return set(os.path.dirname(x.path) for x in self._list)
+
+    @property
+    def streamable(self):
+        """Files install can stream to the device when not on disk."""
+        return []
+
+    def download(self, concurrency=settings.download_concurrency,
+                 stream=False):
+        """
+        Downloads and verifies resources.
+
+        With stream, streamable files that are not in the local store are
+        left for install to stream to the device.
+        """
+        with trace.span('verify', 'projects'):
+            verification.verify_files(self._list)
+        for entry in self._list:
+            if entry.check and entry.verified and _is_sha256(entry):
+                store.checkin(entry.path, entry.hash)
         download_list = filter((lambda x: x.check), self._list)
         download_list = filter((lambda x: not x.verified), download_list)
         log.debug('Download list %s' % download_list)
         if not download_list:
             log.info('Download not required')
             return
-        for entry in download_list:
-            log.debug('Download entry %s %s' % (entry.path, entry.verified))
-            downloads.download(entry)
-            if entry.hash and \
-               not checksum_verify(entry.path, entry.hash, entry.hash_type):
-                raise EnvironmentError(
-                    'Checksum does not match after download for %s '
-                    'and hash %s' % (entry.path, entry.hash))
-        download_list = filter(lambda x: isinstance(x, SignedFile), self._list)
-        for entry in download_list:
-            downloads.download_sig(entry)
+        cancel = threading.Event()
+        if stream:
+            streamed = [entry for entry in download_list
+                        if _can_stream(entry) and entry in self.streamable]
+            download_list = [entry for entry in download_list
+                             if entry not in streamed]
+            for entry in streamed:
+                if not self._checkout(entry):
+                    log.info('%s will be streamed to the device' %
+                             os.path.basename(entry.path))
+        jobs = [(self._download_entry, entry) for entry in download_list]
+        jobs += [(self._download_sig, entry) for entry in
+                 filter(lambda x: isinstance(x, SignedFile), self._list)]
+        with trace.span('download', 'projects', files=len(jobs)):
+            workers.run(lambda job: job[0](job[1], cancel), jobs,
+                        concurrency, cancel)
+
+    def _fetch(self, entry, stream=False, cancel=None):
+        """
+        Verifies entry and downloads it if it does not match.
+
+        With stream, a streamable entry that is not in the local store is
+        left for install to stream to the device.
+        """
+        if not entry.check:
+            return
+        if entry.verified:
+            if _is_sha256(entry):
+                store.checkin(entry.path, entry.hash)
+        elif stream and _can_stream(entry) and entry in self.streamable:
+            if not self._checkout(entry):
+                log.info('%s will be streamed to the device' %
+                         os.path.basename(entry.path))
+        else:
+            self._download_entry(entry, cancel)
+
+    def _fetch_steps(self, concurrency, stream, cancel):
+        """
+        Returns a step fetching each file of this project and its
+        signature, no more than concurrency of them at a time.
+        """
+        slots = threading.Semaphore(concurrency)
+        graph = []
+        for entry in self._list:
+            graph.append(Step(_fetched(entry.path),
+                              lambda e=entry: self._fetch(e, stream, cancel),
+                              slots=slots))
+            if isinstance(entry, SignedFile):
+                graph.append(Step(_fetched(entry.sig_path),
+                                  lambda e=entry: self._download_sig(
+                                      e, cancel),
+                                  slots=slots))
+        return graph
+
+    def step_graph(self, adb, fastboot,
+                   concurrency=settings.download_concurrency, stream=False,
+                   cancel=None):
+        """
+        Returns the steps provisioning this project.
+
+        By default everything is downloaded before install runs.
+        """
+        return [Step('download', lambda: self.download(concurrency, stream)),
+                Step('install', lambda: self.install(adb, fastboot),
+                     requires=['download'])]
+
+    def provision(self, adb, fastboot,
+                  concurrency=settings.download_concurrency, stream=False):
+        """
+        Downloads and installs, running steps that do not depend on each
+        other concurrently, then logs how long each step took.
+        """
+        cancel = threading.Event()
+        graph = self.step_graph(adb, fastboot, concurrency, stream, cancel)
+        try:
+            with trace.span('provision', 'projects', steps=len(graph)):
+                steps.run(graph, cancel)
+        finally:
+            steps.report(graph)
+
+    @staticmethod
+    def _checkout(entry):
+        """Returns True if entry was linked in from the local store."""
+        if _is_sha256(entry):
+            digest = entry.hash
+        elif not entry.hash:
+            digest = store.lookup(entry.uri)
+        else:
+            digest = None
+        if digest and store.checkout(digest, entry.path):
+            if entry.hash:
+                entry.record_digest(digest)
+            return True
+        return False
+
+    @staticmethod
+    def _download_entry(entry, cancel=None):
+        log.debug('Download entry %s %s' % (entry.path, entry.verified))
+        if BaseProject._checkout(entry):
+            return
+        digest = downloads.download(entry, cancel)
+        if entry.hash and not entry.verified:
+            raise EnvironmentError(
+                'Checksum does not match after download for %s '
+                'and hash %s' % (entry.path, entry.hash))
+        if digest:
+            store.checkin(entry.path, digest,
+                          None if entry.hash else entry.uri)
+
+    @staticmethod
+    def _download_sig(entry, cancel=None):
+        digest = store.lookup(entry.sig_uri)
+        if digest and store.checkout(digest, entry.sig_path):
+            return
+        digest = downloads.download_sig(entry, cancel)
+        if digest:
+            store.checkin(entry.sig_path, digest, entry.sig_uri)
 
     def install(self):
         raise EnvironmentError('Requires implementation')
@@ -105,8 +350,8 @@ class Android(BaseProject):
 
     def install(self, adb, fastboot):
         log.warning('Device needs to be unlocked for the following to work')
-        fastboot.flash('system', gunzip(self.system))
-        fastboot.flash('boot', self.boot)
+        fastboot.flash('system', gunzip(self._system.path, self._system.hash))
+        fastboot.flash('boot', self._boot.path)
         log.info('Installation will complete soon and reboot into Android')
         fastboot.reboot()
 
@@ -128,13 +373,50 @@ class UbuntuTouchBootstrap(BaseProject):
         fastboot.flash('boot', self._boot.path)
         fastboot.flash('recovery', self._recovery.path)
         fastboot.boot(self._recovery.path)
-        sleep(15)
-        wipe_device(adb)
-        adb.push(self._ubuntu.path, '/sdcard/autodeploy.zip')
+        self._deploy(adb)
+
+    def _deploy(self, adb):
+        adb.wait_for('recovery', source='fastboot')
+        with adb.batch() as batch:
+            _queue_wipe(batch)
+            batch.push(self._ubuntu.path, '/sdcard/autodeploy.zip')
+        _log_failures(batch.results)
         log.info('Deploying Ubuntu')
         adb.reboot(recovery=True)
         log.info('Installation will complete soon and reboot into Ubuntu')
 
+    def step_graph(self, adb, fastboot,
+                   concurrency=settings.download_concurrency, stream=False,
+                   cancel=None):
+        """
+        Reboots into the bootloader while the images download, nothing is
+        flashed until all of them are fetched.
+        """
+        def reboot():
+            adb.reboot(bootloader=True)
+            log.warning('Device needs to be unlocked for the following to '
+                        'work')
+
+        graph = self._fetch_steps(concurrency, stream, cancel)
+        fetched = [step.name for step in graph]
+        graph.append(Step('reboot to bootloader', reboot))
+        previous = 'reboot to bootloader'
+        for partition, entry in (('system', self._system),
+                                 ('boot', self._boot),
+                                 ('recovery', self._recovery)):
+            name = 'flash %s' % partition
+            graph.append(Step(name,
+                              lambda p=partition, e=entry:
+                              fastboot.flash(p, e.path),
+                              requires=[previous] + fetched))
+            previous = name
+        graph.append(Step('boot recovery',
+                          lambda: fastboot.boot(self._recovery.path),
+                          requires=[previous]))
+        graph.append(Step('deploy', lambda: self._deploy(adb),
+                          requires=['boot recovery']))
+        return graph
+
 
 class UbuntuTouchRecovery(BaseProject):
 
@@ -151,6 +433,10 @@ class UbuntuTouchRecovery(BaseProject):
             ubuntu=ubuntu, device=device, wipe=wipe)
         self._storage = storage
 
+    @property
+    def streamable(self):
+        return [self._device, self._ubuntu]
+
     def install(self, adb, fastboot=None):
         """
         Deploys recovery files, recovery script and then reboots to install.
@@ -159,19 +445,76 @@ class UbuntuTouchRecovery(BaseProject):
                     '(or one that supports extendedcommands) '
                     'in place for the provisioning to work')
         adb.reboot(recovery=True)
-        sleep(20)
-        if self._wipe:
-            wipe_device(adb)
-        adb.shell('mount %s' % self._storage)
-        adb.push(self._device.path, self._storage)
-        adb.push(self._ubuntu.path, self._storage)
         recovery_file = self.create_recovery_file()
-        adb.push(recovery_file, '/cache/recovery/extendedcommand')
+        with adb.batch() as batch:
+            if self._wipe:
+                _queue_wipe(batch)
+            batch.shell('mount %s' % self._storage)
+            for entry in (self._device, self._ubuntu):
+                if not _streamed(entry):
+                    batch.push(entry.path, self._storage, incremental=True)
+            batch.push(recovery_file, '/cache/recovery/extendedcommand')
+        _log_failures(batch.results)
+        for entry in filter(_streamed, (self._device, self._ubuntu)):
+            _stream_entry(adb, entry, self._storage)
         adb.reboot(recovery=True)
         log.info('Once completed the device should reboot into Ubuntu')
         log.debug('Removing recovery file %s' % recovery_file)
         os.unlink(recovery_file)
 
+    def step_graph(self, adb, fastboot=None,
+                   concurrency=settings.download_concurrency, stream=False,
+                   cancel=None):
+        """
+        Reboots into recovery while the files download and pushes each
+        file once it is fetched.
+
+        The wipe and the recovery script that installs the files wait
+        for every file, so a failed download leaves the device as is.
+        """
+        def reboot():
+            log.warning('The device needs to have a clockwork mod recovery '
+                        'image (or one that supports extendedcommands) '
+                        'in place for the provisioning to work')
+            adb.reboot(recovery=True)
+
+        def prepare():
+            with adb.batch() as batch:
+                if self._wipe:
+                    _queue_wipe(batch)
+                batch.shell('mount %s' % self._storage)
+            _log_failures(batch.results)
+
+        def push_script():
+            recovery_file = self.create_recovery_file()
+            try:
+                adb.push(recovery_file, '/cache/recovery/extendedcommand')
+            finally:
+                os.unlink(recovery_file)
+
+        def deploy():
+            adb.reboot(recovery=True)
+            log.info('Once completed the device should reboot into Ubuntu')
+
+        graph = self._fetch_steps(concurrency, stream, cancel)
+        fetched = [step.name for step in graph]
+        graph.append(Step('reboot to recovery', reboot))
+        graph.append(Step('prepare', prepare,
+                          requires=['reboot to recovery'] +
+                          (fetched if self._wipe else [])))
+        graph.append(Step('push extendedcommand', push_script,
+                          requires=['prepare'] + fetched))
+        pushes = ['push extendedcommand']
+        for entry in (self._device, self._ubuntu):
+            name = 'push %s' % os.path.basename(entry.path)
+            graph.append(Step(name,
+                              lambda e=entry: _push_payload(
+                                  adb, e, e.path, self._storage),
+                              requires=['prepare', _fetched(entry.path)]))
+            pushes.append(name)
+        graph.append(Step('reboot to install', deploy, requires=pushes))
+        return graph
+
     def create_recovery_file(self):
         template = self.recovery_script_template
         recovery_file = tempfile.NamedTemporaryFile(delete=False)
@@ -187,17 +530,24 @@ class UbuntuTouchRecovery(BaseProject):
 
 class UbuntuTouchSystem(BaseProject):
 
-    ubuntu_recovery_script = dedent('''\
+    ubuntu_format_script = dedent('''\
         format data
         format system
+        ''')
+
+    ubuntu_recovery_script = dedent('''\
         load_keyring image-master.tar.xz image-master.tar.xz.asc
         load_keyring image-signing.tar.xz image-signing.tar.xz.asc
         mount system
         ''')
 
-    def __init__(self, file_list, recovery, command_part):
+    def __init__(self, file_list, recovery, command_part, wipe=True):
+        """
+        Without wipe the command_part updates are applied on top of the
+        installed system, which is how delta images are installed.
+        """
         log.debug('UbuntuTouchSystem')
-        super(UbuntuTouchSystem, self).__init__(recovery=recovery, wipe=True)
+        super(UbuntuTouchSystem, self).__init__(recovery=recovery, wipe=wipe)
         for item in file_list:
             if item and not isinstance(item, File):
                 raise TypeError('%s is not of type File' % item)
@@ -206,30 +556,102 @@ class UbuntuTouchSystem(BaseProject):
         self._recovery_list = file_list
         self._command_part = command_part
 
+    @property
+    def streamable(self):
+        return list(self._recovery_list)
+
+    def _payloads(self):
+        """Returns the entry and path of each file for /cache/recovery."""
+        payloads = []
+        for entry in self._recovery_list:
+            payloads.append((entry, entry.path))
+            if isinstance(entry, SignedFile):
+                payloads.append((entry, entry.sig_path))
+        return payloads
+
+    def _queue_prepare(self, batch, keep):
+        if self._wipe:
+            _queue_wipe(batch, [os.path.basename(p) for p in keep])
+        else:
+            batch.shell('mkdir /cache/recovery')
+
+    def _boot_recovery(self, fastboot):
+        fastboot.flash('recovery', self._recovery.path)
+        fastboot.boot(self._recovery.path)
+        log.info('Once completed the device should reboot into Ubuntu')
+
     def install(self, adb, fastboot=None):
         """
         Deploys recovery files, recovery script and then reboots to install.
         """
+        streamed = filter(_streamed, self._recovery_list)
+        payloads = [path for entry, path in self._payloads()
+                    if path != entry.path or entry not in streamed]
         adb.reboot(recovery=True)
-        sleep(20)
-        wipe_device(adb)
-
-        for entry in self._recovery_list:
-            adb.push(entry.path, '/cache/recovery/')
-            try:
-                adb.push(entry.sig_path, '/cache/recovery/')
-            except AttributeError:
-                pass
-        adb.push(self.create_ubuntu_command_file(),
-                 '/cache/recovery/ubuntu_command')
+        with adb.batch() as batch:
+            self._queue_prepare(batch, payloads)
+            for payload in payloads:
+                batch.push(payload, '/cache/recovery/', incremental=True)
+            batch.push(self.create_ubuntu_command_file(),
+                       '/cache/recovery/ubuntu_command')
+        _log_failures(batch.results)
+        for entry in streamed:
+            _stream_entry(adb, entry, '/cache/recovery')
         adb.reboot(bootloader=True)
-        fastboot.flash('recovery', self._recovery.path)
-        fastboot.boot(self._recovery.path)
-        log.info('Once completed the device should reboot into Ubuntu')
+        self._boot_recovery(fastboot)
+
+    def step_graph(self, adb, fastboot,
+                   concurrency=settings.download_concurrency, stream=False,
+                   cancel=None):
+        """
+        Reboots into recovery while the files download, pushes each file
+        once it is fetched and flashes recovery once all are pushed.
+
+        The wipe and the command file that installs the files wait for
+        every file, so a failed download leaves the device as is.
+        """
+        payloads = self._payloads()
+
+        def prepare():
+            with adb.batch() as batch:
+                self._queue_prepare(batch, [path for _, path in payloads])
+            _log_failures(batch.results)
+
+        def push_command():
+            adb.push(self.create_ubuntu_command_file(),
+                     '/cache/recovery/ubuntu_command')
+
+        graph = self._fetch_steps(concurrency, stream, cancel)
+        fetched = [step.name for step in graph]
+        graph.append(Step('reboot to recovery',
+                          lambda: adb.reboot(recovery=True)))
+        graph.append(Step('prepare', prepare,
+                          requires=['reboot to recovery'] +
+                          (fetched if self._wipe else [])))
+        graph.append(Step('push ubuntu_command', push_command,
+                          requires=['prepare'] + fetched))
+        pushes = ['push ubuntu_command']
+        for entry, path in payloads:
+            name = 'push %s' % os.path.basename(path)
+            graph.append(Step(name,
+                              lambda e=entry, p=path: _push_payload(
+                                  adb, e, p, '/cache/recovery'),
+                              requires=['prepare', _fetched(path)]))
+            pushes.append(name)
+        graph.append(Step('reboot to bootloader',
+                          lambda: adb.reboot(bootloader=True),
+                          requires=pushes))
+        graph.append(Step('flash recovery',
+                          lambda: self._boot_recovery(fastboot),
+                          requires=['reboot to bootloader',
+                                    _fetched(self._recovery.path)]))
+        return graph
 
     def create_ubuntu_command_file(self):
         ubuntu_command_file = tempfile.NamedTemporaryFile(delete=False)
         with ubuntu_command_file as output_file:
+            if self._wipe:
+                output_file.write(self.ubuntu_format_script)
             output_file.write(self.ubuntu_recovery_script)
             output_file.write(self._command_part)
             output_file.write('unmount system\n')
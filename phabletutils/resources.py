@@ -16,9 +16,13 @@
 
 """Resources for downloading and installing Ubuntu Touch."""
 
-import downloads
 import hashlib
 import logging
+import os.path
+import threading
+import verification
+
+from phabletutils import trace
 
 log = logging.getLogger()
 
@@ -36,6 +40,8 @@ class File(object):
 
     @property
     def verified(self):
+        if self._verified is None:
+            self.verify()
         return self._verified
 
     @property
@@ -50,6 +56,13 @@ class File(object):
     def check(self):
         return self._check
 
+    @property
+    def partial_sum(self):
+        """(size, mtime, hash object) of a partial copy already hashed."""
+        if self._verified is None:
+            self.verify()
+        return self._partial_sum
+
     def __init__(self, file_uri, file_path, check=True, file_hash=None,
                  file_hash_func=hashlib.sha256):
         self._uri = file_uri
@@ -57,12 +70,35 @@ class File(object):
         self._hash = file_hash
         self._hash_func = file_hash_func
         self._check = check
-        if check and file_hash:
-            self._verified = downloads.checksum_verify(file_path, file_hash,
-                                                       file_hash_func)
-            log.debug('%s verified: %s' % (file_path, self._verified))
+        self._partial_sum = None
+        self._lock = threading.Lock()
+        # Verification is deferred until it is first needed.
+        self._verified = None if check and file_hash else False
+
+    def verify(self):
+        """Verifies the file on disk unless that was done already."""
+        with self._lock:
+            if self._verified is None:
+                with trace.span('verify %s' % os.path.basename(self._path),
+                                'verification') as span:
+                    self._verified, self._partial_sum = verification.verify(
+                        self._path, self._hash, self._hash_func)
+                    span['verified'] = self._verified
+                log.debug('%s verified: %s' % (self._path, self._verified))
+        return self._verified
+
+    def record_digest(self, digest):
+        """Records the digest computed while downloading the file."""
+        self._partial_sum = None
+        self._verified = digest == self._hash
+        log.debug('%s verified: %s' % (self._path, self._verified))
+        if self._verified:
+            verification.record_digest(
+                self._path, verification.hash_name(self._hash_func), digest)
         else:
-            self._verified = False
+            log.debug('Calculated sum mismatch calculated %s != %s' %
+                      (digest, self._hash))
+        return self._verified
 
 
 class SignedFile(File):
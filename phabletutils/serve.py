@@ -0,0 +1,182 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serves the local download cache to other phablet-flash hosts.
+
+/objects/<sha256> returns an object from the store and
+/mirror/<scheme>/<host>/<path> returns what the store holds for that
+upstream URI. Checksum files, index.json and stamps under /mirror are
+fetched from upstream and kept for serve_metadata_ttl seconds, so a
+farm asks upstream once for them. Files support Range requests.
+"""
+
+import BaseHTTPServer
+import email.utils
+import logging
+import os
+import os.path
+import re
+import SocketServer
+import urllib
+import urlparse
+
+from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import store
+
+log = logging.getLogger()
+
+
+def _is_metadata(uri):
+    name = uri.rsplit('/', 1)[-1]
+    return name in ('SHA256SUMS', 'index.json') or \
+        name.endswith('.md5sum') or name.endswith('_stamp')
+
+
+def _mirrored_uri(path):
+    '''Returns the upstream URI for a /mirror/ path or None.'''
+    parts = path[len('/mirror/'):].split('/', 1)
+    if len(parts) != 2 or parts[0] not in ('http', 'https'):
+        return None
+    return '%s://%s' % tuple(parts)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    server_version = 'phablet-flash'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug('%s %s' % (self.client_address[0], format % args))
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _handle(self, head):
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        if path.startswith('/objects/'):
+            digest = path[len('/objects/'):]
+            if re.match(r'^[0-9a-f]{64}$', digest):
+                return self._send_file(store.object_path(digest), head)
+        elif path.startswith('/mirror/'):
+            uri = _mirrored_uri(path)
+            if not uri or not uri.startswith(self.server.upstreams):
+                return self._send_error(403)
+            if _is_metadata(uri):
+                return self._send_content(self.server.metadata(uri), head)
+            digest = store.lookup(uri)
+            if digest:
+                return self._send_file(store.object_path(digest), head)
+        self._send_error(404)
+
+    def _send_error(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_content(self, content, head):
+        if content is None:
+            return self._send_error(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(content)
+
+    def _send_file(self, path, head):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return self._send_error(404)
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            start, end = 0, size
+            match = re.match(r'^bytes=(\d*)-(\d*)$',
+                             self.headers.get('Range', ''))
+            if match and match.group(1) and match.group(2) and \
+                    int(match.group(2)) < int(match.group(1)):
+                # An invalid range is ignored, as RFC 7233 asks.
+                match = None
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)) + 1, size)
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                                 (start, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Last-Modified',
+                             email.utils.formatdate(stat.st_mtime,
+                                                    usegmt=True))
+            self.end_headers()
+            if head:
+                return
+            f.seek(start)
+            remaining = end - start
+            while remaining:
+                chunk = f.read(min(settings.download_chunk_size, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server for the local object store.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, upstreams=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        upstreams = upstreams or (settings.cdimage_uri_base,
+                                  settings.system_image_uri)
+        self.upstreams = tuple('%s/' % u.rstrip('/') for u in upstreams)
+
+    def metadata(self, uri):
+        '''Returns upstream content for uri, cached for a short while.'''
+        # Asking our own peers could loop back to the one asking us.
+        return downloads.get_content(uri, peers=False,
+                                     ttl=settings.serve_metadata_ttl)
+
+
+def serve(address='', port=settings.serve_port):
+    '''Serves the download cache until interrupted.'''
+    server = CacheServer((address, port))
+    log.info('Serving %s on port %d' % (store.root(), port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Stopped serving')
+    finally:
+        server.server_close()
@@ -18,8 +18,104 @@ revision = 2
 default_series = 'saucy'
 cdimage_uri_base = 'http://cdimage.ubuntu.com'
 system_image_uri = 'https://system-image.ubuntu.com'
+system_image_channel = 'daily'
+# Where a device records the system-image version it runs.
+system_image_version_files = ('/etc/system-image/channel.ini',
+                              '/system/etc/system-image/channel.ini')
 download_dir = 'phablet-flash'
 
+# Parallel Range segments used per download and the smallest segment
+# worth its own connection, files below twice this size use one stream.
+download_segments = 4
+download_segment_min_size = 8 * 1024 * 1024
+download_chunk_size = 256 * 1024
+download_retries = 5
+download_timeout = 60
+download_progress_interval = 5
+# Artifacts fetched at the same time and the combined bandwidth cap in
+# bytes per second for all of them, None for no cap.
+download_concurrency = 4
+download_rate_limit = None
+# Per download directory record of verified digests.
+verification_cache = '.verified'
+hash_buffer_size = 4 * 1024 * 1024
+# Per download directory manifest of the published checksums and how
+# many checksum files are fetched at the same time.
+hash_manifest = '.hashes.json'
+hash_concurrency = 8
+# Downloaded chunks held in memory ahead of the device when streaming
+# payloads straight to it.
+stream_prefetch = 16
+# Bytes decompressed at a time when unpacking gzipped images.
+gunzip_chunk_size = 4 * 1024 * 1024
+# Content addressed store under download_dir shared by all builds.
+store_dir = 'objects'
+# Download cache quota in bytes enforced after each run, None to keep
+# everything. Temporary downloads and lock files older than
+# cache_stale_age seconds are removed by the collector.
+cache_quota = None
+cache_stamp = '.in_use'
+cache_tmp_dir = 'tmp'
+cache_stale_age = 24 * 60 * 60
+
+# Directory listings fetched at the same time when crawling cdimage and
+# how many seconds a fetched listing is reused.
+crawl_concurrency = 8
+listing_ttl = 300
+# Seconds a resolved current or pending build is reused, and whether
+# rsync is asked when it cannot be resolved over HTTP.
+build_pointer_ttl = 60
+build_pointer_rsync = True
+
+# Shared HTTP connection pools: hosts kept, connections kept per host,
+# default timeout in seconds and retries with exponential backoff for
+# connection errors and the listed statuses.
+http_pool_hosts = 10
+http_pool_size = download_segments * download_concurrency
+http_timeout = 30
+http_retries = 3
+http_backoff = 0.5
+http_retry_statuses = (500, 502, 503, 504)
+
+# Checksum files, indexes and stamps are cached here under download_dir
+# and used without revalidation for metadata_ttl seconds.
+metadata_cache_dir = 'metadata'
+metadata_ttl = 60
+
+# Other phablet-flash hosts serving their download cache, tried in order
+# before the upstream servers, and the defaults for serving ours.
+cache_peers = []
+peer_retries = 1
+peer_timeout = 5
+serve_port = 8037
+serve_metadata_ttl = 60
+
+# Fleet mode keeps one log per device serial under download_dir and
+# installs on this many devices at a time, None for all of them.
+fleet_log_dir = 'logs'
+fleet_concurrency = None
+
+# The adb server spoken to directly for device commands, overridden by
+# ANDROID_ADB_SERVER_PORT like adb does, and the seconds allowed for
+# connecting to it and for each sync transfer step.
+adb_server_host = '127.0.0.1'
+adb_server_port = 5037
+adb_timeout = 30
+
+# Device states are polled starting at state_poll_interval seconds,
+# growing by state_poll_backoff up to state_poll_max_interval. A wait
+# gives up after state_timeout seconds and a device is given
+# state_leave_timeout seconds to drop off before waiting for it to come
+# back. The last state_samples transition times per model are kept in
+# state_transitions under the metadata cache.
+state_poll_interval = 0.1
+state_poll_backoff = 1.5
+state_poll_max_interval = 2
+state_timeout = 300
+state_leave_timeout = 10
+state_transitions = 'transitions.json'
+state_samples = 20
+
 files_arch_any = {
     'ubuntu-touch': {
         'device_zip': '%s-preinstalled-touch-armel+%s.zip',
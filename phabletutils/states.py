@@ -0,0 +1,144 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Waits for devices to reach an adb or fastboot state.
+
+The adb server, and fastboot when a fastboot state is asked for, are
+polled at a growing interval until the device shows up in the state or
+the deadline passes. How long each transition took is recorded per
+device model.
+"""
+
+import logging
+import os.path
+import subprocess
+import time
+
+from phabletutils import adbclient
+from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import trace
+
+log = logging.getLogger()
+
+
+def adb_states():
+    '''Returns the state of every device the adb server sees by serial.'''
+    try:
+        return dict(adbclient.Client().devices())
+    except EnvironmentError as e:
+        log.debug('Cannot list adb devices: %s' % e)
+        return {}
+
+
+def fastboot_states():
+    '''Returns 'fastboot' for every device fastboot sees by serial.'''
+    output = subprocess.check_output(['fastboot', 'devices'])
+    return dict((fields[0], 'fastboot') for fields in
+                (line.split() for line in output.splitlines())
+                if len(fields) >= 2)
+
+
+def state(serial, fastboot=False):
+    '''
+    Returns the state of the device with serial or None if it is not seen.
+
+    Without a serial the state of the only device attached is returned.
+    '''
+    states = adb_states()
+    if fastboot:
+        states.update(fastboot_states())
+    if serial:
+        return states.get(serial)
+    if len(states) == 1:
+        return states.values()[0]
+    return None
+
+
+def _poll(serial, done, fastboot, timeout):
+    '''Polls until done(state) holds, returns (reached, state).'''
+    start = time.time()
+    interval = settings.state_poll_interval
+    while True:
+        current = state(serial, fastboot)
+        if done(current):
+            return True, current
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return False, current
+        time.sleep(min(interval, remaining))
+        interval = min(interval * settings.state_poll_backoff,
+                       settings.state_poll_max_interval)
+
+
+def _transitions_path():
+    return os.path.join(downloads.metadata_dir(),
+                        settings.state_transitions)
+
+
+def record(model, transition, elapsed):
+    '''Adds elapsed seconds to the samples of transition for model.'''
+
+    def add(models):
+        samples = models.setdefault(model, {}).setdefault(transition, [])
+        samples.append(round(elapsed, 1))
+        del samples[:-settings.state_samples]
+    try:
+        downloads.update_json(_transitions_path(), add)
+    except (IOError, OSError) as e:
+        log.debug('Cannot record transition times: %s' % e)
+
+
+def transition_times(model):
+    '''Returns the recorded seconds of each transition for model.'''
+    return downloads.load_json(_transitions_path()).get(model, {})
+
+
+def wait(serial, states, timeout=None, leave=None, model=None,
+         transition=None):
+    '''
+    Waits until the device with serial is in one of states.
+
+    With leave the device is first given state_leave_timeout seconds to
+    drop out of that state, so a device listed until it goes down is
+    not taken for one that is back. The time taken is recorded under
+    transition for model when both are given. Returns the state
+    reached, raises EnvironmentError after timeout seconds.
+    '''
+    timeout = settings.state_timeout if timeout is None else timeout
+    fastboot = 'fastboot' in states
+    start = time.time()
+    with trace.span('wait for %s' % ' or '.join(states), 'device') as span:
+        if leave:
+            left, current = _poll(serial, lambda s: s != leave, fastboot,
+                                  settings.state_leave_timeout)
+            if not left:
+                log.debug('%s did not leave %s' % (serial or 'Device',
+                                                   leave))
+        reached, current = _poll(serial, lambda s: s in states, fastboot,
+                                 timeout - (time.time() - start))
+        span['state'] = current
+    elapsed = time.time() - start
+    if not reached:
+        raise EnvironmentError('%s did not reach %s within %ds, it is %s' %
+                               (serial or 'Device', ' or '.join(states),
+                                timeout, current or 'not attached'))
+    log.info('%s reached %s in %.1fs' % (serial or 'Device', current,
+                                         elapsed))
+    if model and transition:
+        record(model, transition, elapsed)
+    return current
@@ -0,0 +1,147 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs provisioning steps as a dependency graph.
+
+A step starts as soon as the steps it requires are done, so a device
+can reboot while the host downloads and a file is pushed as soon as it
+is verified. Steps sharing a semaphore, like downloads, are limited to
+that many at a time.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from phabletutils import trace
+from phabletutils import workers
+
+log = logging.getLogger()
+
+
+class Step(object):
+    '''A named unit of work and the names of the steps it waits for.'''
+
+    def __init__(self, name, func, requires=(), slots=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.slots = slots
+        self.start = None
+        self.elapsed = None
+
+    def __repr__(self):
+        return '<Step %s>' % self.name
+
+
+def _check(steps):
+    names = set()
+    for step in steps:
+        if step.name in names:
+            raise ValueError('Step %s is defined twice' % step.name)
+        names.add(step.name)
+    for step in steps:
+        missing = set(step.requires) - names
+        if missing:
+            raise ValueError('Step %s requires unknown %s' %
+                             (step.name, ', '.join(sorted(missing))))
+
+
+def run(steps, cancel=None):
+    '''
+    Runs every step once the steps it requires are done.
+
+    Independent steps run concurrently, each on its own thread. The
+    first failure sets cancel, no further steps are started and the
+    error is raised once the running ones are done. Every step that ran
+    has its start offset and elapsed seconds set.
+    '''
+    _check(steps)
+    if cancel is None:
+        cancel = threading.Event()
+    done = set()
+    pending = list(steps)
+    finished = Queue.Queue()
+    running = 0
+    errors = []
+    origin = time.time()
+
+    def work(step):
+        try:
+            if step.slots:
+                with step.slots:
+                    if not cancel.is_set():
+                        _call(step, origin)
+            else:
+                _call(step, origin)
+            finished.put((step, None))
+        except Exception as e:
+            finished.put((step, e))
+
+    try:
+        while pending or running:
+            if not cancel.is_set():
+                ready = [s for s in pending if done.issuperset(s.requires)]
+                for step in ready:
+                    pending.remove(step)
+                    thread = threading.Thread(target=work, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+            if not running:
+                if pending and not cancel.is_set():
+                    raise RuntimeError('Steps cannot be scheduled: %s' %
+                                       ', '.join(s.name for s in pending))
+                break
+            step, error = workers.get(finished)
+            running -= 1
+            if error:
+                if not cancel.is_set():
+                    log.debug('Step %s failed: %s' % (step.name, error))
+                    errors.append(error)
+                cancel.set()
+            else:
+                done.add(step.name)
+    except KeyboardInterrupt:
+        cancel.set()
+        raise
+    if errors:
+        raise errors[0]
+
+
+def _call(step, origin):
+    step.start = time.time() - origin
+    log.debug('Starting step %s' % step.name)
+    try:
+        with trace.span(step.name, 'projects', requires=list(step.requires)):
+            step.func()
+    finally:
+        step.elapsed = time.time() - origin - step.start
+
+
+def report(steps):
+    '''Logs when each step that ran started and how long it took.'''
+    ran = sorted((s for s in steps if s.elapsed is not None),
+                 key=lambda s: s.start)
+    if not ran:
+        return
+    log.info('Step timings, %.1fs in total:' %
+             max(s.start + s.elapsed for s in ran))
+    for step in ran:
+        log.info('  %7.1fs %7.1fs  %s' % (step.start, step.elapsed,
+                                          step.name))
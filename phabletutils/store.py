@@ -0,0 +1,206 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Content addressed store shared by all download directories.
+
+Every verified artifact is kept once as objects/<sha256> and build
+directories hold hardlinks (or reflinks across filesystems) to it.
+Artifacts published without a checksum, like the keyrings and the
+signatures, are found through an index of the validators (ETag,
+Last-Modified and size) their URI had when they were stored.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import requests
+import subprocess
+
+from phabletutils import downloads
+from phabletutils import network
+from phabletutils import settings
+from phabletutils import verification
+
+log = logging.getLogger()
+
+
+def root():
+    '''Returns the directory holding the objects.'''
+    return downloads.tool_dir(settings.store_dir)
+
+
+def object_path(digest):
+    return os.path.join(root(), digest)
+
+
+def _index_path():
+    return os.path.join(root(), 'index.json')
+
+
+def _link(src, dst):
+    '''
+    Makes dst the same file as src, replacing dst atomically.
+
+    Returns False if dst had to be copied instead of hardlinked.
+    '''
+    tmp_path = '%s.%d.link' % (dst, os.getpid())
+    linked = True
+    try:
+        os.link(src, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        log.debug('Cannot hardlink %s, trying a reflink' % src)
+        subprocess.check_call(['cp', '--reflink=auto', src, tmp_path])
+        linked = False
+    os.rename(tmp_path, dst)
+    return linked
+
+
+def _references_path(obj):
+    return obj + '.refs'
+
+
+def _is_copy(path, digest):
+    return verification.cached_digest(path, 'sha256') == digest
+
+
+def _add_reference(obj, path):
+    '''Records that path holds a copy of obj instead of a link to it.'''
+    digest = os.path.basename(obj)
+
+    def update(references):
+        for key in references.keys():
+            if not _is_copy(key, digest):
+                del references[key]
+        references[os.path.abspath(path)] = True
+    downloads.update_json(_references_path(obj), update)
+
+
+def in_use(obj):
+    '''
+    Returns True if a build still holds the content of obj.
+
+    Hardlinks show up in the link count, copies made where hardlinks are
+    not possible are looked up in the references recorded for obj.
+    '''
+    if os.stat(obj).st_nlink > 1:
+        return True
+    digest = os.path.basename(obj)
+    references = downloads.load_json(_references_path(obj))
+    return any(_is_copy(path, digest) for path in references)
+
+
+def remove(obj):
+    '''Removes obj and the references recorded for it.'''
+    for path in (obj, _references_path(obj)):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def _validators(uri):
+    '''Returns what identifies the current content behind uri, if any.'''
+    try:
+        response = network.head(uri, allow_redirects=True,
+                                headers={'Accept-Encoding': 'identity'})
+    except requests.RequestException as e:
+        log.debug('Cannot get validators for %s: %s' % (uri, e))
+        return None
+    if response.status_code != 200:
+        return None
+    validators = [response.headers.get(h) for h in
+                  ('etag', 'last-modified', 'content-length')]
+    if not validators[0] and not validators[1]:
+        return None
+    return validators
+
+
+def lookup(uri):
+    '''Returns the digest stored for uri if its content did not change.'''
+    entry = downloads.load_json(_index_path()).get(uri)
+    if not entry or not os.path.exists(object_path(entry['digest'])):
+        return None
+    if _validators(uri) != entry['validators']:
+        return None
+    return entry['digest']
+
+
+def checkout(digest, path):
+    '''
+    Links the object for digest to path.
+
+    Returns False when the store does not hold a valid object for digest.
+    '''
+    obj = object_path(digest)
+    if not os.path.exists(obj):
+        return False
+    verified, _ = verification.verify(obj, digest, hashlib.sha256)
+    if not verified:
+        log.warning('Removing corrupted object %s' % obj)
+        remove(obj)
+        return False
+    linked = True
+    if not _same_file(obj, path):
+        log.info('Linking %s from the object store' % path)
+        linked = _link(obj, path)
+    verification.record_digest(path, 'sha256', digest)
+    if not linked:
+        _add_reference(obj, path)
+    return True
+
+
+def checkin(path, digest, uri=None):
+    '''
+    Stores the verified file at path under its sha256 digest.
+
+    If the store already holds that content path becomes a link to it.
+    With uri the object can later be found by lookup.
+    '''
+    obj = object_path(digest)
+    try:
+        linked = True
+        if os.path.exists(obj):
+            if not _same_file(obj, path):
+                log.debug('Deduplicating %s with %s' % (path, obj))
+                linked = _link(obj, path)
+        else:
+            linked = _link(path, obj)
+        verification.record_digest(obj, 'sha256', digest)
+        verification.record_digest(path, 'sha256', digest)
+        if not linked:
+            _add_reference(obj, path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning('Cannot store %s: %s' % (path, e))
+        return
+    if uri:
+        validators = _validators(uri)
+        if validators:
+            def update(index):
+                index[uri] = {'digest': digest, 'validators': validators}
+            downloads.update_json(_index_path(), update)
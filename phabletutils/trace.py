@@ -0,0 +1,141 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Records how long each phase of a run takes as nested spans.
+
+Nothing is recorded until start() is called. write() saves the spans in
+the Chrome trace event format, which chrome://tracing and Perfetto open,
+so runs can be compared side by side.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+log = logging.getLogger()
+
+_lock = threading.Lock()
+_local = threading.local()
+_events = None
+_threads = set()
+_origin = 0
+
+
+def start():
+    '''Starts recording spans, dropping the ones recorded before.'''
+    global _events, _origin
+    with _lock:
+        _events = []
+        _threads.clear()
+        _origin = time.time()
+
+
+def stop():
+    '''Stops recording spans and drops the ones recorded.'''
+    global _events
+    with _lock:
+        _events = None
+
+
+def enabled():
+    '''Returns True if spans are being recorded.'''
+    return _events is not None
+
+
+def _now():
+    return int((time.time() - _origin) * 10 ** 6)
+
+
+def _add(event):
+    thread = threading.current_thread()
+    event['pid'] = os.getpid()
+    event['tid'] = thread.ident
+    with _lock:
+        if _events is None:
+            return
+        if thread.ident not in _threads:
+            _threads.add(thread.ident)
+            _events.append({'name': 'thread_name', 'ph': 'M',
+                            'pid': event['pid'], 'tid': thread.ident,
+                            'args': {'name': thread.name}})
+        _events.append(event)
+
+
+def current():
+    '''
+    Returns the args of the innermost span open on this thread.
+
+    Code that moves data adds to them, e.g. the bytes it transferred.
+    '''
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else {}
+
+
+@contextmanager
+def span(name, category, **args):
+    '''
+    Records the time spent in the with block as the span name.
+
+    The args dict is yielded so the block can add what it learns, like
+    the bytes moved or a subprocess exit code. A span left by an error
+    records it.
+    '''
+    if not enabled():
+        yield args
+        return
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(args)
+    start_time = _now()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = str(e) or e.__class__.__name__
+        raise
+    finally:
+        _local.stack.pop()
+        _add({'name': name, 'cat': category, 'ph': 'X', 'ts': start_time,
+              'dur': _now() - start_time, 'args': args})
+
+
+def traced(category):
+    '''Decorates a function to record each call as a span.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(func.__name__, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write(path, metadata=None):
+    '''Writes the spans recorded so far to path as trace event JSON.'''
+    with _lock:
+        events = sorted(_events or [], key=lambda e: e.get('ts', -1))
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    if metadata:
+        trace['otherData'] = metadata
+    with open(path, 'w') as trace_file:
+        json.dump(trace, trace_file, default=str)
+    log.info('Wrote %d spans to %s' %
+             (len([e for e in events if e['ph'] == 'X']), path))
@@ -14,44 +14,237 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import collections
+import heapq
 import json
+import logging
 import os.path
+import re
+import time
 
 from phabletutils import downloads
+from phabletutils import network
 from phabletutils import resources
 from phabletutils import settings
 
+log = logging.getLogger()
+
+
+_separators = re.compile(r'[\s,]*')
+
+# What channel.ini says the device runs, channel and device may be None.
+Installed = collections.namedtuple('Installed', 'version channel device')
+
+
+def iter_array(chunks, key):
+    """
+    Yields the objects of the top level JSON array named key, decoding
+    them one by one from the chunks of a JSON document as they arrive.
+    """
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    marker = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        match = marker.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        buf = buf[-(len(key) + 16):]
+    else:
+        return
+    pos = 0
+    while True:
+        pos = _separators.match(buf, pos).end()
+        if buf[pos:pos + 1] == ']':
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('Truncated %s array' % key)
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+class Catalog(object):
+    """The images published for a device and channel, keyed by version"""
+
+    def __init__(self, images):
+        self.images = images
+        self._full = sorted([image for image in images
+                             if image['type'] == 'full'],
+                            key=lambda image: image['version'])
+        self._versions = [image['version'] for image in self._full]
+        self._deltas = {}
+        for image in images:
+            if image['type'] == 'delta':
+                self._deltas.setdefault(image['base'], []).append(image)
+
+    def latest(self):
+        """Returns the newest full image"""
+        return self.relative(0)
+
+    def relative(self, index):
+        """Returns the full image at relative index, 0 being the latest"""
+        if not self._full or index > 0 or -index >= len(self._full):
+            raise EnvironmentError('Revision %d is not available' % index)
+        return self._full[index - 1]
+
+    def full(self, version):
+        """Returns the full image for version or None"""
+        position = bisect.bisect_left(self._versions, version)
+        if position < len(self._versions) and \
+                self._versions[position] == version:
+            return self._full[position]
+        return None
+
+    def exact(self, version):
+        """Returns the full image for version"""
+        image = self.full(version)
+        if not image:
+            raise EnvironmentError('Version %d is not available' % version)
+        return image
+
+    def deltas(self, base):
+        """Returns the delta images that apply on top of base"""
+        return self._deltas.get(base, [])
+
+
+def _catalog_path(device, channel):
+    return os.path.join(downloads.metadata_dir(),
+                        'catalog-%s-%s.json' % (channel, device))
+
+
+def get_catalog(device, channel=None, ttl=None):
+    """
+    Returns the catalog of the system-image index for device.
+
+    The catalog is kept in the metadata cache and reused for ttl seconds,
+    then refreshed with a conditional request. A changed index is decoded
+    an image at a time while it downloads, which spares buffering the
+    document as text, but every image is still held in memory and the
+    whole catalog is rewritten to the cache.
+    """
+    channel = channel or settings.system_image_channel
+    ttl = downloads.metadata_ttl() if ttl is None else ttl
+    uri = '%s/%s/%s/index.json' % (settings.system_image_uri, channel,
+                                   device)
+    path = _catalog_path(device, channel)
+    cached = downloads.load_json(path)
+    if cached and time.time() - cached['fetched'] < ttl:
+        return Catalog(cached['images'])
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    response = network.get(uri, headers=headers, stream=True)
+    try:
+        if response.status_code == 304 and cached:
+            log.debug('%s is unchanged' % uri)
+            cached['fetched'] = time.time()
+            images = cached['images']
+        elif response.status_code == 200:
+            images = list(iter_array(response.iter_content(
+                settings.download_chunk_size), 'images'))
+            log.debug('%s lists %d images' % (uri, len(images)))
+            cached = {'uri': uri,
+                      'etag': response.headers.get('etag'),
+                      'last_modified': response.headers.get('last-modified'),
+                      'fetched': time.time(),
+                      'images': images}
+        else:
+            raise RuntimeError('%s cannot be retrieved' % uri)
+    finally:
+        response.close()
+    try:
+        downloads.update_json(path, lambda catalog: catalog.update(cached))
+    except (IOError, OSError) as e:
+        log.debug('Cannot cache %s: %s' % (uri, e))
+    return Catalog(images)
+
 
 def get_json_from_index(device, index):
     """Returns json index for device"""
-    index -= 1
-    json_index_uri = '%s/daily/%s/index.json' % \
-        (settings.system_image_uri, device)
-    json_content = downloads.get_content(json_index_uri)
-    if not json_content:
-        raise RuntimeError('%s cannot be retrieved' % json_index_uri)
-    json_index = json.loads(json_content)
-    json_dict = sorted([entry for entry in json_index['images']
-                       if entry['type'] == "full"],
-                       key=lambda entry: entry['version'])[index]
-    return json_dict
+    return get_catalog(device).relative(index)
+
+
+def image_size(image):
+    return sum(entry['size'] for entry in image['files'])
+
+
+def get_delta_chain(catalog, base, target):
+    """
+    Returns the delta images upgrading base to target that transfer the
+    fewest bytes, in the order they apply. Returns None when there is no
+    such chain or the full target image is not bigger.
+    """
+    full = catalog.full(target)
+    full_size = image_size(full) if full else None
+    # Dijkstra over versions, weighted by the bytes of each delta.
+    queue = [(0, base, [])]
+    done = set()
+    while queue:
+        cost, version, chain = heapq.heappop(queue)
+        if version == target:
+            if not chain or (full_size is not None and cost >= full_size):
+                return None
+            return chain
+        if version in done:
+            continue
+        done.add(version)
+        for image in catalog.deltas(version):
+            if image['version'] <= target and \
+                    image['version'] not in done:
+                heapq.heappush(queue, (cost + image_size(image),
+                                       image['version'], chain + [image]))
+    return None
+
+
+def installed_version(adb):
+    """
+    Returns the Installed system-image version, channel and device of
+    the device or None
+    """
+    for version_file in settings.system_image_version_files:
+        try:
+            content = adb.shell('cat %s' % version_file)
+        except EnvironmentError:
+            continue
+        keys = dict(re.findall(r'^(\w+):[ \t]*(\S*)', content, re.MULTILINE))
+        if keys.get('build_number', '').isdigit():
+            return Installed(int(keys['build_number']),
+                             keys.get('channel') or None,
+                             keys.get('device') or None)
+    return None
 
 
 def get_files(download_dir, uri, json):
-    files = {}
+    return get_delta_files(download_dir, uri, [json])
+
+
+def get_delta_files(download_dir, uri, images):
+    """Returns the files and update commands applying images in order"""
     command_part = ''
     files = []
-    for entry in sorted(json['files'], key=lambda entry: entry['order']):
-        filename = entry['path'].split("/")[-1]
-        signame = entry['signature'].split("/")[-1]
-        f = resources.SignedFile(
-            file_path=os.path.join(download_dir, filename),
-            sig_path=os.path.join(download_dir, signame),
-            file_uri='%s%s' % (uri, entry['path']),
-            sig_uri='%s%s' % (uri, entry['signature']),
-            file_hash=entry['checksum'])
-        files.append(f)
-        command_part += 'update %s %s\n' % (filename, signame)
+    for image in images:
+        for entry in sorted(image['files'], key=lambda entry: entry['order']):
+            filename = entry['path'].split("/")[-1]
+            signame = entry['signature'].split("/")[-1]
+            f = resources.SignedFile(
+                file_path=os.path.join(download_dir, filename),
+                sig_path=os.path.join(download_dir, signame),
+                file_uri='%s%s' % (uri, entry['path']),
+                sig_uri='%s%s' % (uri, entry['signature']),
+                file_hash=entry['checksum'])
+            files.append(f)
+            command_part += 'update %s %s\n' % (filename, signame)
     for keyring in ('image-master', 'image-signing'):
         filename = '%s.tar.xz' % keyring
         signame = '%s.asc' % filename
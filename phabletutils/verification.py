@@ -0,0 +1,144 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Verification of downloaded artifacts."""
+
+import logging
+import multiprocessing
+import os
+import os.path
+
+from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import workers
+
+log = logging.getLogger()
+
+
+def hash_name(sum_method):
+    '''Returns the name digests of sum_method are recorded under.'''
+    return sum_method().name.lower()
+
+
+def _cache_path(file_path):
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)),
+                        settings.verification_cache)
+
+
+def _identity(file_path):
+    '''Returns what identifies the current contents of a file on disk.'''
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    # ctime is left out as it changes whenever the object store adds a
+    # hardlink to the file.
+    return {'inode': stat.st_ino,
+            'size': stat.st_size,
+            'mtime_ns': int(stat.st_mtime * 10 ** 9)}
+
+
+def cached_digest(file_path, algorithm):
+    '''
+    Returns the digest recorded for file_path with algorithm if the file
+    is unchanged since it was recorded, None otherwise.
+    '''
+    identity = _identity(file_path)
+    if not identity:
+        return None
+    entry = downloads.load_json(_cache_path(file_path)).get(
+        os.path.basename(file_path))
+    if not entry or entry['identity'] != identity:
+        return None
+    return entry['digests'].get(algorithm)
+
+
+def record_digest(file_path, algorithm, digest):
+    '''Records the verified digest for the current contents of file_path.'''
+    identity = _identity(file_path)
+    if not identity:
+        return
+    cache_path = _cache_path(file_path)
+    name = os.path.basename(file_path)
+    directory = os.path.dirname(cache_path)
+
+    def update(cache):
+        entry = cache.get(name)
+        if not entry or entry['identity'] != identity:
+            entry = {'identity': identity, 'digests': {}}
+        entry['digests'][algorithm] = digest
+        cache[name] = entry
+        for key in cache.keys():
+            if not os.path.exists(os.path.join(directory, key)):
+                del cache[key]
+
+    try:
+        downloads.update_json(cache_path, update)
+    except (IOError, OSError) as e:
+        log.debug('Cannot record digest for %s: %s' % (file_path, e))
+
+
+def digest(file_path, sum_method):
+    '''Returns the hex digest of file_path, reading it only if needed.'''
+    algorithm = hash_name(sum_method)
+    file_digest = cached_digest(file_path, algorithm)
+    if file_digest:
+        return file_digest
+    file_sum = downloads.hash_file(file_path, sum_method)
+    if not file_sum:
+        raise EnvironmentError('%s is not on disk' % file_path)
+    record_digest(file_path, algorithm, file_sum.hexdigest())
+    return file_sum.hexdigest()
+
+
+def verify(file_path, file_hash, sum_method):
+    '''
+    Returns a (verified, partial_sum) tuple for file_path.
+
+    The file is only read when the verification cache has no digest for
+    its current identity. partial_sum is the (size, mtime, hash object)
+    of a file that does not match, so a resumed download can reuse it.
+    '''
+    algorithm = hash_name(sum_method)
+    digest = cached_digest(file_path, algorithm)
+    if digest == file_hash:
+        log.debug('%s verified from cache' % file_path)
+        return True, None
+    log.debug('Verifying file: %s against: %s' % (file_path, file_hash))
+    file_sum = downloads.hash_file(file_path, sum_method)
+    if not file_sum:
+        return False, None
+    if file_sum.hexdigest() == file_hash:
+        record_digest(file_path, algorithm, file_hash)
+        return True, None
+    stat = os.stat(file_path)
+    return False, (stat.st_size, stat.st_mtime, file_sum)
+
+
+def verify_files(files, concurrency=None):
+    '''
+    Verifies all files that still need it concurrently.
+
+    hashlib releases the interpreter lock while hashing, so one thread
+    per CPU core keeps every core busy.
+    '''
+    pending = [f for f in files if f.check and f.hash]
+    if not pending:
+        return
+    concurrency = concurrency or multiprocessing.cpu_count()
+    log.debug('Verifying %d files on %d threads' %
+              (len(pending), concurrency))
+    workers.run(lambda f: f.verify(), pending, concurrency)
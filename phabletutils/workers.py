@@ -0,0 +1,229 @@
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bounded pool of worker threads for concurrent jobs."""
+
+import logging
+import Queue
+import threading
+
+log = logging.getLogger()
+
+# Python 2 cannot interrupt a thread blocked on a lock without a timeout,
+# so a KeyboardInterrupt would not reach the main thread while it waits
+# for workers. Blocking waits are cut into slices of this many seconds.
+_wait_slice = 0.5
+
+
+def wait(ready, idle=None):
+    '''
+    Calls ready with a timeout until it returns something other than
+    None and returns that.
+
+    idle is called whenever ready timed out; what it raises ends the wait.
+    '''
+    while True:
+        result = ready(_wait_slice)
+        if result is not None:
+            return result
+        if idle:
+            idle()
+
+
+def get(queue, idle=None):
+    '''Returns the next item of queue, waiting as long as it takes.'''
+    def ready(timeout):
+        try:
+            return (queue.get(True, timeout),)
+        except Queue.Empty:
+            return None
+    return wait(ready, idle)[0]
+
+
+def join(threads, idle=None):
+    '''Returns once all threads finished.'''
+    alive = list(threads)
+
+    def ready(timeout):
+        alive[0].join(timeout)
+        alive[:] = [t for t in alive if t.is_alive()]
+        return True if not alive else None
+    if alive:
+        wait(ready, idle)
+
+
+def run(func, items, concurrency, cancel=None):
+    '''
+    Calls func for every item on at most concurrency threads.
+
+    Returns the results in the order of items. The first exception stops
+    any further scheduling, sets cancel so running jobs can bail out and
+    is raised once the running jobs are done.
+    '''
+    items = list(items)
+    if cancel is None:
+        cancel = threading.Event()
+    results = [None] * len(items)
+    errors = []
+    if not concurrency or concurrency <= 1 or len(items) <= 1:
+        for index, item in enumerate(items):
+            try:
+                results[index] = func(item)
+            except Exception:
+                cancel.set()
+                raise
+        return results
+
+    pending = Queue.Queue()
+    for entry in enumerate(items):
+        pending.put(entry)
+
+    def worker():
+        while not cancel.is_set():
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                if not cancel.is_set():
+                    log.debug('Job for %s failed: %s' % (item, e))
+                    errors.append(e)
+                cancel.set()
+
+    threads = []
+    for i in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        join(threads)
+    except KeyboardInterrupt:
+        cancel.set()
+        raise
+    if errors:
+        raise errors[0]
+    return results
+
+
+def imap(func, items, concurrency, cancel=None):
+    '''
+    Calls func for every item on at most concurrency threads.
+
+    Yields the results in the order of items, each as soon as it and the
+    ones before it are done. The first exception is raised where its
+    result would have been yielded. Closing the generator early stops
+    any further scheduling. If cancel is set before every result is in,
+    EnvironmentError is raised where the first missing one would be.
+    '''
+    items = list(items)
+    if cancel is None:
+        cancel = threading.Event()
+    if not concurrency or concurrency <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pending = Queue.Queue()
+    for entry in enumerate(items):
+        pending.put(entry)
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not (cancel.is_set() or stop.is_set()):
+            try:
+                index, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((index, func(item), None))
+            except Exception as e:
+                done.put((index, None, e))
+
+    for i in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    def check():
+        if cancel.is_set():
+            raise EnvironmentError('Cancelled with %d of %d results left' %
+                                   (len(items) - index, len(items)))
+
+    ready = {}
+    try:
+        for index in range(len(items)):
+            while index not in ready:
+                ready_index, result, error = get(done, check)
+                ready[ready_index] = (result, error)
+            result, error = ready.pop(index)
+            if error:
+                raise error
+            yield result
+    finally:
+        stop.set()
+
+
+def prefetch(iterable, depth):
+    '''
+    Yields the items of iterable while a thread reads up to depth ahead.
+
+    Lets a slow producer, like a download, overlap with a slow consumer.
+    An exception raised by iterable is raised where its item would have
+    been yielded. Closing the generator early stops the thread.
+    '''
+    ready = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                ready.put(entry, True, 0.5)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((None, StopIteration()))
+        except Exception as e:
+            put((None, e))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = get(ready)
+            if isinstance(error, StopIteration):
+                return
+            if error:
+                raise error
+            yield item
+    finally:
+        stop.set()
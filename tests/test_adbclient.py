@@ -0,0 +1,618 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.adbclient against a fake adb server."""
+
+import hashlib
+import os
+import shlex
+import shutil
+import SocketServer
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+
+from mock import MagicMock
+from mock import patch
+from os import path
+from phabletutils import adbclient
+from phabletutils import network
+from phabletutils import projects
+from phabletutils import resources
+from phabletutils.device import AndroidBridge
+from testtools import TestCase
+from testtools.matchers import Contains
+from testtools.matchers import Equals
+from testtools.matchers import FileContains
+from testtools.matchers import FileExists
+from testtools.matchers import HasLength
+from testtools.matchers import Not
+from tests.test_downloads import _Handler
+from tests.test_downloads import _Server
+
+
+class _AdbHandler(SocketServer.BaseRequestHandler):
+    '''Speaks enough of the adb server protocol for the client.'''
+
+    def recv(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def okay(self):
+        self.request.sendall('OKAY')
+
+    def fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        try:
+            while True:
+                service = self.recv(int(self.recv(4), 16))
+                server.services.append(service)
+                if not self.service(service):
+                    return
+        except EOFError:
+            pass
+
+    def service(self, service):
+        '''Handles service, returns True while more requests may follow.'''
+        server = self.server
+        if service == 'host:version':
+            self.okay()
+            self.request.sendall('0004001f')
+        elif service == 'host:devices':
+            listing = ''.join('%s\t%s\n' % d for d in server.devices)
+            self.okay()
+            self.request.sendall('%04x%s' % (len(listing), listing))
+        elif service.startswith('host:transport'):
+            serial = service.partition('host:transport:')[2]
+            if serial and serial not in dict(server.devices):
+                self.fail('device not found')
+                return False
+            self.okay()
+            return True
+        elif service.endswith(':wait-for-any-device') or \
+                service.startswith('host-serial:') and ':forward:' in service:
+            self.okay()
+            self.okay()
+        elif service.startswith('shell:'):
+            self.okay()
+            self.request.sendall(server.shell(service[len('shell:'):]))
+        elif service.startswith(('reboot:', 'root:')):
+            self.okay()
+        elif service == 'sync:':
+            self.okay()
+            self.sync()
+        else:
+            self.fail('unknown service')
+        return False
+
+    def sync(self):
+        server = self.server
+        while True:
+            command, length = struct.unpack('<4sI', self.recv(8))
+            if command == 'QUIT':
+                return
+            if command == 'STAT':
+                name = self.recv(length)
+                if name in server.files:
+                    mode = stat.S_IFREG | 0644
+                    size = len(server.files[name])
+                elif name in server.dirs:
+                    mode, size = stat.S_IFDIR | 0755, 0
+                else:
+                    mode = size = 0
+                self.request.sendall(struct.pack('<4sIII', 'STAT', mode,
+                                                 size, 0))
+            elif command == 'SEND':
+                name = self.recv(length).rsplit(',', 1)[0]
+                data = ''
+                while True:
+                    chunk_id, length = struct.unpack('<4sI', self.recv(8))
+                    if chunk_id == 'DONE':
+                        break
+                    data += self.recv(length)
+                if name.startswith('/readonly/'):
+                    message = 'Read-only file system'
+                    self.request.sendall(struct.pack(
+                        '<4sI', 'FAIL', len(message)) + message)
+                    return
+                server.files[name] = data
+                server.sent.append(name)
+                self.request.sendall(struct.pack('<4sI', 'OKAY', 0))
+            elif command == 'RECV':
+                name = self.recv(length)
+                if name not in server.files:
+                    message = 'No such file or directory'
+                    self.request.sendall(struct.pack(
+                        '<4sI', 'FAIL', len(message)) + message)
+                    return
+                data = server.files[name]
+                for offset in range(0, len(data), adbclient.SYNC_DATA_MAX):
+                    chunk = data[offset:offset + adbclient.SYNC_DATA_MAX]
+                    self.request.sendall(struct.pack(
+                        '<4sI', 'DATA', len(chunk)) + chunk)
+                self.request.sendall(struct.pack('<4sI', 'DONE', 0))
+
+
+class FakeAdbServer(SocketServer.ThreadingTCPServer):
+    '''An adb server on localhost with one device and a file system.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 _AdbHandler)
+        self.connections = 0
+        self.services = []
+        self.devices = [('0123456789ABCDEF', 'device'),
+                        ('FEDCBA9876543210', 'offline')]
+        self.files = {}
+        self.sent = []
+        self.dirs = set(['/cache/recovery', '/sdcard'])
+        self.shell = lambda command: 'ran %s\r\n' % command
+
+    def use_sh(self):
+        '''Runs shell commands with sh, only its builtins are found.'''
+
+        def shell(command):
+            if command.startswith('md5sum '):
+                return self.md5sum(shlex.split(command)[1:])
+            if command.startswith('rm -f '):
+                self.files.pop(shlex.split(command)[2], None)
+                return ''
+            process = subprocess.Popen(['/bin/sh', '-c', command],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT,
+                                       env={'PATH': '/nonexistent'})
+            # Like the pty adbd runs the shell in.
+            return process.communicate()[0].replace('\n', '\r\n')
+        self.shell = shell
+
+    def md5sum(self, paths):
+        lines = []
+        for name in paths:
+            if name in self.files:
+                digest = hashlib.md5(self.files[name]).hexdigest()
+                lines.append('%s  %s\r\n' % (digest, name))
+        return ''.join(lines)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestAdbClient(TestCase):
+
+    serial = '0123456789ABCDEF'
+
+    def setUp(self):
+        super(TestAdbClient, self).setUp()
+        self.server = FakeAdbServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        patcher = patch('phabletutils.settings.adb_server_port',
+                        self.server.server_address[1])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.client = adbclient.Client(self.serial)
+        self.addCleanup(self.client.close)
+
+    def make_file(self, name, content):
+        file_path = path.join(self.tmp_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(content)
+        return file_path
+
+    def testShell(self):
+        # when
+        output = self.client.shell('getprop ro.product.device')
+        # then
+        self.assertThat(output, Equals('ran getprop ro.product.device\r\n'))
+        self.assertThat(self.server.services,
+                        Equals(['host:transport:%s' % self.serial,
+                                'shell:getprop ro.product.device']))
+
+    def testShellQuotesArguments(self):
+        # when
+        self.client.shell(['chown', '-R', 'phablet', '/home/my dir; rm'])
+        # then
+        self.assertThat(self.server.services[-1],
+                        Equals("shell:chown -R phablet '/home/my dir; rm'"))
+
+    def testUnknownDevice(self):
+        # given
+        client = adbclient.Client('missing')
+        # then
+        self.assertRaises(EnvironmentError, client.shell, 'true')
+
+    def testDevices(self):
+        # when
+        devices = self.client.devices()
+        # then
+        self.assertThat(devices, Equals(self.server.devices))
+
+    def testPushIntoDirectory(self):
+        # given
+        src = self.make_file('ubuntu.tar.xz', 'x' * 200000)
+        # when
+        sent = self.client.push(src, '/cache/recovery')
+        # then
+        self.assertThat(sent, Equals(200000))
+        self.assertThat(self.server.files['/cache/recovery/ubuntu.tar.xz'],
+                        Equals('x' * 200000))
+
+    def testPushesShareOneConnection(self):
+        # given
+        files = [self.make_file('file%d' % i, str(i)) for i in range(3)]
+        # when
+        for src in files:
+            self.client.push(src, '/cache/recovery/')
+        # then
+        self.assertThat(self.server.connections, Equals(1))
+        self.assertThat(self.server.services.count('sync:'), Equals(1))
+
+    def testPushDirectory(self):
+        # given
+        os.mkdir(path.join(self.tmp_dir, 'tests'))
+        self.make_file('tests/a.py', 'a')
+        # when
+        self.client.push(self.tmp_dir, '/home/phablet/autopilot')
+        # then
+        self.assertThat(self.server.files,
+                        Equals({'/home/phablet/autopilot/tests/a.py': 'a'}))
+
+    def testPushFailure(self):
+        # given
+        src = self.make_file('file', 'content')
+        # then
+        self.assertRaises(EnvironmentError, self.client.push, src,
+                          '/readonly/file')
+        self.client.push(src, '/cache/recovery/')
+        self.assertThat(self.server.files, Equals(
+            {'/cache/recovery/file': 'content'}))
+
+    def testPull(self):
+        # given
+        self.server.files['/etc/channel.ini'] = 'y' * 100000
+        # when
+        size = self.client.pull('/etc/channel.ini', self.tmp_dir)
+        # then
+        self.assertThat(size, Equals(100000))
+        self.assertThat(path.join(self.tmp_dir, 'channel.ini'),
+                        FileContains('y' * 100000))
+
+    def testPullMissing(self):
+        # given
+        dst = path.join(self.tmp_dir, 'missing')
+        # then
+        self.assertRaises(EnvironmentError, self.client.pull, '/missing',
+                          dst)
+        self.assertThat(dst, Not(FileExists()))
+
+    def testReconnectsAfterReboot(self):
+        # given
+        src = self.make_file('file', 'content')
+        self.client.push(src, '/cache/recovery/')
+        # when
+        self.client.reboot('recovery')
+        self.client.push(src, '/sdcard/')
+        # then
+        self.assertThat(self.server.services,
+                        Equals(['host:transport:%s' % self.serial, 'sync:',
+                                'host:transport:%s' % self.serial,
+                                'reboot:recovery',
+                                'host:transport:%s' % self.serial, 'sync:']))
+
+    def testForward(self):
+        # when
+        self.client.forward('tcp:8888', 'tcp:22')
+        # then
+        self.assertThat(self.server.services, Equals(
+            ['host-serial:%s:forward:tcp:8888;tcp:22' % self.serial]))
+
+    def testAndroidBridge(self):
+        # given
+        adb = AndroidBridge(self.serial)
+        # when
+        adb.chroot('id -u phablet')
+        # then
+        self.assertThat(self.server.services[-1], Equals(
+            'shell:PATH=/usr/sbin:/usr/bin:/sbin:/bin system/xbin/chroot '
+            'data/ubuntu id -u phablet'))
+
+    @patch('phabletutils.device.call')
+    def testStartSkipsRunningServer(self, call_mock):
+        # when
+        AndroidBridge().start()
+        # then
+        self.assertThat(call_mock.called, Equals(False))
+
+
+class TestAdbBatch(TestCase):
+
+    serial = '0123456789ABCDEF'
+
+    def setUp(self):
+        super(TestAdbBatch, self).setUp()
+        self.server = FakeAdbServer()
+        self.server.use_sh()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        for patcher in (patch('phabletutils.settings.adb_server_port',
+                              self.server.server_address[1]),
+                        patch('phabletutils.states.wait')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.adb = AndroidBridge(self.serial)
+
+    def testStatusAndOutputPerCommand(self):
+        # given
+        batch = self.adb.batch()
+        batch.shell('echo first')
+        batch.shell('echo -n partial; exit 3')
+        batch.shell(['echo', 'a b'])
+        # when
+        results = batch.run()
+        # then
+        self.assertThat([(r.status, r.output) for r in results],
+                        Equals([(0, 'first\n'), (3, 'partial'),
+                                (0, 'a b\n')]))
+        self.assertThat(self.server.services.count('sync:') +
+                        len([s for s in self.server.services
+                             if s.startswith('shell:')]), Equals(1))
+
+    def testCommandsDoNotShareState(self):
+        # given
+        with self.adb.batch() as batch:
+            batch.shell('cd /; x=1')
+            batch.shell('echo "$x" $(pwd)')
+        # then
+        self.assertThat(batch.results[1].output,
+                        Equals(' %s\n' % os.getcwd()))
+
+    def testSystemInstallRoundTrips(self):
+        # given
+        files = []
+        for name in ('ubuntu.tar.xz', 'device.tar.xz'):
+            file_path = path.join(self.tmp_dir, name)
+            open(file_path, 'w').close()
+            open(file_path + '.asc', 'w').close()
+            files.append(resources.SignedFile(
+                file_path=file_path, file_uri=None, file_hash=None,
+                sig_path=file_path + '.asc', sig_uri=None))
+        recovery = resources.File(file_path='recovery.img', file_uri=None,
+                                  check=False)
+        project = projects.UbuntuTouchSystem(
+            file_list=files, recovery=recovery, command_part='')
+        # when
+        project.install(self.adb, MagicMock())
+        # then
+        shells = [s for s in self.server.services
+                  if s.startswith('shell:') and 'getprop' not in s]
+        self.assertThat(shells, HasLength(1))
+        self.assertThat(self.server.services.count('sync:'), Equals(1))
+        self.assertThat(sorted(self.server.files), Equals(
+            ['/cache/recovery/device.tar.xz',
+             '/cache/recovery/device.tar.xz.asc',
+             '/cache/recovery/ubuntu.tar.xz',
+             '/cache/recovery/ubuntu.tar.xz.asc',
+             '/cache/recovery/ubuntu_command']))
+
+
+class TestIncrementalPush(TestCase):
+
+    serial = '0123456789ABCDEF'
+
+    def setUp(self):
+        super(TestIncrementalPush, self).setUp()
+        self.server = FakeAdbServer()
+        self.server.use_sh()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        for patcher in (patch('phabletutils.settings.adb_server_port',
+                              self.server.server_address[1]),
+                        patch('phabletutils.states.wait')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = adbclient.Client(self.serial)
+        self.addCleanup(self.client.close)
+
+    def make_file(self, name, content):
+        file_path = path.join(self.tmp_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(content)
+        return file_path
+
+    def testSkipsUnchanged(self):
+        # given
+        same = self.make_file('same', 'same')
+        changed = self.make_file('changed', 'new!')
+        missing = self.make_file('missing', 'missing')
+        self.server.files['/cache/recovery/same'] = 'same'
+        self.server.files['/cache/recovery/changed'] = 'old!'
+        # when
+        sent = self.client.push_all(
+            [(f, '/cache/recovery/') for f in (same, changed, missing)],
+            incremental=True)
+        # then
+        self.assertThat(self.server.sent, Equals(
+            ['/cache/recovery/changed', '/cache/recovery/missing']))
+        self.assertThat(sent, Equals(len('new!') + len('missing')))
+        md5sums = [s for s in self.server.services
+                   if s.startswith('shell:md5sum')]
+        self.assertThat(md5sums, Equals(
+            ['shell:md5sum /cache/recovery/same /cache/recovery/changed']))
+
+    def testNoChecksumsWhenSizesDiffer(self):
+        # given
+        src = self.make_file('file', 'content')
+        self.server.files['/sdcard/file'] = 'other content'
+        # when
+        self.client.push(src, '/sdcard/', incremental=True)
+        # then
+        self.assertThat(self.server.sent, Equals(['/sdcard/file']))
+        self.assertThat([s for s in self.server.services
+                         if s.startswith('shell:')], HasLength(0))
+
+    def testPushesWithoutMd5sum(self):
+        # given
+        src = self.make_file('file', 'content')
+        self.server.files['/sdcard/file'] = 'content'
+        self.server.md5sum = lambda paths: 'md5sum: not found\r\n'
+        # when
+        self.client.push(src, '/sdcard/', incremental=True)
+        # then
+        self.assertThat(self.server.sent, Equals(['/sdcard/file']))
+
+    def testReinstallSendsOnlyCommandFile(self):
+        # given
+        payload = self.make_file('ubuntu.tar.xz', 'x' * 1000)
+        self.make_file('ubuntu.tar.xz.asc', 'signature')
+        project = projects.UbuntuTouchSystem(
+            file_list=[resources.SignedFile(
+                file_path=payload, file_uri=None, file_hash=None,
+                sig_path=payload + '.asc', sig_uri=None)],
+            recovery=resources.File(file_path='recovery.img', file_uri=None,
+                                    check=False),
+            command_part='')
+        adb = AndroidBridge(self.serial)
+        project.install(adb, MagicMock())
+        del self.server.sent[:]
+        # when
+        project.install(adb, MagicMock())
+        # then
+        self.assertThat(self.server.sent,
+                        Equals(['/cache/recovery/ubuntu_command']))
+        spared = '/cache/recovery|/cache/recovery/ubuntu.tar.xz|' \
+                 '/cache/recovery/ubuntu.tar.xz.asc)'
+        self.assertThat([s for s in self.server.services if spared in s],
+                        HasLength(2))
+
+
+class TestStreamInstall(TestCase):
+
+    serial = '0123456789ABCDEF'
+
+    def setUp(self):
+        super(TestStreamInstall, self).setUp()
+        network.reset()
+        self.addCleanup(network.reset)
+        self.server = FakeAdbServer()
+        self.server.use_sh()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.http = _Server(('127.0.0.1', 0), _Handler)
+        self.http.content = os.urandom(300 * 1024)
+        self.http.ranges = False
+        self.http.served = 0
+        thread = threading.Thread(target=self.http.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.http.server_close)
+        self.addCleanup(self.http.shutdown)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        for patcher in (patch('phabletutils.settings.adb_server_port',
+                              self.server.server_address[1]),
+                        patch('phabletutils.states.wait'),
+                        patch('phabletutils.store.root',
+                              return_value=self.tmp_dir),
+                        patch('phabletutils.downloads.download_sig',
+                              return_value=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def project(self, file_hash):
+        self.payload = path.join(self.tmp_dir, 'ubuntu.tar.xz')
+        open(self.payload + '.asc', 'w').close()
+        entry = resources.SignedFile(
+            file_path=self.payload,
+            file_uri='http://127.0.0.1:%d/ubuntu.tar.xz' %
+            self.http.server_address[1],
+            file_hash=file_hash, sig_path=self.payload + '.asc',
+            sig_uri=None)
+        return projects.UbuntuTouchSystem(
+            file_list=[entry], command_part='',
+            recovery=resources.File(file_path='recovery.img', file_uri=None,
+                                    check=False))
+
+    def testStreamsToDevice(self):
+        # given
+        project = self.project(hashlib.sha256(self.http.content).hexdigest())
+        # when
+        project.download(stream=True)
+        project.install(AndroidBridge(self.serial), MagicMock())
+        # then
+        self.assertThat(self.payload, Not(FileExists()))
+        self.assertThat(self.server.files['/cache/recovery/ubuntu.tar.xz'],
+                        Equals(self.http.content))
+
+    def testRejectsMismatch(self):
+        # given
+        project = self.project(hashlib.sha256('other').hexdigest())
+        project.download(stream=True)
+        # then
+        self.assertRaises(EnvironmentError, project.install,
+                          AndroidBridge(self.serial), MagicMock())
+        self.assertThat(self.server.files,
+                        Not(Contains('/cache/recovery/ubuntu.tar.xz')))
+
+    def testProvisionPushesAsFetched(self):
+        # given
+        project = self.project(hashlib.sha256(self.http.content).hexdigest())
+        fastboot = MagicMock()
+        # when
+        project.provision(AndroidBridge(self.serial), fastboot)
+        # then
+        with open(self.payload) as f:
+            self.assertThat(f.read(), Equals(self.http.content))
+        self.assertThat(self.server.files['/cache/recovery/ubuntu.tar.xz'],
+                        Equals(self.http.content))
+        self.assertThat(self.server.files,
+                        Contains('/cache/recovery/ubuntu_command'))
+        fastboot.flash.assert_called_once_with('recovery', 'recovery.img')
+
+    def testProvisionStreams(self):
+        # given
+        project = self.project(hashlib.sha256(self.http.content).hexdigest())
+        # when
+        project.provision(AndroidBridge(self.serial), MagicMock(),
+                          stream=True)
+        # then
+        self.assertThat(self.payload, Not(FileExists()))
+        self.assertThat(self.server.files['/cache/recovery/ubuntu.tar.xz'],
+                        Equals(self.http.content))
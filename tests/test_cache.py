@@ -0,0 +1,205 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.cache."""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from mock import patch
+from os import path
+from phabletutils import cache
+from phabletutils import settings
+from phabletutils import store
+from testtools import TestCase
+from testtools.matchers import DirExists
+from testtools.matchers import Equals
+from testtools.matchers import FileExists
+from testtools.matchers import Not
+
+
+class TestCacheCollect(TestCase):
+
+    def setUp(self):
+        super(TestCacheCollect, self).setUp()
+        self.cache_root = tempfile.mkdtemp()
+        self.store_dir = path.join(self.cache_root, settings.store_dir)
+        os.mkdir(self.store_dir)
+
+    def tearDown(self):
+        super(TestCacheCollect, self).tearDown()
+        shutil.rmtree(self.cache_root)
+
+    def make_build(self, name, size, last_used):
+        build = path.join(self.cache_root, 'ubuntu-touch', name)
+        os.makedirs(build)
+        with open(path.join(build, 'system.img'), 'w') as f:
+            f.write('x' * size)
+        stamp = path.join(build, settings.cache_stamp)
+        open(stamp, 'w').close()
+        os.utime(stamp, (last_used, last_used))
+        return build
+
+    def testEvictsLeastRecentlyUsed(self):
+        # given
+        now = time.time()
+        old = self.make_build('20130801', 1000, now - 300)
+        middle = self.make_build('20130802', 1000, now - 200)
+        new = self.make_build('20130803', 1000, now - 100)
+        # when
+        cache.collect(2500, self.cache_root)
+        # then
+        self.assertThat(old, Not(DirExists()))
+        self.assertThat(middle, DirExists())
+        self.assertThat(new, DirExists())
+
+    def testKeepsHeldBuilds(self):
+        # given
+        now = time.time()
+        old = self.make_build('20130801', 1000, now - 300)
+        new = self.make_build('20130802', 1000, now - 100)
+        stamp = open(path.join(old, settings.cache_stamp), 'a')
+        self.addCleanup(stamp.close)
+        fcntl.flock(stamp, fcntl.LOCK_SH)
+        # when
+        cache.collect(1500, self.cache_root)
+        # then
+        self.assertThat(old, DirExists())
+        self.assertThat(new, Not(DirExists()))
+
+    def testHardlinksCountedOnce(self):
+        # given
+        build = self.make_build('20130801', 1000, time.time())
+        os.link(path.join(build, 'system.img'),
+                path.join(self.store_dir, 'a' * 64))
+        # when
+        usage = cache.usage(self.cache_root)
+        # then
+        self.assertThat(usage, Equals(1000))
+
+    def testEvictionReleasesObjects(self):
+        # given
+        build = self.make_build('20130801', 1000, time.time())
+        obj = path.join(self.store_dir, 'a' * 64)
+        os.link(path.join(build, 'system.img'), obj)
+        # when
+        freed = cache.collect(0, self.cache_root)
+        # then
+        self.assertThat(obj, Not(FileExists()))
+        self.assertThat(freed, Equals(1000))
+
+    def testKeepsCopiedObjects(self):
+        # given
+        build = self.make_build('20130801', 1000, time.time())
+        image = path.join(build, 'system.img')
+        with open(image, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        obj = path.join(self.store_dir, digest)
+        shutil.copy(image, obj)
+        with patch('phabletutils.store.root', return_value=self.store_dir), \
+                patch('phabletutils.store.os.link',
+                      side_effect=OSError(errno.EXDEV, 'cross-device')):
+            store.checkout(digest, image)
+        # when
+        cache.collect(None, self.cache_root)
+        # then
+        self.assertThat(obj, FileExists())
+        # when
+        os.unlink(image)
+        cache.collect(None, self.cache_root)
+        # then
+        self.assertThat(obj, Not(FileExists()))
+        self.assertThat(obj + '.refs', Not(FileExists()))
+
+    def testRemovesStaleTemporaryDownloads(self):
+        # given
+        tmp_dir = path.join(self.cache_root, settings.cache_tmp_dir)
+        os.mkdir(tmp_dir)
+        stale = path.join(tmp_dir, 'tmpabc')
+        fresh = path.join(tmp_dir, 'tmpdef')
+        for tmp_file in (stale, fresh):
+            open(tmp_file, 'w').close()
+        old = time.time() - settings.cache_stale_age - 10
+        os.utime(stale, (old, old))
+        # when
+        cache.collect(None, self.cache_root)
+        # then
+        self.assertThat(stale, Not(FileExists()))
+        self.assertThat(fresh, FileExists())
+
+    def testHoldsStampWhileRemoving(self):
+        # given
+        build = self.make_build('20130801', 1000, time.time())
+        stamp_path = path.join(build, settings.cache_stamp)
+        blocked = []
+        remove = cache._remove
+
+        def check_and_remove(directory):
+            with open(stamp_path, 'a') as stamp:
+                try:
+                    fcntl.flock(stamp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except IOError:
+                    blocked.append(directory)
+            remove(directory)
+        # when
+        with patch('phabletutils.cache._remove', check_and_remove):
+            cache.collect(0, self.cache_root)
+        # then
+        self.assertThat(blocked, Equals([build]))
+        self.assertThat(build, Not(DirExists()))
+
+    def testEvictsCommunityFiles(self):
+        # given
+        device_dir = path.join(self.cache_root, 'community', 'mako')
+        os.makedirs(path.join(device_dir, 'config', '.bzr'))
+        for name in ('config/license', 'config/.bzr/branch', 'device.zip',
+                     'ubuntu.zip', '.license_accept'):
+            with open(path.join(device_dir, name), 'w') as f:
+                f.write('x' * 100)
+        # when
+        cache.collect(0, self.cache_root)
+        # then
+        self.assertThat(sorted(os.listdir(device_dir)),
+                        Equals(['.license_accept', 'config']))
+        self.assertThat(path.join(device_dir, 'config', 'license'),
+                        FileExists())
+
+    def testUseAfterEviction(self):
+        # given
+        build = self.make_build('20130801', 1000, time.time())
+        self.addCleanup(cache._held.clear)
+        flock = fcntl.flock
+        evicted = []
+
+        def evict_first(stamp, operation):
+            # The collector wins the race for the stamp.
+            if operation == fcntl.LOCK_SH and not evicted:
+                evicted.append(cache._evict(build))
+            flock(stamp, operation)
+        # when
+        with patch('phabletutils.cache.fcntl.flock', evict_first), \
+                patch('phabletutils.downloads.setup_download_directory',
+                      os.makedirs):
+            cache.use([build])
+        # then
+        self.assertThat(evicted, Equals([True]))
+        self.assertThat(path.join(build, 'system.img'), Not(FileExists()))
+        self.assertThat(path.join(build, settings.cache_stamp), FileExists())
+        self.assertThat(cache._held, Equals({build: cache._held[build]}))
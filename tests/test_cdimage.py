@@ -15,8 +15,14 @@
 
 """Unit tests for phabletutils.environment."""
 
+import shutil
+import tempfile
+import threading
+
+from mock import MagicMock
 from mock import patch
 from phabletutils import cdimage
+from phabletutils import listing
 from testtools import TestCase
 from testtools.matchers import Equals
 
@@ -25,6 +31,15 @@ from testtools.matchers import Equals
 class TestCdimageLinks(TestCase):
     def setUp(self):
         super(TestCdimageLinks, self).setUp()
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        # rsync is only asked when HTTP cannot resolve the link.
+        for patcher in (patch('phabletutils.downloads.metadata_dir',
+                              return_value=self.metadata_dir),
+                        patch('phabletutils.cdimage._resolve_pointer',
+                              return_value=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.cdimage_uri = 'http://cdimage.ubuntu.com/ubuntu-touch/daily-build'
         self.rsync_uri_part = 'rsync://cdimage.ubuntu.com/cdimage/' \
                               'ubuntu-touch/daily-build'
@@ -53,3 +68,98 @@ class TestCdimageLinks(TestCase):
         # then
         self.assertThat(build, Equals(target_build))
         process_mock.assert_called_once_with(self.rsync_call)
+
+
+class TestCdimagePointers(TestCase):
+
+    entries = [listing.Entry('20130714', 1373796120, None, True),
+               listing.Entry('20130714.1', 1373796120, None, True),
+               listing.Entry('20130715', 1373882520, None, True),
+               listing.Entry('current', 1373796120, None, True),
+               listing.Entry('pending', 1373882520, None, True)]
+
+    def setUp(self):
+        super(TestCdimagePointers, self).setUp()
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        self.cdimage_uri = 'http://cdimage.ubuntu.com/ubuntu-touch/daily'
+        self.sums = {'20130714': '"a"', '20130714.1': '"b"',
+                     '20130715': '"c"', 'current': '"b"', 'pending': '"c"'}
+        for patcher in (patch('phabletutils.downloads.metadata_dir',
+                              return_value=self.metadata_dir),
+                        patch('phabletutils.listing.get_entries',
+                              return_value=self.entries),
+                        patch('phabletutils.network.head',
+                              side_effect=self.head)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def head(self, uri, **kwargs):
+        response = MagicMock(status_code=200)
+        response.headers = {'etag': self.sums[uri.split('/')[-2]]}
+        return response
+
+    @patch('subprocess.check_output')
+    def testCurrentOverHttp(self, process_mock):
+        # when
+        build = cdimage.get_build(self.cdimage_uri)
+        # then
+        self.assertThat(build, Equals('20130714.1'))
+        self.assertThat(process_mock.call_count, Equals(0))
+
+    @patch('subprocess.check_output')
+    def testPendingOverHttp(self, process_mock):
+        # when
+        build = cdimage.get_build(self.cdimage_uri, pending=True)
+        # then
+        self.assertThat(build, Equals('20130715'))
+        self.assertThat(process_mock.call_count, Equals(0))
+
+    def testCached(self):
+        # given
+        cdimage.get_build(self.cdimage_uri)
+        self.sums['current'] = '"c"'
+        # when
+        build = cdimage.get_build(self.cdimage_uri)
+        # then
+        self.assertThat(build, Equals('20130714.1'))
+
+
+class TestCdimageCrawl(TestCase):
+
+    listings = {'http://cdimage': ['saucy', 'trusty'],
+                'http://cdimage/saucy': ['20130714', '20130715'],
+                'http://cdimage/trusty': []}
+
+    def setUp(self):
+        super(TestCdimageCrawl, self).setUp()
+        self.unblock = threading.Event()
+        patcher = patch('phabletutils.cdimage._get_elements',
+                        side_effect=self.get_elements)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_elements(self, uri):
+        if uri.endswith('trusty'):
+            self.unblock.wait(5)
+        return self.listings[uri.rstrip('/')]
+
+    def testIncremental(self):
+        # when
+        crawl = cdimage.iter_available_revisions('http://cdimage')
+        first = next(crawl)
+        self.unblock.set()
+        rest = list(crawl)
+        # then
+        self.assertThat(first['revisions'],
+                        Equals(['20130714', '20130715']))
+        self.assertThat([r['release'] for r in rest], Equals(['trusty']))
+
+    def testLatestSkipsEmptyRelease(self):
+        # given
+        self.unblock.set()
+        # when
+        release, revision = cdimage.get_latest_revision('http://cdimage')
+        # then
+        self.assertThat(release, Equals('saucy'))
+        self.assertThat(revision, Equals('20130715'))
@@ -0,0 +1,399 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.downloads."""
+
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+
+from mock import patch
+from os import path
+from phabletutils import downloads
+from phabletutils import network
+from phabletutils import resources
+from phabletutils import settings
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import FileExists
+from testtools.matchers import GreaterThan
+from testtools.matchers import Is
+from testtools.matchers import Not
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    requests = 0
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves server.content honouring Range only if server.ranges.'''
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self):
+        content = self.server.content
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            end = int(match.group(2)) + 1 if match.group(2) else len(content)
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end - 1, len(content)))
+        else:
+            start, end = 0, len(content)
+            self.send_response(200)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        return content[start:end]
+
+    def do_HEAD(self):
+        self._headers()
+
+    def do_GET(self):
+        self.server.requests += 1
+        body = self._headers()
+        if body:
+            self.server.served += len(body)
+            self.wfile.write(body)
+
+
+class TestDownload(TestCase):
+
+    def setUp(self):
+        super(TestDownload, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.path = path.join(self.download_dir, 'ubuntu.tar.xz')
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.content = os.urandom(64 * 1024)
+        self.server.ranges = True
+        self.server.served = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.uri = 'http://127.0.0.1:%d/ubuntu.tar.xz' % \
+            self.server.server_address[1]
+        patcher = patch.object(settings, 'download_segment_min_size', 4096)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(TestDownload, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.download_dir)
+
+    def content(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def testSegmentedDownload(self):
+        # when
+        downloads._download(self.uri, self.path)
+        # then
+        self.assertThat(self.content(), Equals(self.server.content))
+        self.assertThat(self.path + '.segments', Not(FileExists()))
+        self.assertThat(self.server.served,
+                        Equals(len(self.server.content)))
+
+    def testSegmentedResume(self):
+        # given
+        size = len(self.server.content)
+        with open(self.path, 'wb') as f:
+            f.write(self.server.content[:1024])
+            f.write('\0' * (size - 1024))
+        with open(self.path + '.segments', 'w') as f:
+            json.dump({'size': size,
+                       'segments': [[0, size / 2, 1024],
+                                    [size / 2, size, size]]}, f)
+        with open(self.path, 'r+b') as f:
+            f.seek(size / 2)
+            f.write(self.server.content[size / 2:])
+        # when
+        downloads._download(self.uri, self.path)
+        # then
+        self.assertThat(self.content(), Equals(self.server.content))
+        self.assertThat(self.server.served, Equals(size / 2 - 1024))
+
+    def testSequentialPrefixResume(self):
+        # given
+        with open(self.path, 'wb') as f:
+            f.write(self.server.content[:10000])
+        # when
+        downloads._download(self.uri, self.path)
+        # then
+        self.assertThat(self.content(), Equals(self.server.content))
+        self.assertThat(self.server.served,
+                        Equals(len(self.server.content) - 10000))
+
+    def testNoRangeSupport(self):
+        # given
+        self.server.ranges = False
+        with open(self.path, 'wb') as f:
+            f.write('stale partial content')
+        # when
+        downloads._download(self.uri, self.path)
+        # then
+        self.assertThat(self.content(), Equals(self.server.content))
+
+    def testLinkedFileLeftIntact(self):
+        # given
+        linked = path.join(self.download_dir, 'object')
+        for ranges in (True, False):
+            self.server.ranges = ranges
+            with open(linked, 'wb') as f:
+                f.write('previous build')
+            if path.exists(self.path):
+                os.unlink(self.path)
+            os.link(linked, self.path)
+            # when
+            downloads._download(self.uri, self.path)
+            # then
+            self.assertThat(self.content(), Equals(self.server.content))
+            with open(linked, 'rb') as f:
+                self.assertThat(f.read(), Equals('previous build'))
+
+    def testHashAfterLinkedFileReplaced(self):
+        # given
+        linked = path.join(self.download_dir, 'object')
+        with open(linked, 'wb') as f:
+            f.write('0' * len(self.server.content))
+        os.link(linked, self.path)
+        artifact = self.artifact()
+        positions = []
+        original = downloads._download_from
+
+        def download_from(uri, path, cancel, stream_hash, **kwargs):
+            positions.append(stream_hash.position)
+            original(uri, path, cancel, stream_hash, **kwargs)
+        # when
+        with patch.object(downloads, '_download_from', download_from):
+            downloads.download(artifact)
+        # then
+        self.assertThat(positions, Equals([0]))
+        self.assertThat(artifact.verified, Is(True))
+
+    def testSegmentRetry(self):
+        # given
+        original = downloads._SegmentedDownload._fetch
+        failures = []
+
+        def flaky_fetch(download, segment):
+            if not failures:
+                failures.append(segment)
+                raise IOError('connection reset')
+            return original(download, segment)
+
+        # when
+        with patch.object(downloads._SegmentedDownload, '_fetch',
+                          flaky_fetch), \
+                patch.object(downloads, '_retry_wait'):
+            downloads._download(self.uri, self.path)
+        # then
+        self.assertThat(len(failures), GreaterThan(0))
+        self.assertThat(self.content(), Equals(self.server.content))
+
+    def artifact(self):
+        artifact = resources.File(
+            file_uri=self.uri, file_path=self.path,
+            file_hash=hashlib.sha256(self.server.content).hexdigest())
+        artifact.verify()
+        return artifact
+
+    def testHashWhileDownloading(self):
+        # given
+        artifact = self.artifact()
+        # when
+        with patch('phabletutils.downloads.hash_file') as hash_file_mock:
+            downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(True))
+        self.assertThat(hash_file_mock.called, Is(False))
+
+    def testHashWhileResuming(self):
+        # given
+        with open(self.path, 'wb') as f:
+            f.write(self.server.content[:10000])
+        artifact = self.artifact()
+        # when
+        with patch('phabletutils.downloads.hash_file') as hash_file_mock:
+            downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(True))
+        self.assertThat(hash_file_mock.called, Is(False))
+        self.assertThat(self.server.served,
+                        Equals(len(self.server.content) - 10000))
+
+    def testHashAfterInterruptedSegments(self):
+        # given
+        size = len(self.server.content)
+        original = downloads._SegmentedDownload._fetch
+        finished = threading.Event()
+
+        def fail_last(download, segment):
+            if segment.end != size:
+                original(download, segment)
+                if all(s.done for s in download._segments
+                       if s.end != size):
+                    finished.set()
+                return
+            finished.wait(5)
+            raise IOError('connection reset')
+        with patch.object(downloads._SegmentedDownload, '_fetch',
+                          fail_last), \
+                patch.object(downloads, '_retry_wait',
+                             side_effect=EnvironmentError('gave up')):
+            self.assertRaises(EnvironmentError, downloads._download,
+                              self.uri, self.path)
+        self.assertThat(self.path + '.segments', FileExists())
+        artifact = self.artifact()
+        # when
+        downloads.download(artifact)
+        # then
+        self.assertThat(self.content(), Equals(self.server.content))
+        self.assertThat(artifact.verified, Is(True))
+
+    def testHashWhileStreaming(self):
+        # given
+        self.server.ranges = False
+        artifact = self.artifact()
+        # when
+        downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(True))
+
+    def testHashMismatch(self):
+        # given
+        artifact = resources.File(file_uri=self.uri, file_path=self.path,
+                                  file_hash='0' * 64)
+        # when
+        downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(False))
+
+
+class TestGetContent(TestCase):
+
+    def setUp(self):
+        super(TestGetContent, self).setUp()
+        network.reset()
+        self.addCleanup(network.reset)
+        self.metadata_dir = tempfile.mkdtemp()
+        patcher = patch('phabletutils.downloads.metadata_dir',
+                        return_value=self.metadata_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.content = 'abc  ubuntu.tar.xz\n'
+        self.server.ranges = False
+        self.server.served = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.uri = 'http://127.0.0.1:%d/SHA256SUMS' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        super(TestGetContent, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.metadata_dir)
+
+    def testFreshFromCache(self):
+        # given
+        downloads.get_content(self.uri, ttl=60)
+        # when
+        content = downloads.get_content(self.uri, ttl=60)
+        # then
+        self.assertThat(content, Equals(self.server.content))
+        self.assertThat(self.server.requests, Equals(1))
+
+    def testRevalidated(self):
+        # given
+        downloads.get_content(self.uri, ttl=0)
+        # when
+        content = downloads.get_content(self.uri, ttl=0)
+        # then
+        self.assertThat(content, Equals(self.server.content))
+        self.assertThat(self.server.requests, Equals(2))
+        self.assertThat(self.server.served, Equals(len(content)))
+
+    def testChangedContent(self):
+        # given
+        downloads.get_content(self.uri, ttl=0)
+        self.server.content = 'def  ubuntu.tar.xz\n'
+        # when
+        content = downloads.get_content(self.uri, ttl=0)
+        # then
+        self.assertThat(content, Equals('def  ubuntu.tar.xz\n'))
+
+    @patch.object(settings, 'http_retries', 0)
+    def testStaleWhenUnreachable(self):
+        # given
+        downloads.get_content(self.uri, ttl=0)
+        self.server.shutdown()
+        self.server.server_close()
+        # when
+        content = downloads.get_content(self.uri, ttl=0)
+        # then
+        self.assertThat(content, Equals('abc  ubuntu.tar.xz\n'))
+
+
+class TestToolDir(TestCase):
+
+    def setUp(self):
+        super(TestToolDir, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.download_dir)
+        for patcher in (patch.object(downloads, '_download_dir', None),
+                        patch.object(downloads, '_created_dirs', set())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('phabletutils.downloads.log')
+    def testResolvedOnce(self, log_mock):
+        # given
+        with patch('phabletutils.downloads._xdg_download_dir',
+                   return_value=self.download_dir) as xdg_mock:
+            # when
+            objects = downloads.tool_dir(settings.store_dir)
+            downloads.tool_dir(settings.store_dir)
+            downloads.tool_dir(settings.cache_tmp_dir)
+        # then
+        self.assertThat(objects, Equals(path.join(
+            self.download_dir, settings.download_dir, settings.store_dir)))
+        self.assertThat(path.isdir(objects), Equals(True))
+        self.assertThat(xdg_mock.call_count, Equals(1))
+        self.assertThat(log_mock.method_calls, Equals([]))
@@ -0,0 +1,133 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.fleet."""
+
+import argparse
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+from mock import MagicMock
+from mock import patch
+from os import path
+from phabletutils import fleet
+from testtools import TestCase
+from testtools.matchers import Contains
+from testtools.matchers import Equals
+from testtools.matchers import Not
+
+
+class TestFleet(TestCase):
+
+    models = {'A1': 'mako', 'A2': 'mako', 'B1': 'maguro'}
+
+    def setUp(self):
+        super(TestFleet, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.projects = {}
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        for patcher in (patch('phabletutils.fleet.log_dir',
+                              return_value=self.log_dir),
+                        patch('phabletutils.fleet.AndroidBridge'),
+                        patch('phabletutils.fleet.Fastboot'),
+                        patch('phabletutils.cache.use'),
+                        patch('phabletutils.environment.detect_device',
+                              side_effect=lambda s, d: self.models[s])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        super(TestFleet, self).tearDown()
+        shutil.rmtree(self.log_dir)
+
+    def args(self, serials=None, all_devices=False, download_only=False):
+        return argparse.Namespace(serials=serials, all_devices=all_devices,
+                                  download_only=download_only, device=None,
+                                  jobs=1, limit_rate=None, func=self.project)
+
+    def project(self, args):
+        project = MagicMock()
+        project.install.side_effect = self.install
+        self.projects[args.device] = project
+        return project
+
+    def install(self, adb, fastboot):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        logging.getLogger().info('installing')
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+
+    def testDownloadsOncePerModel(self):
+        # given
+        args = self.args(serials=['A1', 'A2', 'B1'])
+        # when
+        failed = fleet.run(args)
+        # then
+        self.assertThat(failed, Equals(0))
+        self.assertThat(sorted(self.projects), Equals(['maguro', 'mako']))
+        for project in self.projects.values():
+            self.assertThat(project.download.call_count, Equals(1))
+        self.assertThat(self.projects['mako'].install.call_count, Equals(2))
+        self.assertThat(self.peak, Equals(3))
+
+    @patch('phabletutils.device.attached_devices',
+           return_value=['A1', 'B1'])
+    def testAllDevices(self, attached_mock):
+        # given
+        args = self.args(all_devices=True)
+        # when
+        fleet.run(args)
+        # then
+        self.assertThat(sorted(self.projects), Equals(['maguro', 'mako']))
+
+    def testFailureDoesNotStopOthers(self):
+        # given
+        args = self.args(serials=['A1', 'B1'])
+
+        def install(adb, fastboot):
+            raise EnvironmentError('flash failed')
+
+        def project(args):
+            project = self.project(args)
+            if args.device == 'mako':
+                project.install.side_effect = install
+            return project
+        args.func = project
+        # when
+        failed = fleet.run(args)
+        # then
+        self.assertThat(failed, Equals(1))
+        self.assertThat(self.projects['maguro'].install.call_count,
+                        Equals(1))
+
+    def testPerDeviceLogs(self):
+        # given
+        args = self.args(serials=['A1', 'B1'])
+        # when
+        fleet.run(args)
+        # then
+        with open(path.join(self.log_dir, 'A1.log')) as f:
+            content = f.read()
+        self.assertThat(content, Contains('[A1] installing'))
+        self.assertThat(content, Not(Contains('[B1]')))
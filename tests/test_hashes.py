@@ -0,0 +1,97 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.hashes."""
+
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from os import path
+from phabletutils import hashes
+from phabletutils import settings
+from testtools import TestCase
+from testtools.matchers import Equals
+
+
+def _md5sum(uri):
+    name = uri.rsplit('/', 1)[-1][:-len('.md5sum')]
+    return '%s  %s\n' % (name.split('.')[0] * 4, name)
+
+
+@patch('phabletutils.downloads.get_content', side_effect=_md5sum)
+class TestHashManifest(TestCase):
+
+    def setUp(self):
+        super(TestHashManifest, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.uri = 'http://cdimage.ubuntu.com/ubuntu-touch/20130714'
+        self.artifacts = ['boot.img.md5sum', 'system.img.md5sum']
+
+    def tearDown(self):
+        super(TestHashManifest, self).tearDown()
+        shutil.rmtree(self.download_dir)
+
+    def testMerged(self, get_content_mock):
+        # when
+        hash_dict = hashes.load_hashes(self.uri, self.artifacts,
+                                       self.download_dir)
+        # then
+        self.assertThat(hash_dict, Equals({'boot.img': 'boot' * 4,
+                                           'system.img': 'system' * 4}))
+        self.assertThat(get_content_mock.call_count, Equals(2))
+
+    def testServedFromManifest(self, get_content_mock):
+        # given
+        hashes.load_hashes(self.uri, self.artifacts, self.download_dir)
+        # when
+        hash_dict = hashes.load_hashes(self.uri, self.artifacts,
+                                       self.download_dir)
+        # then
+        self.assertThat(hash_dict['system.img'], Equals('system' * 4))
+        self.assertThat(get_content_mock.call_count, Equals(2))
+
+    def testRefresh(self, get_content_mock):
+        # given
+        hashes.load_hashes(self.uri, self.artifacts, self.download_dir)
+        # when
+        hashes.load_hashes(self.uri, self.artifacts, self.download_dir,
+                           refresh=True)
+        # then
+        self.assertThat(get_content_mock.call_count, Equals(4))
+
+    def testLocalChecksumFiles(self, get_content_mock):
+        # given
+        with open(path.join(self.download_dir, 'SHA256SUMS'), 'w') as f:
+            f.write('abc *ubuntu.zip\n')
+        # when
+        hash_dict = hashes.load_hashes(None, ['SHA256SUMS'],
+                                       self.download_dir)
+        # then
+        self.assertThat(hash_dict, Equals({'ubuntu.zip': 'abc'}))
+        self.assertThat(get_content_mock.call_count, Equals(0))
+
+    def testChecksumFilesKept(self, get_content_mock):
+        # given
+        expected = hashes.load_hashes(self.uri, self.artifacts,
+                                      self.download_dir)
+        os.unlink(path.join(self.download_dir, settings.hash_manifest))
+        # when
+        hash_dict = hashes.load_hashes(None, self.artifacts,
+                                       self.download_dir)
+        # then
+        self.assertThat(hash_dict, Equals(expected))
+        self.assertThat(get_content_mock.call_count, Equals(2))
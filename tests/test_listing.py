@@ -0,0 +1,130 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.listing."""
+
+import shutil
+import tempfile
+import threading
+
+from mock import patch
+from phabletutils import listing
+from testtools import TestCase
+from testtools.matchers import Equals
+from tests.test_downloads import _Handler
+from tests.test_downloads import _Server
+
+TABLE = '''<html><body><h1>Index of /ubuntu-touch/daily-preinstalled</h1>
+<table><tr><th><img src="/icons/blank.gif" alt="[ICO]"></th>
+<th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last
+modified</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+<tr><th colspan="5"><hr></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[DIR]"></td><td><a
+href="/ubuntu-touch/">Parent Directory</a></td><td>&nbsp;</td><td
+align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a
+href="20130714/">20130714/</a></td><td align="right">14-Jul-2013 10:02
+</td><td align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td><td><a
+href="SHA256SUMS">SHA256SUMS</a></td><td align="right">2013-07-15 08:30
+</td><td align="right">1.5K</td></tr>
+<tr><th colspan="5"><hr></th></tr>
+</table><address>Apache Server at cdimage.ubuntu.com</address></body></html>
+'''
+
+PRE = '''<html><body><h1>Index of /ubuntu-touch</h1><pre><img
+src="/icons/blank.gif" alt="Icon "> <a href="?C=N;O=D">Name</a>
+<hr><img src="/icons/back.gif" alt="[DIR]"> <a href="/">Parent Directory</a>
+<img src="/icons/folder.gif" alt="[DIR]"> <a href="saucy/">saucy/</a>      \
+      14-Jul-2013 10:02    -
+<img src="/icons/unknown.gif" alt="[   ]"> <a href="touch%2Bmako.img">\
+touch+mako.img</a>  15-Jul-2013 08:30  512M
+<hr></pre></body></html>
+'''
+
+LIST = '''<html><body><h1>Index of /ubuntu-touch</h1><ul>
+<li><a href="/"> Parent Directory</a></li>
+<li><a href="saucy/"> saucy/</a></li>
+<li><a href="trusty/"> trusty/</a></li>
+</ul></body></html>
+'''
+
+
+class TestListing(TestCase):
+
+    def parse(self, page):
+        # One byte at a time, as a slow connection would deliver it.
+        return list(listing.parse(iter(page)))
+
+    def testTable(self):
+        # when
+        entries = self.parse(TABLE)
+        # then
+        self.assertThat(entries, Equals([
+            listing.Entry('20130714', 1373796120, None, True),
+            listing.Entry('SHA256SUMS', 1373877000, 1536, False)]))
+
+    def testPre(self):
+        # when
+        entries = self.parse(PRE)
+        # then
+        self.assertThat(entries, Equals([
+            listing.Entry('saucy', 1373796120, None, True),
+            listing.Entry('touch+mako.img', 1373877000, 512 * 1024 ** 2,
+                          False)]))
+
+    def testList(self):
+        # when
+        entries = self.parse(LIST)
+        # then
+        self.assertThat([e.name for e in entries],
+                        Equals(['saucy', 'trusty']))
+        self.assertThat(entries[0].mtime, Equals(None))
+
+
+class TestGetEntries(TestCase):
+
+    def setUp(self):
+        super(TestGetEntries, self).setUp()
+        self.metadata_dir = tempfile.mkdtemp()
+        patcher = patch('phabletutils.downloads.metadata_dir',
+                        return_value=self.metadata_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.content = LIST
+        self.server.ranges = False
+        self.server.served = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.uri = 'http://127.0.0.1:%d/ubuntu-touch/' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        super(TestGetEntries, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.metadata_dir)
+
+    def testCached(self):
+        # given
+        listing.get_entries(self.uri)
+        # when
+        entries = listing.get_entries(self.uri)
+        # then
+        self.assertThat([e.name for e in entries],
+                        Equals(['saucy', 'trusty']))
+        self.assertThat(self.server.requests, Equals(1))
@@ -0,0 +1,97 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.network."""
+
+import BaseHTTPServer
+import threading
+
+from mock import patch
+from phabletutils import network
+from phabletutils import settings
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import HasLength
+from tests.test_downloads import _Server
+
+
+class _KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers with server.statuses in turn, then 200.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+
+class TestNetwork(TestCase):
+
+    def setUp(self):
+        super(TestNetwork, self).setUp()
+        network.reset()
+        self.addCleanup(network.reset)
+        self.server = _Server(('127.0.0.1', 0), _KeepAliveHandler)
+        self.server.clients = set()
+        self.server.statuses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.uri = 'http://127.0.0.1:%d/index.json' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        super(TestNetwork, self).tearDown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testConnectionReused(self):
+        # when
+        for i in range(3):
+            network.get(self.uri)
+        # then
+        self.assertThat(self.server.clients, HasLength(1))
+
+    @patch.object(settings, 'http_backoff', 0)
+    def testRetriesServerErrors(self):
+        # given
+        self.server.statuses = [503, 502]
+        # when
+        response = network.get(self.uri)
+        # then
+        self.assertThat(response.status_code, Equals(200))
+
+    def testNoRetriesWhenAsked(self):
+        # given
+        self.server.statuses = [503]
+        # when
+        response = network.get(self.uri, retry=False)
+        # then
+        self.assertThat(response.status_code, Equals(503))
+
+    @patch('requests.Session.get')
+    def testDefaultTimeout(self, get_mock):
+        # when
+        network.get(self.uri)
+        # then
+        self.assertThat(get_mock.call_args[1]['timeout'],
+                        Equals(settings.http_timeout))
@@ -0,0 +1,347 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.projects."""
+
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+
+from contextlib import closing
+from mock import MagicMock
+from mock import patch
+from os import path
+from phabletutils import projects
+from phabletutils import resources
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import HasLength
+
+
+class TestProjectDownload(TestCase):
+
+    def setUp(self):
+        super(TestProjectDownload, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.content = 'ubuntu'
+        self.files = [resources.SignedFile(
+            file_path=path.join(self.download_dir, 'file%d' % i),
+            file_uri='http://localhost/file%d' % i,
+            file_hash=hashlib.sha256(self.content).hexdigest(),
+            sig_path=path.join(self.download_dir, 'file%d.asc' % i),
+            sig_uri='http://localhost/file%d.asc' % i) for i in range(4)]
+        self.project = projects.UbuntuTouchSystem(
+            file_list=self.files, recovery=None, command_part='')
+        self.running = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.store_dir = tempfile.mkdtemp()
+        for patcher in (patch('phabletutils.store.root',
+                              return_value=self.store_dir),
+                        patch('phabletutils.store._validators',
+                              return_value=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super(TestProjectDownload, self).tearDown()
+        shutil.rmtree(self.download_dir)
+        shutil.rmtree(self.store_dir)
+
+    def fake_download(self, content):
+        def download(entry, cancel=None):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(0.05)
+            with open(entry.path, 'w') as f:
+                f.write(content)
+            entry.record_digest(hashlib.sha256(content).hexdigest())
+            with self.lock:
+                self.running -= 1
+            return hashlib.sha256(content).hexdigest()
+        return download
+
+    def device(self):
+        '''
+        Returns a mock device with its methods created up front, as a mock
+        creating them on first use can lose calls made by parallel steps.
+        '''
+        device = MagicMock()
+        for method in ('batch', 'boot', 'flash', 'push', 'push_stream',
+                       'reboot', 'shell'):
+            getattr(device, method)
+        return device
+
+    def fail_after(self, reboot):
+        '''Returns a download failing a while after reboot was called.'''
+        rebooted = threading.Event()
+        reboot.side_effect = lambda **kwargs: rebooted.set()
+
+        def download(entry, cancel=None):
+            rebooted.wait(5)
+            time.sleep(0.2)
+            raise EnvironmentError('network down')
+        return download
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testConcurrentDownload(self, download_mock, sig_mock):
+        # given
+        sig_mock.return_value = None
+        download_mock.side_effect = self.fake_download(self.content)
+        # when
+        self.project.download(concurrency=4)
+        # then
+        self.assertThat(self.peak, Equals(4))
+        self.assertThat(sig_mock.call_args_list, HasLength(4))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testConcurrencyLimit(self, download_mock, sig_mock):
+        # given
+        sig_mock.return_value = None
+        download_mock.side_effect = self.fake_download(self.content)
+        # when
+        self.project.download(concurrency=2)
+        # then
+        self.assertThat(self.peak, Equals(2))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testStreamedLeftForInstall(self, download_mock, sig_mock):
+        # given
+        sig_mock.return_value = None
+        # when
+        self.project.download(stream=True)
+        # then
+        self.assertThat(download_mock.call_count, Equals(0))
+        self.assertThat(sig_mock.call_args_list, HasLength(4))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testChecksumFailsFast(self, download_mock, sig_mock):
+        # given
+        download_mock.side_effect = self.fake_download('corrupted')
+        # when
+        self.assertRaises(EnvironmentError, self.project.download, 2)
+        # then
+        self.assertThat(download_mock.call_count < 4, Equals(True))
+        self.assertThat(sig_mock.call_args_list, HasLength(0))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testRebootOverlapsDownload(self, download_mock, sig_mock):
+        # given
+        sig_mock.return_value = None
+        rebooted = threading.Event()
+        adb = self.device()
+        adb.reboot.side_effect = lambda **kwargs: rebooted.set()
+        fetch = self.fake_download(self.content)
+
+        def download(entry, cancel=None):
+            rebooted.wait(5)
+            return fetch(entry, cancel)
+        download_mock.side_effect = download
+        project = projects.UbuntuTouchSystem(
+            file_list=self.files, command_part='',
+            recovery=resources.File(file_path='recovery.img', file_uri=None,
+                                    check=False))
+        # when
+        project.provision(adb, self.device())
+        # then
+        self.assertThat(rebooted.is_set(), Equals(True))
+        self.assertThat(adb.reboot.call_args_list[0][1],
+                        Equals({'recovery': True}))
+        self.assertThat(adb.push.call_args_list, HasLength(9))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testFailedDownloadKeepsDevice(self, download_mock, sig_mock):
+        # given
+        sig_mock.return_value = None
+        adb = self.device()
+        download_mock.side_effect = self.fail_after(adb.reboot)
+        project = projects.UbuntuTouchSystem(
+            file_list=self.files, command_part='',
+            recovery=resources.File(file_path='recovery.img', file_uri=None,
+                                    check=False))
+        # then
+        self.assertRaises(EnvironmentError, project.provision, adb,
+                          self.device())
+        self.assertThat(adb.batch.call_args_list, HasLength(0))
+        self.assertThat(adb.push.call_args_list, HasLength(0))
+
+    @patch('phabletutils.downloads.download_sig')
+    @patch('phabletutils.downloads.download')
+    def testFailedDownloadFlashesNothing(self, download_mock, sig_mock):
+        # given
+        adb = self.device()
+        fail = self.fail_after(adb.reboot)
+
+        def download(entry, cancel=None):
+            if entry.path.endswith('ubuntu.zip'):
+                fail(entry, cancel)
+        download_mock.side_effect = download
+        images = [resources.File(
+            file_path=path.join(self.download_dir, name),
+            file_uri='http://localhost/%s' % name, check=False)
+            for name in ('boot.img', 'system.img', 'recovery.img')]
+        ubuntu = resources.File(
+            file_path=path.join(self.download_dir, 'ubuntu.zip'),
+            file_uri='http://localhost/ubuntu.zip')
+        project = projects.UbuntuTouchBootstrap(*images, ubuntu=ubuntu)
+        fastboot = self.device()
+        # then
+        self.assertRaises(EnvironmentError, project.provision, adb, fastboot)
+        self.assertThat(fastboot.flash.call_args_list, HasLength(0))
+
+    @patch('phabletutils.projects.log')
+    def testNoWarningsWhileBuildingSteps(self, log_mock):
+        # given
+        images = [resources.File(
+            file_path=path.join(self.download_dir, name),
+            file_uri='http://localhost/%s' % name, check=False)
+            for name in ('boot.img', 'system.img', 'recovery.img',
+                         'ubuntu.zip')]
+        bootstrap = projects.UbuntuTouchBootstrap(*images)
+        recovery = projects.UbuntuTouchRecovery(*images[2:])
+        # when
+        for project in (bootstrap, recovery):
+            project.step_graph(self.device(), self.device())
+        # then
+        self.assertThat(log_mock.warning.call_args_list, HasLength(0))
+
+
+class TestObjectStore(TestCase):
+
+    def setUp(self):
+        super(TestObjectStore, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.build_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        patcher = patch('phabletutils.store.root',
+                        return_value=self.store_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.content = 'ubuntu'
+        self.hash = hashlib.sha256(self.content).hexdigest()
+
+    def tearDown(self):
+        super(TestObjectStore, self).tearDown()
+        for directory in [self.store_dir] + self.build_dirs:
+            shutil.rmtree(directory)
+
+    def project(self, build_dir, file_hash=None):
+        system = resources.File(
+            file_path=path.join(build_dir, 'system.img'),
+            file_uri='http://localhost/system.img',
+            file_hash=file_hash or self.hash)
+        return projects.Android(boot=None, system=system), system
+
+    def fake_download(self, entry, cancel=None):
+        with open(entry.path, 'w') as f:
+            f.write(self.content)
+        entry.record_digest(hashlib.sha256(self.content).hexdigest())
+        return hashlib.sha256(self.content).hexdigest()
+
+    @patch('phabletutils.downloads.download')
+    def testDownloadedOnce(self, download_mock):
+        # given
+        download_mock.side_effect = self.fake_download
+        first, first_file = self.project(self.build_dirs[0])
+        second, second_file = self.project(self.build_dirs[1])
+        # when
+        first.download()
+        second.download()
+        # then
+        self.assertThat(download_mock.call_count, Equals(1))
+        self.assertThat(second_file.verified, Equals(True))
+        self.assertThat(path.samefile(first_file.path, second_file.path),
+                        Equals(True))
+
+    @patch('phabletutils.store._validators')
+    @patch('phabletutils.downloads.download')
+    def testUnhashedLookedUpByValidators(self, download_mock,
+                                         validators_mock):
+        # given
+        download_mock.side_effect = self.fake_download
+        validators_mock.return_value = ['"etag"', None, '6']
+        first = projects.Android(boot=None, system=resources.File(
+            file_path=path.join(self.build_dirs[0], 'image-master.tar.xz'),
+            file_uri='http://localhost/image-master.tar.xz'))
+        second_file = resources.File(
+            file_path=path.join(self.build_dirs[1], 'image-master.tar.xz'),
+            file_uri='http://localhost/image-master.tar.xz')
+        second = projects.Android(boot=None, system=second_file)
+        # when
+        first.download()
+        second.download()
+        # then
+        self.assertThat(download_mock.call_count, Equals(1))
+        with open(second_file.path) as f:
+            self.assertThat(f.read(), Equals(self.content))
+
+
+class TestGunzip(TestCase):
+
+    def setUp(self):
+        super(TestGunzip, self).setUp()
+        self.build_dir = tempfile.mkdtemp()
+        self.source = path.join(self.build_dir, 'system.img.gz')
+        self.write_source('system' * 1024)
+
+    def tearDown(self):
+        super(TestGunzip, self).tearDown()
+        shutil.rmtree(self.build_dir)
+
+    def write_source(self, content):
+        with closing(gzip.open(self.source, 'wb')) as f:
+            f.write(content)
+
+    @patch('phabletutils.settings.gunzip_chunk_size', 1000)
+    def testStreamsInChunks(self):
+        # given
+        content = 'system' * 1024
+        # when
+        with patch('shutil.copyfileobj',
+                   wraps=shutil.copyfileobj) as copy_mock:
+            target = projects.gunzip(self.source)
+        # then
+        self.assertThat(copy_mock.call_args[0][2], Equals(1000))
+        with open(target) as f:
+            self.assertThat(f.read(), Equals(content))
+
+    def testReusedForSameSource(self):
+        # given
+        projects.gunzip(self.source)
+        # when
+        with patch('gzip.open') as open_mock:
+            target = projects.gunzip(self.source)
+        # then
+        self.assertThat(open_mock.call_count, Equals(0))
+        self.assertThat(target, Equals(self.source[:-3]))
+
+    def testRedoneForNewSource(self):
+        # given
+        projects.gunzip(self.source)
+        self.write_source('recovery')
+        # when
+        target = projects.gunzip(self.source)
+        # then
+        with open(target) as f:
+            self.assertThat(f.read(), Equals('recovery'))
@@ -0,0 +1,160 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.serve."""
+
+import hashlib
+import os
+import requests
+import shutil
+import tempfile
+import threading
+
+from mock import patch
+from os import path
+from phabletutils import downloads
+from phabletutils import resources
+from phabletutils import serve
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import Is
+from tests.test_downloads import _Handler
+from tests.test_downloads import _Server
+
+
+def _start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+class TestCacheServer(TestCase):
+
+    def setUp(self):
+        super(TestCacheServer, self).setUp()
+        self.store_dir = tempfile.mkdtemp()
+        self.download_dir = tempfile.mkdtemp()
+        for patcher in (patch('phabletutils.store.root',
+                              return_value=self.store_dir),
+                        patch('phabletutils.downloads.metadata_dir',
+                              return_value=self.download_dir)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.upstream = _Server(('127.0.0.1', 0), _Handler)
+        self.upstream.content = os.urandom(32 * 1024)
+        self.upstream.ranges = True
+        self.upstream.served = 0
+        self.upstream_uri = _start(self.upstream)
+        self.peer = serve.CacheServer(('127.0.0.1', 0),
+                                      upstreams=[self.upstream_uri])
+        self.peer_uri = _start(self.peer)
+        self.digest = hashlib.sha256(self.upstream.content).hexdigest()
+        downloads.set_peers([self.peer_uri])
+        self.addCleanup(downloads.set_peers, [])
+
+    def tearDown(self):
+        super(TestCacheServer, self).tearDown()
+        for server in (self.upstream, self.peer):
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.store_dir)
+        shutil.rmtree(self.download_dir)
+
+    def store_object(self):
+        with open(path.join(self.store_dir, self.digest), 'wb') as f:
+            f.write(self.upstream.content)
+
+    def artifact(self):
+        artifact = resources.File(
+            file_path=path.join(self.download_dir, 'ubuntu.tar.xz'),
+            file_uri='%s/ubuntu.tar.xz' % self.upstream_uri,
+            file_hash=self.digest)
+        artifact.verify()
+        return artifact
+
+    def testDownloadFromPeer(self):
+        # given
+        self.store_object()
+        artifact = self.artifact()
+        # when
+        downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(True))
+        self.assertThat(self.upstream.served, Equals(0))
+
+    def testFallbackToUpstream(self):
+        # given
+        artifact = self.artifact()
+        # when
+        downloads.download(artifact)
+        # then
+        self.assertThat(artifact.verified, Is(True))
+        self.assertThat(self.upstream.served,
+                        Equals(len(self.upstream.content)))
+
+    def testRange(self):
+        # given
+        self.store_object()
+        # when
+        response = requests.get('%s/objects/%s' % (self.peer_uri,
+                                                   self.digest),
+                                headers={'Range': 'bytes=100-199'})
+        # then
+        self.assertThat(response.status_code, Equals(206))
+        self.assertThat(response.content,
+                        Equals(self.upstream.content[100:200]))
+
+    def testInvertedRange(self):
+        # given
+        self.store_object()
+        # when
+        response = requests.get('%s/objects/%s' % (self.peer_uri,
+                                                   self.digest),
+                                headers={'Range': 'bytes=10-5'})
+        # then
+        self.assertThat(response.status_code, Equals(200))
+        self.assertThat(response.content, Equals(self.upstream.content))
+
+    def testRangeBeyondEnd(self):
+        # given
+        self.store_object()
+        # when
+        response = requests.get('%s/objects/%s' % (self.peer_uri,
+                                                   self.digest),
+                                headers={'Range': 'bytes=%d-' %
+                                         len(self.upstream.content)})
+        # then
+        self.assertThat(response.status_code, Equals(416))
+        self.assertThat(response.content, Equals(''))
+
+    def testMetadataPassthrough(self):
+        # given
+        uri = '%s/SHA256SUMS' % self.upstream_uri
+        # when
+        first = requests.get(downloads.peer_uri(self.peer_uri, uri))
+        second = requests.get(downloads.peer_uri(self.peer_uri, uri))
+        # then
+        self.assertThat(first.content, Equals(self.upstream.content))
+        self.assertThat(second.content, Equals(self.upstream.content))
+        self.assertThat(self.upstream.served,
+                        Equals(len(self.upstream.content)))
+
+    def testOnlyUpstreamsMirrored(self):
+        # when
+        response = requests.get(downloads.peer_uri(
+            self.peer_uri, 'http://example.com/SHA256SUMS'))
+        # then
+        self.assertThat(response.status_code, Equals(403))
@@ -0,0 +1,126 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.states."""
+
+import shutil
+import tempfile
+
+from mock import patch
+from phabletutils import states
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import HasLength
+
+
+class TestStates(TestCase):
+
+    serial = 'A1'
+
+    def setUp(self):
+        super(TestStates, self).setUp()
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        self.now = 0.0
+        self.sleeps = []
+        self.seen = []
+        for patcher in (patch('phabletutils.downloads.metadata_dir',
+                              return_value=self.metadata_dir),
+                        patch('phabletutils.states.time.time',
+                              side_effect=lambda: self.now),
+                        patch('phabletutils.states.time.sleep',
+                              side_effect=self.sleep),
+                        patch('phabletutils.states.adb_states',
+                              side_effect=self.adb_states),
+                        patch('phabletutils.states.fastboot_states',
+                              return_value={})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def adb_states(self):
+        '''Replays self.seen, one state per poll, the last one stays.'''
+        current = self.seen.pop(0) if len(self.seen) > 1 else self.seen[0]
+        return {self.serial: current} if current else {}
+
+    def testReturnsOnceReached(self):
+        # given
+        self.seen = ['device', None, None, 'recovery']
+        # when
+        state = states.wait(self.serial, ['recovery'])
+        # then
+        self.assertThat(state, Equals('recovery'))
+        self.assertThat(self.sleeps, HasLength(3))
+
+    def testBacksOff(self):
+        # given
+        self.seen = [None] * 12 + ['device']
+        # when
+        states.wait(self.serial, ['device'])
+        # then
+        self.assertThat([round(s, 3) for s in self.sleeps[:3]],
+                        Equals([0.1, 0.15, 0.225]))
+        self.assertThat(max(self.sleeps), Equals(2))
+
+    def testWaitsToLeave(self):
+        # given
+        self.seen = ['device', 'device', None, 'device']
+        # when
+        states.wait(self.serial, ['device'], leave='device')
+        # then
+        self.assertThat(self.seen, Equals(['device']))
+        self.assertThat(self.sleeps, HasLength(2))
+
+    def testProceedsWhenNeverLeaving(self):
+        # given
+        self.seen = ['device']
+        # when
+        state = states.wait(self.serial, ['device'], leave='device')
+        # then
+        self.assertThat(state, Equals('device'))
+        self.assertThat(self.now, Equals(10))
+
+    def testDeadline(self):
+        # given
+        self.seen = ['offline']
+        # then
+        self.assertRaises(EnvironmentError, states.wait, self.serial,
+                          ['recovery'], timeout=30)
+        self.assertThat(self.now, Equals(30))
+
+    def testRecordsPerModel(self):
+        # given
+        self.seen = ['device', None, None, 'recovery']
+        # when
+        states.wait(self.serial, ['recovery'], model='mako',
+                    transition='device->recovery')
+        states.wait(self.serial, ['recovery'], model='mako',
+                    transition='device->recovery')
+        # then
+        self.assertThat(states.transition_times('mako'),
+                        Equals({'device->recovery': [0.5, 0.0]}))
+        self.assertThat(states.transition_times('maguro'), Equals({}))
+
+    @patch('phabletutils.settings.state_samples', 2)
+    def testKeepsLastSamples(self):
+        # when
+        for elapsed in (10, 20, 30):
+            states.record('mako', 'device->fastboot', elapsed)
+        # then
+        self.assertThat(states.transition_times('mako'),
+                        Equals({'device->fastboot': [20, 30]}))
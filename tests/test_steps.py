@@ -0,0 +1,130 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.steps."""
+
+import threading
+import time
+
+from mock import patch
+from phabletutils import steps
+from phabletutils.steps import Step
+from testtools import TestCase
+from testtools.matchers import Equals
+
+
+class TestSteps(TestCase):
+
+    def setUp(self):
+        super(TestSteps, self).setUp()
+        self.order = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def work(self, name, seconds=0):
+        def func():
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(seconds)
+            with self.lock:
+                self.running -= 1
+                self.order.append(name)
+        return func
+
+    def testRunsAfterRequired(self):
+        # given
+        graph = [Step('boot', self.work('boot'), requires=['flash']),
+                 Step('flash', self.work('flash', 0.05), requires=['reboot']),
+                 Step('reboot', self.work('reboot'))]
+        # when
+        steps.run(graph)
+        # then
+        self.assertThat(self.order, Equals(['reboot', 'flash', 'boot']))
+
+    def testIndependentOverlap(self):
+        # given
+        graph = [Step('reboot', self.work('reboot', 0.1)),
+                 Step('fetch', self.work('fetch', 0.1)),
+                 Step('push', self.work('push'),
+                      requires=['reboot', 'fetch'])]
+        # when
+        steps.run(graph)
+        # then
+        self.assertThat(self.peak, Equals(2))
+        self.assertThat(self.order[-1], Equals('push'))
+        self.assertThat(graph[1].start < graph[0].elapsed, Equals(True))
+
+    def testSlotsLimit(self):
+        # given
+        slots = threading.Semaphore(2)
+        graph = [Step('fetch %d' % i, self.work(i, 0.05), slots=slots)
+                 for i in range(5)]
+        # when
+        steps.run(graph)
+        # then
+        self.assertThat(self.peak, Equals(2))
+        self.assertThat(sorted(self.order), Equals(range(5)))
+
+    def testFailureStopsDependents(self):
+        # given
+        def fail():
+            raise EnvironmentError('no device')
+        cancel = threading.Event()
+        graph = [Step('reboot', fail),
+                 Step('fetch', self.work('fetch', 0.1)),
+                 Step('push', self.work('push'),
+                      requires=['reboot', 'fetch'])]
+        # then
+        self.assertRaises(EnvironmentError, steps.run, graph, cancel)
+        self.assertThat(self.order, Equals(['fetch']))
+        self.assertThat(cancel.is_set(), Equals(True))
+        self.assertThat(graph[2].start, Equals(None))
+
+    def testUnknownRequirement(self):
+        # given
+        graph = [Step('push', self.work('push'), requires=['fetch'])]
+        # then
+        self.assertRaises(ValueError, steps.run, graph)
+        self.assertThat(self.order, Equals([]))
+
+    def testDefinedTwice(self):
+        # given
+        graph = [Step('push', self.work('push')),
+                 Step('push', self.work('push'))]
+        # then
+        self.assertRaises(ValueError, steps.run, graph)
+
+    def testCycle(self):
+        # given
+        graph = [Step('a', self.work('a'), requires=['b']),
+                 Step('b', self.work('b'), requires=['a'])]
+        # then
+        self.assertRaises(RuntimeError, steps.run, graph)
+
+    @patch('phabletutils.steps.log')
+    def testReportsStepsThatRan(self, log_mock):
+        # given
+        graph = [Step('reboot', None), Step('push', None)]
+        graph[0].start, graph[0].elapsed = 0.0, 20.0
+        graph[1].start, graph[1].elapsed = 20.0, 4.5
+        # when
+        steps.report(graph + [Step('flash', None)])
+        # then
+        lines = [c[0][0] for c in log_mock.info.call_args_list]
+        self.assertThat(lines, Equals(['Step timings, 24.5s in total:',
+                                       '      0.0s    20.0s  reboot',
+                                       '     20.0s     4.5s  push']))
@@ -0,0 +1,142 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.trace."""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from mock import patch
+from os import path
+from phabletutils import downloads
+from phabletutils import settings
+from phabletutils import trace
+from phabletutils.device import Fastboot
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import HasLength
+from tests.test_downloads import _Handler
+from tests.test_downloads import _Server
+
+
+class TestTrace(TestCase):
+
+    def setUp(self):
+        super(TestTrace, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.addCleanup(trace.stop)
+        trace.start()
+
+    def spans(self):
+        trace_path = path.join(self.tmp_dir, 'trace.json')
+        trace.write(trace_path)
+        with open(trace_path) as trace_file:
+            events = json.load(trace_file)['traceEvents']
+        return dict((e['name'], e) for e in events if e['ph'] == 'X')
+
+    def testNested(self):
+        # when
+        with trace.span('provision', 'projects'):
+            with trace.span('push', 'device', dst='/cache') as span:
+                span['bytes'] = 10
+        # then
+        spans = self.spans()
+        outer, inner = spans['provision'], spans['push']
+        self.assertThat(inner['args'], Equals({'dst': '/cache',
+                                               'bytes': 10}))
+        self.assertThat(inner['tid'], Equals(outer['tid']))
+        self.assertThat(outer['ts'] <= inner['ts'], Equals(True))
+        self.assertThat(inner['ts'] + inner['dur'] <=
+                        outer['ts'] + outer['dur'], Equals(True))
+
+    def testRecordsError(self):
+        # when
+        try:
+            with trace.span('flash', 'device'):
+                raise EnvironmentError('no device')
+        except EnvironmentError:
+            pass
+        # then
+        self.assertThat(self.spans()['flash']['args'],
+                        Equals({'error': 'no device'}))
+
+    def testNamesThreads(self):
+        # given
+        def fetch():
+            with trace.span('fetch', 'downloads'):
+                pass
+        thread = threading.Thread(target=fetch, name='worker')
+        # when
+        fetch()
+        thread.start()
+        thread.join()
+        trace_path = path.join(self.tmp_dir, 'trace.json')
+        trace.write(trace_path, {'argv': ['ubuntu-system']})
+        # then
+        with open(trace_path) as trace_file:
+            written = json.load(trace_file)
+        names = [e['args']['name'] for e in written['traceEvents']
+                 if e['ph'] == 'M']
+        self.assertThat(names, Equals([threading.current_thread().name,
+                                       'worker']))
+        self.assertThat(written['otherData'],
+                        Equals({'argv': ['ubuntu-system']}))
+
+    def testNothingWhenStopped(self):
+        # given
+        trace.stop()
+        # when
+        with trace.span('push', 'device') as span:
+            span['bytes'] = 10
+        # then
+        self.assertThat(trace.current(), Equals({}))
+        self.assertThat(trace.enabled(), Equals(False))
+
+    @patch('phabletutils.device.subprocess.call', return_value=1)
+    def testExitCode(self, call_mock):
+        # then
+        self.assertRaises(subprocess.CalledProcessError,
+                          Fastboot().flash, 'recovery', 'recovery.img')
+        span = self.spans()['fastboot flash recovery recovery.img']
+        self.assertThat(span['args']['exit_code'], Equals(1))
+
+    @patch.object(settings, 'download_segment_min_size', 4096)
+    def testDownloadBytes(self):
+        # given
+        server = _Server(('127.0.0.1', 0), _Handler)
+        server.content = os.urandom(64 * 1024)
+        server.ranges = True
+        server.served = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        uri = 'http://127.0.0.1:%d/ubuntu.tar.xz' % server.server_address[1]
+        # when
+        downloads._download(uri, path.join(self.tmp_dir, 'ubuntu.tar.xz'))
+        downloads.hash_file(path.join(self.tmp_dir, 'ubuntu.tar.xz'))
+        # then
+        spans = self.spans()
+        self.assertThat(spans['fetch']['args']['bytes'],
+                        Equals(len(server.content)))
+        self.assertThat(spans['hash ubuntu.tar.xz']['args']['bytes'],
+                        Equals(len(server.content)))
+        self.assertThat(spans, HasLength(2))
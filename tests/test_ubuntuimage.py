@@ -15,14 +15,26 @@
 
 """Unit tests for phabletutils.environment."""
 
+import shutil
+import tempfile
+
+from mock import MagicMock
 from mock import patch
+from phabletutils import settings
 from phabletutils import ubuntuimage
 from testtools import TestCase
 from testtools.matchers import Equals
 from testtools.matchers import HasLength
 
 
-@patch('phabletutils.downloads.get_content')
+def _response(content, status_code=200, chunk_size=1000):
+    response = MagicMock(status_code=status_code, headers={'etag': '"1"'})
+    response.iter_content.return_value = (
+        content[i:i + chunk_size] for i in range(0, len(content), chunk_size))
+    return response
+
+
+@patch('phabletutils.network.get')
 class TestUbuntuImage(TestCase):
 
     def setUp(self):
@@ -30,10 +42,16 @@ class TestUbuntuImage(TestCase):
         self.device = 'mako'
         with open('tests/index.json', 'r') as f:
             self.json_content = f.read()
+        self.metadata_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metadata_dir)
+        patcher = patch('phabletutils.downloads.metadata_dir',
+                        return_value=self.metadata_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
-    def testGetLatestIndex(self, get_content_mock):
+    def testGetLatestIndex(self, get_mock):
         # given
-        get_content_mock.return_value = self.json_content
+        get_mock.return_value = _response(self.json_content)
         # when
         json_dict = ubuntuimage.get_json_from_index(self.device, 0)
         # then
@@ -42,9 +60,9 @@ class TestUbuntuImage(TestCase):
         self.assertThat(json_dict['type'], Equals('full'))
         self.assertThat(json_dict['files'], HasLength(3))
 
-    def testGetPreviousIndex(self, get_content_mock):
+    def testGetPreviousIndex(self, get_mock):
         # given
-        get_content_mock.return_value = self.json_content
+        get_mock.return_value = _response(self.json_content)
         # when
         json_dict = ubuntuimage.get_json_from_index(self.device, -1)
         # then
@@ -52,3 +70,113 @@ class TestUbuntuImage(TestCase):
         self.assertThat(json_dict['description'], Equals('20130806.1'))
         self.assertThat(json_dict['type'], Equals('full'))
         self.assertThat(json_dict['files'], HasLength(3))
+
+    def testDeltaChain(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        # when
+        chain = ubuntuimage.get_delta_chain(catalog, 20130806, 20130808)
+        # then
+        self.assertThat([(i['base'], i['version']) for i in chain],
+                        Equals([(20130806, 20130807), (20130807, 20130808)]))
+
+    def testDeltaChainMissingBase(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        # when
+        chain = ubuntuimage.get_delta_chain(catalog, 20130701, 20130808)
+        # then
+        self.assertThat(chain, Equals(None))
+
+    def testDeltaChainNotWorthIt(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        # when
+        chain = ubuntuimage.get_delta_chain(catalog, 20130733, 20130808)
+        # then
+        self.assertThat(chain, Equals(None))
+
+    def testDeltaFilesInOrder(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        chain = ubuntuimage.get_delta_chain(catalog, 20130806, 20130808)
+        # when
+        files, command_part = ubuntuimage.get_delta_files(
+            '/tmp', settings.system_image_uri, chain)
+        # then
+        self.assertThat(files, HasLength(8))
+        self.assertThat(command_part.splitlines()[0], Equals(
+            'update ubuntu-20130806.1.delta-20130806.tar.xz '
+            'ubuntu-20130806.1.delta-20130806.tar.xz.asc'))
+        self.assertThat(command_part.splitlines()[-1], Equals(
+            'update version-20130808.tar.xz version-20130808.tar.xz.asc'))
+
+    def testExactVersion(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        # when
+        image = catalog.exact(20130805)
+        # then
+        self.assertThat(image['type'], Equals('full'))
+        self.assertThat(image['version'], Equals(20130805))
+
+    def testMissingVersion(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        catalog = ubuntuimage.get_catalog(self.device)
+        # then
+        self.assertRaises(EnvironmentError, catalog.exact, 20130701)
+
+    def testCatalogRevalidated(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        ubuntuimage.get_catalog(self.device, ttl=0)
+        get_mock.return_value = _response('', status_code=304)
+        # when
+        catalog = ubuntuimage.get_catalog(self.device, ttl=0)
+        # then
+        self.assertThat(get_mock.call_args[1]['headers'],
+                        Equals({'If-None-Match': '"1"'}))
+        self.assertThat(catalog.latest()['version'], Equals(20130808))
+
+    def testCatalogFresh(self, get_mock):
+        # given
+        get_mock.return_value = _response(self.json_content)
+        ubuntuimage.get_catalog(self.device, ttl=60)
+        # when
+        ubuntuimage.get_catalog(self.device, ttl=60)
+        # then
+        self.assertThat(get_mock.call_count, Equals(1))
+
+    def testIterArray(self, get_mock):
+        # given
+        content = '{"global": {"images": 1}, "images": [{"a": "]"}, {}]}'
+        # when
+        items = list(ubuntuimage.iter_array(iter(content), 'images'))
+        # then
+        self.assertThat(items, Equals([{'a': ']'}, {}]))
+
+    def testInstalledVersion(self, get_mock):
+        # given
+        adb = MagicMock()
+        adb.shell.return_value = ('[service]\r\nbase: system-image.ubuntu.com'
+                                  '\r\nchannel: devel\r\ndevice: mako\r\n'
+                                  'build_number: 20130806\r\n')
+        # when
+        installed = ubuntuimage.installed_version(adb)
+        # then
+        self.assertThat(installed, Equals((20130806, 'devel', 'mako')))
+
+    def testInstalledVersionWithoutChannel(self, get_mock):
+        # given
+        adb = MagicMock()
+        adb.shell.return_value = '[service]\nbuild_number: 20130806\n'
+        # when
+        installed = ubuntuimage.installed_version(adb)
+        # then
+        self.assertThat(installed, Equals((20130806, None, None)))
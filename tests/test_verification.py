@@ -0,0 +1,157 @@
+# Copyright (C) 2013 Canonical Ltd.
+# Author: Sergio Schvezov <sergio.schvezov@canonical.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for phabletutils.verification."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from mock import patch
+from os import path
+from phabletutils import resources
+from phabletutils import verification
+from testtools import TestCase
+from testtools.matchers import Equals
+from testtools.matchers import Is
+
+
+class TestVerificationCache(TestCase):
+
+    def setUp(self):
+        super(TestVerificationCache, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.path = path.join(self.download_dir, 'ubuntu.zip')
+        self.content = 'ubuntu touch'
+        with open(self.path, 'w') as f:
+            f.write(self.content)
+        self.hash = hashlib.sha256(self.content).hexdigest()
+
+    def tearDown(self):
+        super(TestVerificationCache, self).tearDown()
+        shutil.rmtree(self.download_dir)
+
+    def artifact(self):
+        artifact = resources.File(file_path=self.path, file_uri=None,
+                                  file_hash=self.hash)
+        artifact.verify()
+        return artifact
+
+    def testUnchangedFileNotRead(self):
+        # given
+        self.artifact()
+        # when
+        with patch('phabletutils.downloads.hash_file') as hash_file_mock:
+            artifact = self.artifact()
+        # then
+        self.assertThat(artifact.verified, Is(True))
+        self.assertThat(hash_file_mock.called, Is(False))
+
+    def testChangedFileInvalidates(self):
+        # given
+        self.artifact()
+        with open(self.path, 'w') as f:
+            f.write('ubuntu toucH')
+        # when
+        artifact = self.artifact()
+        # then
+        self.assertThat(artifact.verified, Is(False))
+        self.assertThat(verification.cached_digest(self.path, 'sha256'),
+                        Is(None))
+
+    def testTouchedFileInvalidates(self):
+        # given
+        self.artifact()
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+        # when
+        with patch('phabletutils.downloads.hash_file') as hash_file_mock:
+            hash_file_mock.return_value = hashlib.sha256(self.content)
+            self.artifact()
+        # then
+        self.assertThat(hash_file_mock.called, Is(True))
+
+    def testDigestsPerAlgorithm(self):
+        # when
+        verification.record_digest(self.path, 'md5', 'md5sum')
+        verification.record_digest(self.path, 'sha256', 'sha256sum')
+        # then
+        self.assertThat(verification.cached_digest(self.path, 'md5'),
+                        Equals('md5sum'))
+        self.assertThat(verification.cached_digest(self.path, 'sha256'),
+                        Equals('sha256sum'))
+
+    def testConcurrentRecords(self):
+        # given
+        paths = [path.join(self.download_dir, 'file%d' % i)
+                 for i in range(16)]
+        for file_path in paths:
+            open(file_path, 'w').close()
+        threads = [threading.Thread(target=verification.record_digest,
+                                    args=(p, 'sha256', p)) for p in paths]
+        # when
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # then
+        for file_path in paths:
+            self.assertThat(verification.cached_digest(file_path, 'sha256'),
+                            Equals(file_path))
+
+
+class TestLazyVerification(TestCase):
+
+    def setUp(self):
+        super(TestLazyVerification, self).setUp()
+        self.download_dir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(4):
+            file_path = path.join(self.download_dir, 'file%d' % i)
+            with open(file_path, 'w') as f:
+                f.write('content %d' % i)
+            self.files.append(resources.File(
+                file_path=file_path, file_uri=None,
+                file_hash=hashlib.sha256('content %d' % i).hexdigest()))
+
+    def tearDown(self):
+        super(TestLazyVerification, self).tearDown()
+        shutil.rmtree(self.download_dir)
+
+    @patch('phabletutils.downloads.hash_file')
+    def testNotVerifiedOnCreation(self, hash_file_mock):
+        # when
+        resources.File(file_path=path.join(self.download_dir, 'file0'),
+                       file_uri=None, file_hash='0' * 64)
+        # then
+        self.assertThat(hash_file_mock.called, Is(False))
+
+    def testVerifyFiles(self):
+        # when
+        verification.verify_files(self.files, concurrency=2)
+        # then
+        self.assertThat([f._verified for f in self.files],
+                        Equals([True] * 4))
+
+    def testVerifyFilesOnce(self):
+        # given
+        verification.verify_files(self.files)
+        # when
+        with patch('phabletutils.verification.verify') as verify_mock:
+            verification.verify_files(self.files)
+        # then
+        self.assertThat(verify_mock.called, Is(False))